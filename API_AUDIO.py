@@ -4,8 +4,17 @@
 # Other providers are being explored. 
 
 import requests
+import httpx
+import asyncio
+import collections
+import hashlib
 import json
 import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from typing import Optional, List, Dict, Union, BinaryIO
 from dataclasses import dataclass, asdict
 from enum import Enum
@@ -14,6 +23,111 @@ from dotenv import load_dotenv
 # Load env for API keys
 load_dotenv()
 
+from tts_cache import TTS_CACHE_ENABLED, CacheWriter, TTSCache, audio_cache_key, tts_cache
+from tts_metadata import MetadataCache, tts_metadata
+
+# Bytes read from the provider (or the cache) per chunk when streaming audio
+TTS_STREAM_CHUNK_BYTES = int(os.getenv("TTS_STREAM_CHUNK_BYTES", 16384))
+
+# ElevenLabs plans limit how many requests can run at once. This is the limit for one worker,
+# sync and async requests together (plan limit / number of gunicorn workers).
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", 4))
+# Retries of a request the provider turned away (429 or 503), waiting for Retry-After in between
+TTS_MAX_RETRIES = int(os.getenv("TTS_MAX_RETRIES", 3))
+TTS_REQUEST_TIMEOUT = float(os.getenv("TTS_REQUEST_TIMEOUT", 60))
+
+RETRY_STATUSES = (429, 503)
+
+
+class ProviderSlots:
+    """A semaphore for threads and asyncio tasks together, served first come first served.
+
+    A released slot is handed straight to the longest waiting request, so a thread that keeps
+    taking slots can't starve the event loop's requests (threading.Semaphore lets it barge in).
+    """
+
+    def __init__(self, slots: int):
+        self._free = slots
+        self._waiters = collections.deque()  # threading.Event or (loop, future)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            granted = threading.Event()
+            self._waiters.append(granted)
+        granted.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The slot was handed over as the task was cancelled, pass it on
+            self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._free += 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# One slot per request in flight to ElevenLabs from this worker
+provider_slots = ProviderSlots(TTS_MAX_CONCURRENCY)
+
+
+def retry_delay(headers, attempt: int) -> float:
+    """Seconds to wait before retrying: the provider's Retry-After if it sent one, else exponential backoff"""
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return min(30.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def provider_error(response, label: str = "ElevenLabs API") -> requests.RequestException:
+    """Exception for a failed ElevenLabs response (requests or httpx)"""
+    error_message = response.text
+    try:
+        error_data = response.json()
+        error_message = error_data.get("detail", error_message)
+    except:
+        pass
+    return requests.RequestException(f"{label} error {response.status_code}: {error_message}")
+
+
 # Audio format options supported by ElevenLabs
 class AudioFormat(Enum):
     MP3_STANDARD_32 = "mp3_44100_32"      # Standard quality 
@@ -29,6 +143,10 @@ class AudioFormat(Enum):
     PCM_CD_QUALITY_44K = "pcm_44100"      # CD PCM
     
     ULAW_TELEPHONY = "ulaw_8000"          # for telephony systems
+    
+    OPUS_COMPACT_32 = "opus_48000_32"     # Opus in Ogg, about as good as MP3 at twice the bitrate
+    
+    WAV_22050 = "wav_22050"               # Uncompressed WAV (what the local engines produce)
 
 
 class TextProcessingMode(Enum):
@@ -68,24 +186,137 @@ class PronunciationDictionary:
     version_id: str  
 
 
-class SpeechSynthesizer:
+class AudioStream:
+    """Audio chunks of a streamed synthesis as they arrive from ElevenLabs (or a local engine).
+
+    Chunks are passed on as they are read, so a stream only ever holds one chunk in memory.
+    With a cache_writer they are also written to the TTS cache, and the clip is cached once the
+    stream has been read to the end.
+
+    request_id identifies the generation, it can be passed as previous_request_ids/next_request_ids
+    to neighbouring requests so the joins sound continuous.
+    """
+    
+    cached = False
+    
+    def __init__(self, response, chunk_size: int = TTS_STREAM_CHUNK_BYTES, cache_writer: Optional[CacheWriter] = None,
+                 holds_provider_slot: bool = False):
+        self.response = response
+        self.request_id = response.headers.get("request-id")
+        self.chunk_size = chunk_size
+        self.cache_writer = cache_writer
+        # The request counts against TTS_MAX_CONCURRENCY until the stream is closed
+        self._holds_provider_slot = holds_provider_slot
+    
+    def __iter__(self):
+        try:
+            for audio_chunk in self.response.iter_content(chunk_size=self.chunk_size):
+                if self.cache_writer:
+                    self.cache_writer.write(audio_chunk)
+                yield audio_chunk
+            if self.cache_writer:
+                self.cache_writer.commit()
+        finally:
+            self.close()
+    
+    def close(self):
+        # Does nothing after a commit, drops a clip that was cut off
+        if self.cache_writer:
+            self.cache_writer.abort()
+        self.response.close()
+        if self._holds_provider_slot:
+            self._holds_provider_slot = False
+            provider_slots.release()
+    
+    def __del__(self):
+        # A stream that is never read must still give its slot back
+        if self._holds_provider_slot:
+            self.close()
+
+
+class CachedAudioStream:
+    """A clip from the TTS cache, read in chunks like an AudioStream"""
+    
+    cached = True
+    request_id = None
+    
+    def __init__(self, file_path: str, chunk_size: int = TTS_STREAM_CHUNK_BYTES):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self._file = None
+    
+    def __iter__(self):
+        self._file = open(self.file_path, 'rb')
+        try:
+            while True:
+                audio_chunk = self._file.read(self.chunk_size)
+                if not audio_chunk:
+                    break
+                yield audio_chunk
+        finally:
+            self.close()
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class SpeechBackend:
+    """
+    What the app needs from a text-to-speech engine. SpeechSynthesizer (ElevenLabs) and
+    LocalSpeechSynthesizer (tts_local.py, espeak-ng/Piper) implement it, and each agent picks one
+    with "backend" in the "audio" block of its JSON. Both use the TTS cache the same way.
+    """
+    
+    name = ""
+    cache = None
+    
+    def synthesize_speech(self, text_content: str, voice_id: str, **options) -> bytes:
+        """The whole clip for text_content"""
+        raise NotImplementedError
+    
+    def synthesize_speech_streaming(self, text_content: str, voice_id: str, **options):
+        """An AudioStream (or CachedAudioStream) yielding the clip in chunks"""
+        raise NotImplementedError
+    
+    def cache_key(self, text_content: str, voice_id: str, **options) -> str:
+        """TTS cache key of the clip synthesize_speech would return"""
+        raise NotImplementedError
+    
+    def supports_format(self, audio_format: AudioFormat) -> bool:
+        """Whether this backend can produce audio_format"""
+        return True
+
+
+class SpeechSynthesizer(SpeechBackend):
+    name = "elevenlabs"
     API_BASE_URL = "https://api.elevenlabs.io/v1"
     
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, cache: Optional[TTSCache] = None, use_cache: bool = True,
+                 metadata: Optional[MetadataCache] = None):
         self.api_key = api_key or os.getenv("ELEVENLABS_API_KEY")
         if not self.api_key:
             raise ValueError("API key required. Set ELEVENLABS_API_KEY in .env file or pass api_key parameter.")
         
+        # Repeated phrases are served from the TTS cache instead of synthesized again (see tts_cache.py)
+        self.cache = None
+        if use_cache:
+            self.cache = cache or (tts_cache if TTS_CACHE_ENABLED else None)
+        
+        # Voice and model lists are cached too (see tts_metadata.py). Accounts can have different
+        # voices, so entries are kept per API key (by a hash, the key itself isn't saved).
+        self.metadata = metadata or tts_metadata
+        self._metadata_prefix = hashlib.sha256(self.api_key.encode()).hexdigest()[:12]
+        
         self.session = requests.Session()
         self.session.headers.update({
             "xi-api-key": self.api_key,
             "Content-Type": "application/json"
         })
     
-    def synthesize_speech(
+    def _build_request(
         self,
         text_content: str,
-        voice_id: str,
         model_id: str = "eleven_multilingual_v2",
         voice_settings: Optional[VoiceSettings] = None,
         language_code: Optional[str] = None,
@@ -101,36 +332,8 @@ class SpeechSynthesizer:
         enable_request_logging: bool = True,
         latency_optimization: Optional[int] = None,
         audio_format: AudioFormat = AudioFormat.MP3_PROFESSIONAL_128
-    ) -> bytes:
-        """
-        Convert text to natural-sounding speech using ElevenLabs API
-        
-        Args:
-            text_content: The text to convert to speech (required)
-            voice_id: Voice ID to use for synthesis (required)
-            model_id: AI model for generation (default: eleven_multilingual_v2)
-            voice_settings: Voice configuration settings
-            language_code: ISO 639-1 language code for language-specific processing
-            pronunciation_dictionaries: Custom pronunciation dictionaries to apply
-            generation_seed: Seed for reproducible results (0-4294967295)
-            previous_text: Previous text for better continuity
-            next_text: Following text for smoother transitions
-            previous_request_ids: Previous request IDs for continuity (max 3)
-            next_request_ids: Next request IDs for continuity (max 3)
-            text_processing: Text normalization mode
-            language_normalization: Enable language-specific text processing
-            use_legacy_voice_model: Use legacy voice model (deprecated)
-            enable_request_logging: Enable API request logging
-            latency_optimization: Latency optimization level (0-4, deprecated)
-            audio_format: Output audio format
-        
-        Returns:
-            bytes: Generated audio data
-        
-        Raises:
-            requests.RequestException: If API request fails
-            ValueError: If parameters are invalid
-        """
+    ):
+        """Validate the synthesis options and build the query parameters and JSON payload"""
         # Validate input parameters
         if not text_content.strip():
             raise ValueError("Text content cannot be empty")
@@ -148,7 +351,6 @@ class SpeechSynthesizer:
             raise ValueError("Latency optimization must be between 0 and 4")
         
         # Build API request
-        api_url = f"{self.API_BASE_URL}/text-to-speech/{voice_id}"
         request_params = {
             "enable_logging": str(enable_request_logging).lower(),
             "output_format": audio_format.value
@@ -196,61 +398,153 @@ class SpeechSynthesizer:
         if next_request_ids:
             payload["next_request_ids"] = next_request_ids
         
-        # executing the API request here
-        response = self.session.post(
-            api_url,
-            params=request_params,
-            json=payload
+        return request_params, payload
+    
+    @staticmethod
+    def _cache_key(voice_id: str, request_params: Dict, payload: Dict) -> str:
+        return audio_cache_key(
+            voice_id=voice_id,
+            output_format=request_params["output_format"],
+            latency_optimization=request_params.get("optimize_streaming_latency"),
+            payload=payload
         )
+    
+    def cache_key(self, text_content: str, voice_id: str, **options) -> str:
+        """TTS cache key of the audio synthesize_speech would return for these arguments"""
+        request_params, payload = self._build_request(text_content, **options)
+        return self._cache_key(voice_id, request_params, payload)
+    
+    def synthesize_speech(
+        self,
+        text_content: str,
+        voice_id: str,
+        model_id: str = "eleven_multilingual_v2",
+        voice_settings: Optional[VoiceSettings] = None,
+        language_code: Optional[str] = None,
+        pronunciation_dictionaries: Optional[List[PronunciationDictionary]] = None,
+        generation_seed: Optional[int] = None,
+        previous_text: Optional[str] = None,
+        next_text: Optional[str] = None,
+        previous_request_ids: Optional[List[str]] = None,
+        next_request_ids: Optional[List[str]] = None,
+        text_processing: TextProcessingMode = TextProcessingMode.AUTO_DETECT,
+        language_normalization: bool = False,
+        use_legacy_voice_model: bool = False,
+        enable_request_logging: bool = True,
+        latency_optimization: Optional[int] = None,
+        audio_format: AudioFormat = AudioFormat.MP3_PROFESSIONAL_128
+    ) -> bytes:
+        """
+        Convert text to natural-sounding speech using ElevenLabs API
+        
+        Args:
+            text_content: The text to convert to speech (required)
+            voice_id: Voice ID to use for synthesis (required)
+            model_id: AI model for generation (default: eleven_multilingual_v2)
+            voice_settings: Voice configuration settings
+            language_code: ISO 639-1 language code for language-specific processing
+            pronunciation_dictionaries: Custom pronunciation dictionaries to apply
+            generation_seed: Seed for reproducible results (0-4294967295)
+            previous_text: Previous text for better continuity
+            next_text: Following text for smoother transitions
+            previous_request_ids: Previous request IDs for continuity (max 3)
+            next_request_ids: Next request IDs for continuity (max 3)
+            text_processing: Text normalization mode
+            language_normalization: Enable language-specific text processing
+            use_legacy_voice_model: Use legacy voice model (deprecated)
+            enable_request_logging: Enable API request logging
+            latency_optimization: Latency optimization level (0-4, deprecated)
+            audio_format: Output audio format
+        
+        Returns:
+            bytes: Generated audio data
+        
+        Raises:
+            requests.RequestException: If API request fails
+            ValueError: If parameters are invalid
+        """
+        api_url = f"{self.API_BASE_URL}/text-to-speech/{voice_id}"
+        request_params, payload = self._build_request(
+            text_content, model_id, voice_settings, language_code, pronunciation_dictionaries,
+            generation_seed, previous_text, next_text, previous_request_ids, next_request_ids,
+            text_processing, language_normalization, use_legacy_voice_model, enable_request_logging,
+            latency_optimization, audio_format
+        )
+        
+        # Same request as before = same audio, so don't pay for it twice
+        cache_key = None
+        if self.cache:
+            cache_key = self._cache_key(voice_id, request_params, payload)
+            cached_audio = self.cache.get(cache_key, audio_format.value)
+            if cached_audio is not None:
+                return cached_audio
+        
+        # executing the API request here
+        for attempt in range(TTS_MAX_RETRIES + 1):
+            with provider_slots:
+                response = self.session.post(
+                    api_url,
+                    params=request_params,
+                    json=payload,
+                    timeout=TTS_REQUEST_TIMEOUT
+                )
+            if response.status_code not in RETRY_STATUSES or attempt == TTS_MAX_RETRIES:
+                break
+            time.sleep(retry_delay(response.headers, attempt))
         
         if response.status_code != 200:
-            error_message = response.text
-            try:
-                error_data = response.json()
-                error_message = error_data.get("detail", error_message)
-            except:
-                pass
-            raise requests.RequestException(
-                f"ElevenLabs API error {response.status_code}: {error_message}"
-            )
+            raise provider_error(response)
         
+        if cache_key:
+            self.cache.put(cache_key, response.content, audio_format.value)
         return response.content
     
-    def get_available_voices(self) -> List[Dict]:
+    def _metadata_key(self, name: str) -> str:
+        return f"{self._metadata_prefix}:{name}"
+    
+    def _get_metadata(self, path: str):
+        response = self.session.get(f"{self.API_BASE_URL}{path}", timeout=TTS_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    
+    def get_available_voices(self, refresh: bool = False) -> List[Dict]:
         """
-        Retrieve all available voices from ElevenLabs
+        Retrieve all available voices from ElevenLabs (cached, see tts_metadata.py)
+        
+        Args:
+            refresh: Fetch the list again even if the cached one is fresh
         
         Returns:
             List[Dict]: Collection of voice information and metadata
         """
-        response = self.session.get(f"{self.API_BASE_URL}/voices")
-        response.raise_for_status()
-        return response.json().get("voices", [])
+        return self.metadata.get(self._metadata_key("voices"),
+                                 lambda: self._get_metadata("/voices").get("voices", []), refresh)
     
-    def get_voice_details(self, voice_id: str) -> Dict:
+    def get_voice_details(self, voice_id: str, refresh: bool = False) -> Dict:
         """
-        Get detailed information about a specific voice
+        Get detailed information about a specific voice (cached, see tts_metadata.py)
         
         Args:
             voice_id: The voice identifier to query
+            refresh: Fetch the details again even if the cached ones are fresh
         
         Returns:
             Dict: Voice details including settings and capabilities
         """
-        response = self.session.get(f"{self.API_BASE_URL}/voices/{voice_id}")
-        response.raise_for_status()
-        return response.json()
+        return self.metadata.get(self._metadata_key(f"voice:{voice_id}"),
+                                 lambda: self._get_metadata(f"/voices/{voice_id}"), refresh)
     
-    def get_available_models(self) -> List[Dict]:
+    def get_available_models(self, refresh: bool = False) -> List[Dict]:
         """
-        Retrieve all available AI models for speech synthesis
+        Retrieve all available AI models for speech synthesis (cached, see tts_metadata.py)
+        
+        Args:
+            refresh: Fetch the list again even if the cached one is fresh
         
         Returns:
             List[Dict]: Collection of model information and capabilities
         """
-        response = self.session.get(f"{self.API_BASE_URL}/models")
-        response.raise_for_status()
-        return response.json()
+        return self.metadata.get(self._metadata_key("models"), lambda: self._get_metadata("/models"), refresh)
     
     def synthesize_speech_streaming(
         self,
@@ -270,99 +564,62 @@ class SpeechSynthesizer:
         use_legacy_voice_model: bool = False,
         enable_request_logging: bool = True,
         latency_optimization: Optional[int] = None,
-        audio_format: AudioFormat = AudioFormat.MP3_PROFESSIONAL_128
+        audio_format: AudioFormat = AudioFormat.MP3_PROFESSIONAL_128,
+        chunk_size: int = TTS_STREAM_CHUNK_BYTES,
+        use_cache: bool = True
     ):
         """
         Convert text to speech with streaming response for real-time audio
         
-        Same parameters as synthesize_speech, but returns streaming audio chunks
+        Same parameters as synthesize_speech, plus chunk_size (bytes per chunk), but returns
+        streaming audio chunks. Audio that is already in the TTS cache is read from there, and new
+        audio is cached as it streams through (unless use_cache is False).
         
         Returns:
-            Iterator yielding audio chunks as they're generated
+            AudioStream (or CachedAudioStream) yielding audio chunks as they're generated
         """
-        # Input validation (same as main synthesis method)
-        if not text_content.strip():
-            raise ValueError("Text content cannot be empty")
-        
-        if generation_seed is not None and not (0 <= generation_seed <= 4294967295):
-            raise ValueError("Generation seed must be between 0 and 4294967295")
-        
-        if previous_request_ids and len(previous_request_ids) > 3:
-            raise ValueError("Maximum 3 previous request IDs allowed")
-        
-        if next_request_ids and len(next_request_ids) > 3:
-            raise ValueError("Maximum 3 next request IDs allowed")
-        
-        if latency_optimization is not None and not (0 <= latency_optimization <= 4):
-            raise ValueError("Latency optimization must be between 0 and 4")
-        
-        # This is for streaming
         streaming_url = f"{self.API_BASE_URL}/text-to-speech/{voice_id}/stream"
-        request_params = {
-            "enable_logging": str(enable_request_logging).lower(),
-            "output_format": audio_format.value
-        }
-        
-        if latency_optimization is not None:
-            request_params["optimize_streaming_latency"] = latency_optimization
-        
-        payload = {
-            "text": text_content,
-            "model_id": model_id,
-            "apply_text_normalization": text_processing.value,
-            "apply_language_text_normalization": language_normalization,
-            "use_pvc_as_ivc": use_legacy_voice_model
-        }
-        
-        if voice_settings:
-            payload["voice_settings"] = voice_settings.to_api_dict()
-        
-        if language_code:
-            payload["language_code"] = language_code
-        
-        if pronunciation_dictionaries:
-            payload["pronunciation_dictionary_locators"] = [
-                {
-                    "pronunciation_dictionary_id": dictionary.pronunciation_dictionary_id,
-                    "version_id": dictionary.version_id
-                }
-                for dictionary in pronunciation_dictionaries
-            ]
-        
-        if generation_seed is not None:
-            payload["seed"] = generation_seed
-        
-        if previous_text:
-            payload["previous_text"] = previous_text
-        
-        if next_text:
-            payload["next_text"] = next_text
-        
-        if previous_request_ids:
-            payload["previous_request_ids"] = previous_request_ids
-        
-        if next_request_ids:
-            payload["next_request_ids"] = next_request_ids
-        
-        response = self.session.post(
-            streaming_url,
-            params=request_params,
-            json=payload,
-            stream=True
+        request_params, payload = self._build_request(
+            text_content, model_id, voice_settings, language_code, pronunciation_dictionaries,
+            generation_seed, previous_text, next_text, previous_request_ids, next_request_ids,
+            text_processing, language_normalization, use_legacy_voice_model, enable_request_logging,
+            latency_optimization, audio_format
         )
         
-        if response.status_code != 200:
-            error_message = response.text
-            try:
-                error_data = response.json()
-                error_message = error_data.get("detail", error_message)
-            except:
-                pass
-            raise requests.RequestException(
-                f"ElevenLabs streaming API error {response.status_code}: {error_message}"
-            )
+        cache_writer = None
+        if self.cache and use_cache:
+            cache_key = self._cache_key(voice_id, request_params, payload)
+            cached_path = self.cache.lookup(cache_key, audio_format.value)
+            if cached_path:
+                return CachedAudioStream(cached_path, chunk_size)
+            cache_writer = self.cache.writer(audio_format.value, cache_key)
         
-        return response.iter_content(chunk_size=1024)
+        for attempt in range(TTS_MAX_RETRIES + 1):
+            provider_slots.acquire()
+            try:
+                response = self.session.post(
+                    streaming_url,
+                    params=request_params,
+                    json=payload,
+                    stream=True,
+                    timeout=TTS_REQUEST_TIMEOUT
+                )
+            except Exception:
+                provider_slots.release()
+                if cache_writer:
+                    cache_writer.abort()
+                raise
+            if response.status_code == 200:
+                return AudioStream(response, chunk_size, cache_writer, holds_provider_slot=True)
+            provider_slots.release()
+            if response.status_code not in RETRY_STATUSES or attempt == TTS_MAX_RETRIES:
+                break
+            response.close()
+            time.sleep(retry_delay(response.headers, attempt))
+        
+        if cache_writer:
+            cache_writer.abort()
+        raise provider_error(response, "ElevenLabs streaming API")
     
     def save_audio_to_file(self, audio_data: bytes, file_path: str) -> str:
         """
@@ -390,12 +647,184 @@ class SpeechSynthesizer:
         Returns:
             str: The file path where audio was saved
         """
-        with open(file_path, 'wb') as audio_file:
+        with open(file_path, 'wb', buffering=TTS_STREAM_CHUNK_BYTES) as audio_file:
             for audio_chunk in audio_stream:
                 audio_file.write(audio_chunk)
         return file_path
 
 
+class AsyncSpeechSynthesizer(SpeechSynthesizer):
+    """SpeechSynthesizer with asyncio methods on a pooled httpx client, for synthesizing many clips at once.
+
+    Requests share provider_slots with the sync methods, so together they never go over
+    TTS_MAX_CONCURRENCY, and requests turned away with 429/503 are retried after Retry-After.
+    The httpx client belongs to the event loop it is first used on.
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, cache: Optional[TTSCache] = None, use_cache: bool = True,
+                 metadata: Optional[MetadataCache] = None):
+        super().__init__(api_key, cache, use_cache, metadata)
+        self._client = None
+    
+    def _async_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.API_BASE_URL,
+                headers={"xi-api-key": self.api_key, "Content-Type": "application/json"},
+                limits=httpx.Limits(max_connections=TTS_MAX_CONCURRENCY,
+                                    max_keepalive_connections=TTS_MAX_CONCURRENCY),
+                timeout=TTS_REQUEST_TIMEOUT
+            )
+        return self._client
+    
+    async def synthesize_speech_async(self, text_content: str, voice_id: str, **options) -> bytes:
+        """
+        Same as synthesize_speech (takes the same arguments), but awaitable
+        
+        Returns:
+            bytes: Generated audio data
+        """
+        request_params, payload = self._build_request(text_content, **options)
+        cache_key = None
+        if self.cache:
+            cache_key = self._cache_key(voice_id, request_params, payload)
+            # Disk I/O runs in a thread so it doesn't hold up the other requests on the loop
+            cached_audio = await asyncio.to_thread(self.cache.get, cache_key, request_params["output_format"])
+            if cached_audio is not None:
+                return cached_audio
+        
+        response = await self._request_async("POST", f"/text-to-speech/{voice_id}", params=request_params, json=payload)
+        if response.status_code != 200:
+            raise provider_error(response)
+        if cache_key:
+            await asyncio.to_thread(self.cache.put, cache_key, response.content, request_params["output_format"])
+        return response.content
+    
+    async def _request_async(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """An ElevenLabs request within provider_slots, retried after Retry-After when turned away"""
+        client = self._async_client()
+        for attempt in range(TTS_MAX_RETRIES + 1):
+            await provider_slots.acquire_async()
+            try:
+                response = await client.request(method, path, **kwargs)
+            finally:
+                provider_slots.release()
+            if response.status_code not in RETRY_STATUSES or attempt == TTS_MAX_RETRIES:
+                return response
+            await asyncio.sleep(retry_delay(response.headers, attempt))
+    
+    async def synthesize_many(self, speech_requests: List[Dict], return_exceptions: bool = True) -> List:
+        """
+        Synthesize several clips at once
+        
+        Args:
+            speech_requests: synthesize_speech arguments for each clip, e.g. {"text_content": ..., "voice_id": ...}
+            return_exceptions: Return a failed clip's exception in its place instead of raising it
+        
+        Returns:
+            List: audio bytes (or the exception) for each request, in the same order
+        """
+        return await asyncio.gather(
+            *(self.synthesize_speech_async(**speech_request) for speech_request in speech_requests),
+            return_exceptions=return_exceptions
+        )
+    
+    async def warm_voice_details(self, voice_ids: Optional[List[str]] = None, refresh: bool = False) -> int:
+        """
+        Fetch the details of many voices at once into the metadata cache
+        
+        Args:
+            voice_ids: Voices to fetch (all of the account's voices by default)
+            refresh: Fetch voices whose cached details are still fresh as well
+        
+        Returns:
+            int: Number of voices fetched
+        """
+        if voice_ids is None:
+            voices = await asyncio.to_thread(self.get_available_voices)
+            voice_ids = [voice["voice_id"] for voice in voices]
+        # fresh() may read the metadata file, so it runs in a thread too
+        missing = await asyncio.to_thread(lambda: [
+            voice_id for voice_id in voice_ids
+            if refresh or not self.metadata.fresh(self._metadata_key(f"voice:{voice_id}"))])
+        
+        async def fetch(voice_id):
+            # Through provider_slots like synthesis, so warming voices can't crowd out participants' audio
+            response = await self._request_async("GET", f"/voices/{voice_id}")
+            if response.status_code != 200:
+                raise provider_error(response, "ElevenLabs voices API")
+            return response.json()
+        
+        results = await asyncio.gather(*(fetch(voice_id) for voice_id in missing), return_exceptions=True)
+        details = {}
+        for voice_id, result in zip(missing, results):
+            if isinstance(result, Exception):
+                print(f"Could not fetch details of voice {voice_id}: {result}")
+            else:
+                details[self._metadata_key(f"voice:{voice_id}")] = result
+        # One save of the metadata file for all of them
+        await asyncio.to_thread(self.metadata.put_many, details)
+        return len(details)
+    
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Each worker has one synthesizer per API key, so connections are reused between calls, and an event
+# loop thread for its async requests, so they can be used from Flask's synchronous request handlers.
+_shared_synthesizers = {}
+_tts_loop = None
+_tts_loop_pid = None
+_shared_lock = threading.Lock()
+
+
+def shared_synthesizer(api_key: Optional[str] = None) -> AsyncSpeechSynthesizer:
+    """This worker's synthesizer for api_key (ELEVENLABS_API_KEY by default)"""
+    api_key = api_key or os.getenv("ELEVENLABS_API_KEY")
+    key = (os.getpid(), api_key)
+    with _shared_lock:
+        synthesizer = _shared_synthesizers.get(key)
+        if synthesizer is None:
+            synthesizer = AsyncSpeechSynthesizer(api_key)
+            _shared_synthesizers[key] = synthesizer
+        return synthesizer
+
+
+def run_async(coroutine, timeout: Optional[float] = None):
+    """Run a coroutine on the worker's TTS event loop and wait for its result"""
+    global _tts_loop, _tts_loop_pid
+    with _shared_lock:
+        if _tts_loop is None or _tts_loop_pid != os.getpid():
+            _tts_loop = asyncio.new_event_loop()
+            _tts_loop_pid = os.getpid()
+            threading.Thread(target=_tts_loop.run_forever, name="tts-loop", daemon=True).start()
+        loop = _tts_loop
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result(timeout)
+
+
+def synthesize_many(speech_requests: List[Dict], api_key: Optional[str] = None, timeout: Optional[float] = None) -> List:
+    """
+    Synthesize several clips at once from synchronous code, on the worker's shared synthesizer
+    
+    Args:
+        speech_requests: synthesize_speech arguments for each clip
+        api_key: API key (optional if ELEVENLABS_API_KEY is set in .env)
+        timeout: Seconds to wait for the whole batch
+    
+    Returns:
+        List: audio bytes (or the exception) for each request, in the same order
+    """
+    return run_async(shared_synthesizer(api_key).synthesize_many(speech_requests), timeout)
+
+
+def warm_voice_details(voice_ids: Optional[List[str]] = None, api_key: Optional[str] = None,
+                       timeout: Optional[float] = None) -> int:
+    """Fetch voice details into the metadata cache from synchronous code (see AsyncSpeechSynthesizer.warm_voice_details)"""
+    return run_async(shared_synthesizer(api_key).warm_voice_details(voice_ids), timeout)
+
+
 # Extra stuff
 def create_voice_settings(
     stability: float = 0.5,
@@ -449,7 +878,8 @@ def quick_text_to_speech(
     Returns:
         bytes if no output_file specified, str (file path) if saved to file
     """
-    synthesizer = SpeechSynthesizer(api_key)
+    # The shared synthesizer keeps its connection to ElevenLabs open between calls
+    synthesizer = shared_synthesizer(api_key)
     voice_config = VoiceSettings(
         stability=stability,
         similarity_boost=similarity_boost,
@@ -507,11 +937,17 @@ if __name__ == "__main__":
                 audio_format=AudioFormat.MP3_PROFESSIONAL_128
             )
             
-            # Saving audio file here
-            # Need to create a temporary storage setup for audio files. Server will get WAY too big otherwise.
-            output_filename = "demo_speech.mp3"
-            synthesizer.save_audio_to_file(audio_data, output_filename)
-            print(f"Audio saved to: {output_filename}")
+            # The clip is already in the TTS cache, which keeps disk use within its limits (tts_cache.py)
+            cache_key = synthesizer.cache_key(sample_text, chosen_voice, model_id="eleven_multilingual_v2",
+                                              voice_settings=custom_settings,
+                                              audio_format=AudioFormat.MP3_PROFESSIONAL_128)
+            cached_path = synthesizer.cache.lookup(cache_key, AudioFormat.MP3_PROFESSIONAL_128.value) if synthesizer.cache else None
+            if cached_path:
+                print(f"Audio stored at: {cached_path}")
+            else:
+                output_filename = "demo_speech.mp3"
+                synthesizer.save_audio_to_file(audio_data, output_filename)
+                print(f"Audio saved to: {output_filename}")
         
     except ValueError as config_error:
         print(f"Configuration error: {config_error}")
@@ -2,10 +2,13 @@
 
 import os
 import json
+import time
 import warnings
 import litellm
 from litellm import completion
 
+from metrics import llm_metrics
+
 # Validate critical environment variables
 required_keys = ['FLASK_SECRET_KEY']
 missing_keys = [key for key in required_keys if not os.getenv(key)]
@@ -419,6 +422,116 @@ def get_provider_category(provider_name):
     }
     return categories.get(provider_name, "Other")
 
+def provider_for_model(model):
+    """Work out the provider name for a model string (used to label metrics)"""
+    try:
+        return litellm.get_llm_provider(model)[1]
+    except Exception:
+        pass
+    if "/" in model:
+        return model.split("/", 1)[0]
+    if "gpt" in model or model.startswith(("o1", "o3", "o4")):
+        return "openai"
+    if "claude" in model:
+        return "anthropic"
+    if model.startswith("command"):
+        return "cohere"
+    return model.split("-", 1)[0]
+
+# Optional price overrides in data/model_prices.json, e.g.
+# {"gpt-4o": {"input_per_million": 2.5, "output_per_million": 10}}
+# Anything not listed falls back to LiteLLM's built-in price table.
+MODEL_PRICES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'model_prices.json')
+_model_price_overrides = None
+
+def _load_model_price_overrides():
+    global _model_price_overrides
+    if _model_price_overrides is None:
+        try:
+            with open(MODEL_PRICES_PATH, 'r') as f:
+                _model_price_overrides = json.load(f)
+        except FileNotFoundError:
+            _model_price_overrides = {}
+        except Exception as e:
+            print(f"Warning: Could not load model prices from {MODEL_PRICES_PATH}: {e}")
+            _model_price_overrides = {}
+    return _model_price_overrides
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimated USD cost for a call, or None if the model has no known price"""
+    override = _load_model_price_overrides().get(model)
+    if override:
+        return (prompt_tokens * override.get("input_per_million", 0) +
+                completion_tokens * override.get("output_per_million", 0)) / 1_000_000
+    prices = litellm.model_cost.get(model) or litellm.model_cost.get(model.split("/", 1)[-1])
+    if not prices:
+        return None
+    return (prompt_tokens * (prices.get("input_cost_per_token") or 0) +
+            completion_tokens * (prices.get("output_cost_per_token") or 0))
+
+def completion_params(model, messages, temperature=1, top_p=1, presence_penalty=0, frequency_penalty=0,
+                      max_tokens=300, logprobs=True):
+    """Request parameters for LiteLLM, keeping only the settings each provider supports"""
+    params = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens
+    }
+    
+    if "gpt" in model or "o1" in model:
+        # OpenAI stuff
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+        params["presence_penalty"] = presence_penalty
+        params["frequency_penalty"] = frequency_penalty
+        if logprobs and "o1" not in model:
+            params["logprobs"] = True
+    elif "claude" in model:
+        # Anthropic models don't support presence/frequency penalties
+        # Anthropic API only allows temperature OR top_p, not both
+        # Use temperature as the primary parameter (more intuitive)
+        params["temperature"] = temperature
+    elif "grok" in model:
+        # XAI models - some support penalties, others don't
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+        if "grok-4" not in model:
+            # Most Grok models support penalties except grok-4
+            params["presence_penalty"] = presence_penalty
+            params["frequency_penalty"] = frequency_penalty
+        # grok-4 currently only supports basic parameters
+    elif any(provider in model for provider in ["groq", "perplexity", "mistral", "cohere"]):
+        # These providers generally support temperature and top_p
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+    elif any(provider in model for provider in ["together", "replicate", "fireworks", "cerebras"]):
+        # These providers generally support temperature and top_p
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+    elif "gemini" in model:
+        # Google Gemini models
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+    elif "deepseek" in model:
+        # DeepSeek models
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+    elif "ollama" in model:
+        # Ollama local models
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+    elif any(provider in model for provider in ["azure", "bedrock"]):
+        if "azure" in model:
+            params["temperature"] = temperature
+            params["top_p"] = top_p
+            params["presence_penalty"] = presence_penalty
+            params["frequency_penalty"] = frequency_penalty
+    else:
+        # Default: include temperature and top_p for other models
+        params["temperature"] = temperature
+        params["top_p"] = top_p
+    return params
+
 def litellm_api_request(model="gpt-4.1",
                        messages=None,
                        temperature=1,
@@ -426,70 +539,16 @@ def litellm_api_request(model="gpt-4.1",
                        presence_penalty=0,
                        frequency_penalty=0,
                        max_tokens=300,
-                       logprobs=True):
+                       logprobs=True,
+                       agent=None):
     
     if messages is None:
         messages = []
     
+    started = time.perf_counter()
     try:
-        params = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_tokens
-        }
-        
-        if "gpt" in model or "o1" in model:
-            # OpenAI stuff
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-            params["presence_penalty"] = presence_penalty
-            params["frequency_penalty"] = frequency_penalty
-            if logprobs and "o1" not in model:
-                params["logprobs"] = True
-        elif "claude" in model:
-            # Anthropic models don't support presence/frequency penalties
-            # Anthropic API only allows temperature OR top_p, not both
-            # Use temperature as the primary parameter (more intuitive)
-            params["temperature"] = temperature
-        elif "grok" in model:
-            # XAI models - some support penalties, others don't
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-            if "grok-4" not in model:
-                # Most Grok models support penalties except grok-4
-                params["presence_penalty"] = presence_penalty
-                params["frequency_penalty"] = frequency_penalty
-            # grok-4 currently only supports basic parameters
-        elif any(provider in model for provider in ["groq", "perplexity", "mistral", "cohere"]):
-            # These providers generally support temperature and top_p
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-        elif any(provider in model for provider in ["together", "replicate", "fireworks", "cerebras"]):
-            # These providers generally support temperature and top_p
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-        elif "gemini" in model:
-            # Google Gemini models
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-        elif "deepseek" in model:
-            # DeepSeek models
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-        elif "ollama" in model:
-            # Ollama local models
-            params["temperature"] = temperature
-            params["top_p"] = top_p
-        elif any(provider in model for provider in ["azure", "bedrock"]):
-            if "azure" in model:
-                params["temperature"] = temperature
-                params["top_p"] = top_p
-                params["presence_penalty"] = presence_penalty
-                params["frequency_penalty"] = frequency_penalty
-        else:
-            # Default: include temperature and top_p for other models
-            params["temperature"] = temperature
-            params["top_p"] = top_p
+        params = completion_params(model, messages, temperature, top_p, presence_penalty,
+                                   frequency_penalty, max_tokens, logprobs)
         
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", UserWarning)
@@ -533,6 +592,12 @@ def litellm_api_request(model="gpt-4.1",
         except (AttributeError, IndexError):
             response_content = "Error: Could not extract response content"
         
+        llm_metrics.record_call(agent, provider_for_model(model), model,
+                                (time.perf_counter() - started) * 1000,
+                                prompt_tokens=prompt_tokens,
+                                completion_tokens=completion_tokens,
+                                cost_usd=estimate_cost(model, prompt_tokens, completion_tokens))
+        
         # Package the response in a standard format
         formatted_response = {
             "choices": [{
@@ -553,6 +618,9 @@ def litellm_api_request(model="gpt-4.1",
     except Exception as e:
         error_msg = str(e)
         print(f"Error with model {model}: {error_msg}")
+        llm_metrics.record_call(agent, provider_for_model(model), model,
+                                (time.perf_counter() - started) * 1000,
+                                error=type(e).__name__)
         
         # error response
         error_response = {
@@ -566,6 +634,86 @@ def litellm_api_request(model="gpt-4.1",
         }
         return error_response, 0, 0, 0, [], model
 
+class StreamedReply:
+    """A reply streamed from the provider. Iterating it yields the text as it arrives.
+
+    Once the iteration is done, the attributes hold what thinkAbout returns, plus the time to
+    the first token (ttft_ms) and the whole call (latency_ms). truncated is set when the provider
+    failed after part of the reply had arrived, text is then only that part.
+    """
+
+    def __init__(self, params, conversation, agent=None):
+        self.params = params
+        self.conversation = conversation
+        self.agent = agent
+        self.model = params["model"]
+        self.text = ""
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.logprobs_list = []
+        self.ttft_ms = None
+        self.latency_ms = None
+        self.error = None
+        self.truncated = False
+
+    def __iter__(self):
+        started = time.perf_counter()
+        parts = []
+        usage = None
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                warnings.simplefilter("ignore", DeprecationWarning)
+                chunks = completion(**self.params, stream=True, stream_options={"include_usage": True})
+                for chunk in chunks:
+                    usage = getattr(chunk, 'usage', None) or usage
+                    choices = getattr(chunk, 'choices', None)
+                    if not choices:
+                        continue
+                    choice = choices[0]
+                    logprobs = getattr(choice, 'logprobs', None)
+                    if logprobs and getattr(logprobs, 'content', None):
+                        self.logprobs_list.extend(getattr(content, 'logprob', 0) for content in logprobs.content
+                                                  if hasattr(content, 'logprob'))
+                    delta = getattr(getattr(choice, 'delta', None), 'content', None)
+                    if not delta:
+                        continue
+                    if self.ttft_ms is None:
+                        self.ttft_ms = (time.perf_counter() - started) * 1000
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            print(f"Error with model {self.model}: {e}")
+            self.error = type(e).__name__
+            self.truncated = bool(parts)
+            message = f"Error: {e}"
+            if not parts:
+                # Same as litellm_api_request: the participant sees the error as the reply
+                parts.append(message)
+                yield message
+
+        self.latency_ms = (time.perf_counter() - started) * 1000
+        self.text = "".join(parts)
+        if not self.error:
+            if usage:
+                self.prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+                self.completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+            else:
+                # Not every provider reports usage on streams
+                try:
+                    self.prompt_tokens = litellm.token_counter(model=self.model, messages=self.params["messages"])
+                    self.completion_tokens = litellm.token_counter(model=self.model, text=self.text)
+                except Exception:
+                    pass
+            self.total_tokens = self.prompt_tokens + self.completion_tokens
+        llm_metrics.record_call(self.agent, provider_for_model(self.model), self.model, self.latency_ms,
+                                prompt_tokens=self.prompt_tokens,
+                                completion_tokens=self.completion_tokens,
+                                cost_usd=estimate_cost(self.model, self.prompt_tokens, self.completion_tokens),
+                                ttft_ms=self.ttft_ms, error=self.error)
+        self.conversation.append({"role": "assistant", "content": self.text})
+
 class API_Call():
     def __init__(self, agent=None):
         # Set up connections to AI providers
@@ -659,11 +807,12 @@ class API_Call():
         
     def update_agent(self, filename):
         self.agent_data = load_agent(filename)
+
+    def set_agent_data(self, agent_data):
+        """Use an agent config that has already been loaded (e.g. from chatPsych's agent cache)"""
+        self.agent_data = agent_data
    
-    def thinkAbout(self, message, conversation, model=None, debug=False):
-        if model is None:
-            model = self.agent_data.get("model", "gpt-4.1")
-        
+    def _working_conversation(self, message, conversation):
         # Make a copy of the conversation to avoid changing the original
         working_conversation = conversation.copy()
         
@@ -675,6 +824,13 @@ class API_Call():
         # Add the user's new message
         formatted_message = {"role": "user", "content": message}
         working_conversation.append(formatted_message)
+        return working_conversation
+
+    def thinkAbout(self, message, conversation, model=None, debug=False):
+        if model is None:
+            model = self.agent_data.get("model", "gpt-4.1")
+        
+        working_conversation = self._working_conversation(message, conversation)
 
         try:
             # Hide technical warnings during AI conversation. Use for debuggin if nneeded.
@@ -687,7 +843,8 @@ class API_Call():
                     frequency_penalty=self.agent_data.get("frequency_penalty", 0),
                     presence_penalty=self.agent_data.get("presence_penalty", 0),
                     top_p=self.agent_data.get("top_p", 1),
-                    max_tokens=self.agent_data.get("max_completion_tokens", 300)
+                    max_tokens=self.agent_data.get("max_completion_tokens", 300),
+                    agent=self.agent_data.get("filename")
                 )
         except Exception as e:
             # If something goes wrong, return an error message
@@ -717,4 +874,19 @@ class API_Call():
         if not logprobs_list and debug:
             print("Logprobs are empty. Response:", response)
 
-        return conversation, prompt_tokens, completion_tokens, total_tokens, logprobs_list, actual_model
\ No newline at end of file
+        return conversation, prompt_tokens, completion_tokens, total_tokens, logprobs_list, actual_model
+
+    def thinkAbout_stream(self, message, conversation, model=None):
+        """Like thinkAbout, but returns a StreamedReply that yields the reply text as it is generated"""
+        if model is None:
+            model = self.agent_data.get("model", "gpt-4.1")
+        params = completion_params(
+            model,
+            self._working_conversation(message, conversation),
+            temperature=self.agent_data.get("temperature", 1),
+            top_p=self.agent_data.get("top_p", 1),
+            presence_penalty=self.agent_data.get("presence_penalty", 0),
+            frequency_penalty=self.agent_data.get("frequency_penalty", 0),
+            max_tokens=self.agent_data.get("max_completion_tokens", 300)
+        )
+        return StreamedReply(params, conversation, agent=self.agent_data.get("filename"))
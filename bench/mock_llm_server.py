@@ -0,0 +1,212 @@
+# Local OpenAI-compatible mock provider for benchmarking chatPsych.
+# It answers POST /v1/chat/completions with a canned reply after a configurable delay, so load
+# tests measure chatPsych and not a real provider. Point the app at it with
+# OPENAI_API_BASE=http://127.0.0.1:<port>/v1 (run_bench.py does this for you).
+#
+# Run on its own:
+#   python bench/mock_llm_server.py --port 8765 --latency-ms 300 --tokens-per-second 60 --error-rate 0.02
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ('the participant asked a thoughtful question and this is a plausible sounding answer '
+         'that keeps going for a while so the response has a realistic length').split()
+
+
+class MockConfig:
+    def __init__(self, latency_ms=300, jitter_ms=50, tokens_per_second=60, completion_tokens=80,
+                 error_rate=0.0, error_status=429):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.streamed = 0
+
+    def as_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'injected_errors': self.errors, 'streamed': self.streamed}
+
+
+def _count_prompt_tokens(messages):
+    # Rough word count is good enough for a mock
+    return sum(len(str(message.get('content', '')).split()) for message in messages)
+
+
+def _tokens(count):
+    return [WORDS[i % len(WORDS)] + ' ' for i in range(count)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'gpt-4o', 'object': 'model'}]})
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        config = self.server.mock_config
+        stats = self.server.mock_stats
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'Invalid JSON'}})
+            return
+
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+
+        with stats.lock:
+            stats.requests += 1
+
+        # Time before the first token
+        delay_ms = max(0, config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms))
+        time.sleep(delay_ms / 1000)
+
+        if config.error_rate and random.random() < config.error_rate:
+            with stats.lock:
+                stats.errors += 1
+            headers = {'Retry-After': '1'} if config.error_status == 429 else None
+            self._send_json(config.error_status, {'error': {'message': 'Injected mock error', 'type': 'mock_error'}}, headers)
+            return
+
+        completion_tokens = min(config.completion_tokens, body.get('max_tokens') or config.completion_tokens)
+        tokens = _tokens(completion_tokens)
+        prompt_tokens = _count_prompt_tokens(body.get('messages', []))
+        token_delay = 1 / config.tokens_per_second if config.tokens_per_second else 0
+        model = body.get('model', 'gpt-4o')
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:12]}'
+
+        if body.get('stream'):
+            with stats.lock:
+                stats.streamed += 1
+            self._stream(completion_id, model, tokens, token_delay, prompt_tokens)
+            return
+
+        time.sleep(token_delay * len(tokens))
+        logprobs = None
+        if body.get('logprobs'):
+            logprobs = {'content': [{'token': token, 'logprob': -random.random(), 'bytes': None, 'top_logprobs': []}
+                                    for token in tokens]}
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': ''.join(tokens).strip()},
+                'logprobs': logprobs,
+                'finish_reason': 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': len(tokens),
+                'total_tokens': prompt_tokens + len(tokens)
+            }
+        })
+
+    def _stream(self, completion_id, model, tokens, token_delay, prompt_tokens):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def send_event(data):
+            self.wfile.write(f'data: {data}\n\n'.encode())
+            self.wfile.flush()
+
+        for token in tokens:
+            send_event(json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]
+            }))
+            time.sleep(token_delay)
+        send_event(json.dumps({
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens),
+                      'total_tokens': prompt_tokens + len(tokens)}
+        }))
+        send_event('[DONE]')
+
+
+def start_mock_server(host='127.0.0.1', port=0, config=None):
+    """Start the mock provider in a background thread and return the server (server.server_port has the port)"""
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.mock_config = config or MockConfig()
+    server.mock_stats = MockStats()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def add_mock_arguments(parser):
+    """Mock provider options shared with run_bench.py"""
+    parser.add_argument('--latency-ms', type=float, default=300, help='Delay before the first token')
+    parser.add_argument('--jitter-ms', type=float, default=50, help='Random +/- jitter added to the latency')
+    parser.add_argument('--tokens-per-second', type=float, default=60, help='Generation speed after the first token (0 = instant)')
+    parser.add_argument('--completion-tokens', type=int, default=80, help='Tokens in each reply')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls that fail (0-1)')
+    parser.add_argument('--error-status', type=int, default=429, help='HTTP status for injected errors')
+
+
+def config_from_args(args):
+    return MockConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      tokens_per_second=args.tokens_per_second, completion_tokens=args.completion_tokens,
+                      error_rate=args.error_rate, error_status=args.error_status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenAI-compatible mock provider for chatPsych benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(args.host, args.port, config_from_args(args))
+    print(f"Mock provider listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
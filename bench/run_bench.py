@@ -0,0 +1,416 @@
+# Load test / benchmark for chatPsych.
+# Starts a copy of the app in a temporary directory, pointed at the local mock LLM provider,
+# then runs simulated participants through the full study:
+#   login -> pre-survey -> N chat turns -> post-chat popup -> post-survey
+# Reports throughput, p50/p95/p99 per route and how much the data files and users.db grew.
+# Results are saved as JSON so later runs can be compared against a baseline.
+#
+#   python bench/run_bench.py --participants 40 --concurrency 8 --turns 5
+#   python bench/run_bench.py --baseline bench/results/<earlier run>.json
+#
+# See bench/README.md for all options.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from mock_llm_server import add_mock_arguments, config_from_args, start_mock_server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# What gets copied into the temporary app directory, along with every top-level .py module
+APP_FOLDERS = ('templates', 'static', 'agents')
+
+PARTICIPANT_PASSWORD = 'onesentencedefault'
+RESEARCHER_USERNAME = 'bench'
+RESEARCHER_PASSWORD = 'bench'
+
+PRE_SURVEY_FORM = {
+    'age': '34', 'gender': 'prefer_not_to_say',
+    'trust_1': '4', 'useful_1': '5', 'use_1': '3', 'understand_1': '4', 'recommend_1': '4',
+    'expectation': 'I expect a short conversation about everyday topics.'
+}
+POST_SURVEY_FORM = {
+    'helpful_post': '4', 'trust_post': '3',
+    'comments_post': 'The conversation was fine.'
+}
+CHAT_MESSAGES = (
+    'Hello, how are you today?',
+    'Can you tell me something interesting about memory?',
+    'Why do people forget things they have just read?',
+    'What is a good way to remember names?',
+    'Thanks, can you summarise what we talked about?'
+)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    """Collects (route, status, milliseconds) samples from all participant threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def timed(self, route, call, ok_statuses=(200, 302)):
+        started = time.perf_counter()
+        status = None
+        try:
+            response = call()
+            status = response.status_code
+            return response
+        except requests.RequestException:
+            return None
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.samples.append((route, status, elapsed_ms, status in ok_statuses))
+
+    def route_report(self, elapsed_seconds):
+        routes = {}
+        for route, status, elapsed_ms, ok in self.samples:
+            routes.setdefault(route, []).append((elapsed_ms, ok, status))
+        report = {}
+        for route, samples in sorted(routes.items()):
+            latencies = sorted(sample[0] for sample in samples)
+            statuses = {}
+            for _, _, status in samples:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            report[route] = {
+                'requests': len(samples),
+                'errors': sum(1 for sample in samples if not sample[1]),
+                'statuses': statuses,
+                'throughput_rps': round(len(samples) / elapsed_seconds, 3) if elapsed_seconds else None,
+                'mean_ms': round(sum(latencies) / len(latencies), 2),
+                'p50_ms': round(percentile(latencies, 0.50), 2),
+                'p95_ms': round(percentile(latencies, 0.95), 2),
+                'p99_ms': round(percentile(latencies, 0.99), 2),
+                'max_ms': round(latencies[-1], 2)
+            }
+        return report
+
+
+def prepare_app_dir(keep_dir=None):
+    """Copy the app into a fresh directory so the benchmark never touches real study data"""
+    app_dir = keep_dir or tempfile.mkdtemp(prefix='chatpsych-bench-')
+    os.makedirs(app_dir, exist_ok=True)
+    for name in os.listdir(REPO_DIR):
+        if name.endswith('.py'):
+            shutil.copy2(os.path.join(REPO_DIR, name), app_dir)
+    for folder in APP_FOLDERS:
+        target = os.path.join(app_dir, folder)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.copytree(os.path.join(REPO_DIR, folder), target,
+                        ignore=shutil.ignore_patterns('__pycache__', 'uploads'))
+    os.makedirs(os.path.join(app_dir, 'data'), exist_ok=True)
+    shutil.copy2(os.path.join(BENCH_DIR, 'fixtures', 'survey_config.json'),
+                 os.path.join(app_dir, 'data', 'survey_config.json'))
+    return app_dir
+
+
+def start_app(app_dir, port, mock_url, workers, extra_env=None):
+    env = dict(os.environ)
+    env.update({
+        'FLASK_SECRET_KEY': 'bench-secret',
+        'researcher_username': RESEARCHER_USERNAME,
+        'researcher_password': RESEARCHER_PASSWORD,
+        'OPENAI_API_KEY': 'bench-key',
+        'OPENAI_API_BASE': mock_url,
+        'OPENAI_BASE_URL': mock_url,
+        'PYTHONUNBUFFERED': '1'
+    })
+    env.update(extra_env or {})
+
+    if workers and shutil.which('gunicorn'):
+        command = ['gunicorn', '-w', str(workers), '--threads', '4', '-b', f'127.0.0.1:{port}',
+                   '--timeout', '120', 'chatPsych:app']
+        server = f'gunicorn ({workers} workers)'
+    else:
+        if workers:
+            print("gunicorn not found, using the Flask development server instead")
+        command = [sys.executable, '-c',
+                   f"from chatPsych import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+        server = 'flask (threaded)'
+
+    log = open(os.path.join(app_dir, 'bench_server.log'), 'w')
+    process = subprocess.Popen(command, cwd=app_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup, see {log.name}")
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return process, base_url, server
+        except requests.RequestException:
+            time.sleep(0.25)
+    stop_app(process)
+    raise RuntimeError(f"App did not start within 60 seconds, see {log.name}")
+
+
+def stop_app(process):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def configure_study(base_url):
+    """Log in as the researcher and switch on the post-survey and post-chat popup"""
+    researcher = requests.Session()
+    response = researcher.post(f'{base_url}/researcher', data={
+        'researcher_username': RESEARCHER_USERNAME, 'researcher_password': RESEARCHER_PASSWORD})
+    response.raise_for_status()
+    response = researcher.post(f'{base_url}/update-url-settings', json={
+        'quit_url': 'https://example.com/quit',
+        'redirect_url': 'https://example.com/done',
+        'use_post_survey': True,
+        'post_chat_popup_enabled': True
+    })
+    response.raise_for_status()
+
+
+def run_participant(base_url, recorder, run_id, index, turns, think_time):
+    session = requests.Session()
+    timed = recorder.timed
+    timed('GET /', lambda: session.get(f'{base_url}/'))
+    timed('POST /', lambda: session.post(f'{base_url}/', allow_redirects=False, data={
+        'username': f'bench_{run_id}_{index}', 'password': PARTICIPANT_PASSWORD}))
+    timed('GET /survey', lambda: session.get(f'{base_url}/survey'))
+    timed('POST /survey', lambda: session.post(f'{base_url}/survey', data=PRE_SURVEY_FORM))
+    timed('GET /chat', lambda: session.get(f'{base_url}/chat'))
+    for turn in range(turns):
+        if think_time:
+            time.sleep(think_time)
+        message = CHAT_MESSAGES[turn % len(CHAT_MESSAGES)]
+        timed('POST /chat', lambda: session.post(f'{base_url}/chat', data={'message': message}, timeout=120))
+    timed('POST /log-post-chat-popup', lambda: session.post(f'{base_url}/log-post-chat-popup',
+                                                            json={'button_text': 'useful'}))
+    timed('GET /post-survey', lambda: session.get(f'{base_url}/post-survey'))
+    timed('POST /post-survey', lambda: session.post(f'{base_url}/post-survey', data=POST_SURVEY_FORM))
+
+
+def storage_snapshot(app_dir):
+    """Sizes of everything the app writes, plus row counts from users.db"""
+    files = {}
+    data_dir = os.path.join(app_dir, 'data')
+    for root, _, names in os.walk(data_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, app_dir)] = os.path.getsize(path)
+    db_path = os.path.join(app_dir, 'users.db')
+    rows = {}
+    if os.path.exists(db_path):
+        files['users.db'] = os.path.getsize(db_path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                files['users.db' + suffix] = os.path.getsize(db_path + suffix)
+        conn = sqlite3.connect(db_path)
+        for table in ('users', 'messages'):
+            try:
+                rows[table] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            except sqlite3.Error:
+                rows[table] = None
+        conn.close()
+    return {'files': files, 'rows': rows}
+
+
+def storage_growth(before, after):
+    growth = {}
+    for name in sorted(set(before['files']) | set(after['files'])):
+        delta = after['files'].get(name, 0) - before['files'].get(name, 0)
+        if delta:
+            growth[name] = delta
+    return {
+        'bytes': growth,
+        'total_bytes': sum(growth.values()),
+        'rows': {table: (after['rows'].get(table) or 0) - (before['rows'].get(table) or 0) for table in after['rows']}
+    }
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """Per-route percentile changes against an earlier run. Returns (rows, regressions)."""
+    rows = []
+    regressions = []
+    for route, current in results['routes'].items():
+        previous = baseline.get('routes', {}).get(route)
+        if not previous:
+            continue
+        row = {'route': route}
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = previous.get(key), current.get(key)
+            change = (new - old) / old if old else None
+            row[key] = {'baseline': old, 'current': new, 'change': round(change, 4) if change is not None else None}
+            if change is not None and change > threshold:
+                regressions.append(f"{route} {key}: {old:.1f} -> {new:.1f} ms ({change:+.0%})")
+        rows.append(row)
+    old_rps = baseline.get('summary', {}).get('throughput_rps')
+    new_rps = results['summary']['throughput_rps']
+    if old_rps and new_rps < old_rps * (1 - threshold):
+        regressions.append(f"throughput: {old_rps:.2f} -> {new_rps:.2f} req/s")
+    return rows, regressions
+
+
+def print_report(results):
+    print(f"\nchatPsych benchmark ({results['config']['server']}, commit {results['environment']['git_commit']})")
+    summary = results['summary']
+    print(f"{summary['participants']} participants, {summary['requests']} requests in {summary['elapsed_seconds']:.1f}s "
+          f"-> {summary['throughput_rps']:.2f} req/s, {summary['errors']} errors")
+    print(f"\n{'Route':<28}{'n':>6}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for route, stats in results['routes'].items():
+        print(f"{route:<28}{stats['requests']:>6}{stats['errors']:>5}{stats['p50_ms']:>9.1f}"
+              f"{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}{stats['max_ms']:>9.1f}")
+    growth = results['storage_growth']
+    print(f"\nStorage growth: {growth['total_bytes'] / 1024:.1f} KB, rows {growth['rows']}")
+    for name, delta in growth['bytes'].items():
+        print(f"  {name:<40}{delta / 1024:>10.1f} KB")
+    print(f"Mock provider: {results['mock_provider']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test chatPsych against a mock LLM provider')
+    parser.add_argument('--participants', type=int, default=20, help='Number of simulated participants')
+    parser.add_argument('--concurrency', type=int, default=5, help='Participants running at the same time')
+    parser.add_argument('--turns', type=int, default=5, help='Chat turns per participant')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Seconds each participant waits before a chat turn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers (0 = Flask development server)')
+    parser.add_argument('--app-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment variable for the app, can be repeated')
+    parser.add_argument('--output', help='Where to save the JSON results (default bench/results/<timestamp>.json)')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare against')
+    parser.add_argument('--regression-threshold', type=float, default=0.10,
+                        help='Relative slowdown that counts as a regression (default 0.10 = 10%%)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 if a regression is found')
+    parser.add_argument('--keep-dir', help='Run the app in this directory and keep it afterwards')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = start_mock_server(config=config_from_args(args))
+    mock_url = f'http://127.0.0.1:{mock.server_port}/v1'
+    app_dir = prepare_app_dir(args.keep_dir)
+    extra_env = dict(item.split('=', 1) for item in args.app_env)
+    process, base_url, server = start_app(app_dir, free_port(), mock_url, args.workers, extra_env)
+    run_id = uuid.uuid4().hex[:6]
+
+    try:
+        configure_study(base_url)
+        before = storage_snapshot(app_dir)
+        recorder = Recorder()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(run_participant, base_url, recorder, run_id, i, args.turns, args.think_time)
+                       for i in range(args.participants)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+        after = storage_snapshot(app_dir)
+    finally:
+        stop_app(process)
+        mock.shutdown()
+
+    routes = recorder.route_report(elapsed)
+    total_requests = sum(stats['requests'] for stats in routes.values())
+    results = {
+        'timestamp': datetime.now().isoformat(),
+        'config': {
+            'participants': args.participants,
+            'concurrency': args.concurrency,
+            'turns': args.turns,
+            'think_time': args.think_time,
+            'workers': args.workers,
+            'server': server,
+            'app_env': extra_env,
+            'mock': vars(config_from_args(args))
+        },
+        'environment': {
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'summary': {
+            'participants': args.participants,
+            'requests': total_requests,
+            'errors': sum(stats['errors'] for stats in routes.values()),
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_rps': round(total_requests / elapsed, 3),
+            'journeys_per_minute': round(args.participants / elapsed * 60, 2)
+        },
+        'routes': routes,
+        'storage_growth': storage_growth(before, after),
+        'mock_provider': mock.mock_stats.as_dict()
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results['baseline'] = {'path': args.baseline, 'git_commit': baseline.get('environment', {}).get('git_commit')}
+        results['comparison'], regressions = compare_with_baseline(results, baseline, args.regression_threshold)
+        results['regressions'] = regressions
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print_report(results)
+    if args.baseline:
+        print(f"\nCompared with {args.baseline}:")
+        for row in results['comparison']:
+            changes = '  '.join(f"{key[:-3]} {row[key]['change']:+.0%}" for key in ('p50_ms', 'p95_ms', 'p99_ms')
+                                if row[key]['change'] is not None)
+            print(f"  {row['route']:<28}{changes}")
+        print('Regressions:' if regressions else 'No regressions.')
+        for regression in regressions:
+            print(f"  {regression}")
+    print(f"\nResults saved to {output}")
+
+    if not args.keep_dir:
+        shutil.rmtree(app_dir, ignore_errors=True)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
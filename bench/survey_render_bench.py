@@ -0,0 +1,102 @@
+# Micro-benchmark for survey page rendering.
+# Builds a survey with --sections sections and --items items spread over them (Likert, free text,
+# checkbox, dropdown, slider, image, video and PDF) and times generate_survey_html_content:
+#   cold      every section compiled from scratch (fragment cache cleared before each render)
+#   cached    fragments reused, items in config order
+#   shuffled  fragments reused, items randomized (rows reordered per render)
+#
+#   python bench/survey_render_bench.py --sections 20 --items 200
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import time
+
+from run_bench import prepare_app_dir
+
+SECTION_TYPES = ('likert', 'freetext', 'checkbox', 'dropdown', 'slider', 'image', 'video', 'pdf')
+
+
+def build_survey(section_count, item_count, randomize):
+    """Survey config with item_count items spread over section_count sections"""
+    sections = {}
+    per_section = max(1, item_count // section_count)
+    for index in range(section_count):
+        section_type = SECTION_TYPES[index % len(SECTION_TYPES)]
+        section_id = f'{section_type}-{index}'
+        config = {'enabled': True, 'type': section_type, 'title': f'Section {index}'}
+        if section_type == 'likert':
+            config['items'] = [{'text': f'Statement {index}.{i}', 'column_label': f'l{index}_{i}'} for i in range(per_section)]
+        elif section_type == 'freetext':
+            config['questions'] = [{'question': f'Question {index}.{i}', 'column_label': f'f{index}_{i}'} for i in range(per_section)]
+        elif section_type in ('checkbox', 'dropdown'):
+            config['options'] = [f'Option {i}' for i in range(per_section)]
+        elif section_type == 'slider':
+            config.update({'slider_type': 'numeric', 'min_value': 0, 'max_value': 100})
+        elif section_type in ('image', 'video', 'pdf'):
+            config.update({'require_response': True, 'response_type': 'checkbox',
+                           'checkbox_options': [f'Option {i}' for i in range(per_section)]})
+            if section_type == 'image':
+                config['file_path'] = '/static/uploads/example.png'
+            elif section_type == 'video':
+                config['video_url'] = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+            else:
+                config['file_path'] = '/static/uploads/example.pdf'
+        sections[section_id] = config
+    return {'title': 'Benchmark survey', 'sections': sections, 'settings': {'randomizeItems': randomize}}
+
+
+def time_renders(render, repeat, before_each=None):
+    timings = []
+    for _ in range(repeat):
+        if before_each:
+            before_each()
+        started = time.perf_counter()
+        render()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {'mean_ms': statistics.fmean(timings), 'p50_ms': timings[len(timings) // 2],
+            'p95_ms': timings[int(len(timings) * 0.95) - 1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time survey page rendering')
+    parser.add_argument('--sections', type=int, default=20)
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    # chatPsych creates users.db and data/ where it runs, so import it from a throwaway copy
+    app_dir = prepare_app_dir()
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    os.environ.setdefault('FLASK_SECRET_KEY', 'bench-secret')
+    try:
+        import chatPsych
+        import survey_fragments
+
+        plain = build_survey(args.sections, args.items, randomize=False)
+        shuffled = build_survey(args.sections, args.items, randomize=True)
+        with chatPsych.app.test_request_context():
+            page_size = len(chatPsych.generate_survey_html_content(plain))
+            results = {
+                'cold': time_renders(lambda: chatPsych.generate_survey_html_content(plain), args.repeat,
+                                     before_each=survey_fragments.clear_cache),
+                'cached': time_renders(lambda: chatPsych.generate_survey_html_content(plain), args.repeat),
+                'shuffled': time_renders(lambda: chatPsych.generate_survey_html_content(shuffled), args.repeat),
+            }
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+    print(f"\nSurvey with {args.sections} sections and {args.items} items ({page_size / 1024:.1f} KB page), {args.repeat} renders each")
+    print(f"  {'':<10}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for name, timing in results.items():
+        print(f"  {name:<10}{timing['mean_ms']:>8.3f}ms{timing['p50_ms']:>8.3f}ms{timing['p95_ms']:>8.3f}ms")
+    print(f"  cached is {results['cold']['mean_ms'] / results['cached']['mean_ms']:.1f}x faster than cold")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
 import sqlite3
-from flask import Flask, jsonify, render_template, request, session as flask_session, redirect, url_for, flash, send_from_directory, send_file, abort
+import time
+from flask import Flask, jsonify, render_template, request, session as flask_session, redirect, url_for, flash, send_from_directory, send_file, abort, Response, stream_with_context, copy_current_request_context
 import sys
 import os
 import json
 import random
 from datetime import datetime
 import csv
-import re
+import hashlib
+import base64
+import queue
+import tempfile
+import threading
+import zipfile
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 import geoip2.database
 
@@ -14,6 +21,22 @@ load_dotenv(override=True)
 
 # Gotta import this after the env loading to make sure we don't run into API auth issues
 from API_LLM import API_Call, get_available_models, get_available_providers
+from logprob_codec import pack_logprobs, decode_logprobs, summarize_logprobs
+from metrics import llm_metrics
+import request_tracing
+from request_tracing import trace_phase, init_request_tracing
+from config_watcher import config_watcher
+from static_assets import init_static_assets, asset_url
+from survey_fragments import SurveyFragment, compiled_section
+from survey_model import (sanitize_column_label, compile_survey, survey_model, clean_submission,
+                          SurveySubmissionError, SURVEY_TEXT_MAX_CHARS, SURVEY_MAX_SUBMISSION_BYTES)
+from data_logging import data_log
+import data_writers  # registers the data file writers with data_log
+from API_AUDIO import AudioFormat, warm_voice_details
+from tts_cache import tts_cache
+from speech_pipeline import (SpeechPipeline, agent_synthesizer, agent_voice, audio_mime_type, get_synthesizer,
+                             negotiate_audio_format, speak_text)
+from tts_warmup import warm_up_in_background
 
 def ensure_data_directory():
     """Create data directory if it doesn't exist"""
@@ -23,19 +46,6 @@ def ensure_data_directory():
     return data_dir
 
 
-_COLUMN_LABEL_SANITIZE_RE = re.compile(r"[^A-Za-z0-9_]+")
-
-
-def sanitize_column_label(label, fallback):
-    """Return a safe column label for HTML field names and CSV headers."""
-    candidate = (label or "").strip()
-    if not candidate:
-        candidate = (fallback or "").strip()
-    candidate = candidate.replace(" ", "_")
-    candidate = _COLUMN_LABEL_SANITIZE_RE.sub("_", candidate)
-    candidate = candidate.strip("_")
-    return candidate or "field"
-
 # Visitor logging stuff for IP addresses
 GEOIP_DB_PATH = os.path.join(ensure_data_directory(), 'GeoLite2-City.mmdb')
 
@@ -65,6 +75,8 @@ env_valid = validate_env_variables()
 # Get the Flask app and the API handler going 
 app = Flask(__name__)
 app.secret_key = os.environ['FLASK_SECRET_KEY']
+init_request_tracing(app)
+init_static_assets(app)
 API = API_Call()
 current_model = "gpt-4o" # just for startup
 
@@ -155,6 +167,19 @@ def init_db():
                  message TEXT NOT NULL,
                  response TEXT NOT NULL,
                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 agent TEXT,
+                 model TEXT,
+                 temperature REAL,
+                 prompt_tokens INTEGER,
+                 completion_tokens INTEGER,
+                 total_tokens INTEGER,
+                 latency_ms REAL,
+                 ttft_ms REAL,
+                 logprobs BLOB,
+                 logprob_count INTEGER,
+                 logprob_sum REAL,
+                 logprob_mean REAL,
+                 logprob_min REAL,
                  FOREIGN KEY (user_id) REFERENCES users (id))''')
     c.execute('''CREATE TABLE IF NOT EXISTS passwords 
                  (password TEXT PRIMARY KEY, 
@@ -169,6 +194,111 @@ def init_db():
     conn.commit()
     conn.close()
 
+# Typed usage columns on the messages table. Older databases only had
+# user_id/password/message/response so these get added (and backfilled) on startup.
+MESSAGE_USAGE_COLUMNS = {
+    'agent': 'TEXT',
+    'model': 'TEXT',
+    'temperature': 'REAL',
+    'prompt_tokens': 'INTEGER',
+    'completion_tokens': 'INTEGER',
+    'total_tokens': 'INTEGER',
+    'latency_ms': 'REAL',
+    'ttft_ms': 'REAL',
+    'logprobs': 'BLOB',
+    'logprob_count': 'INTEGER',
+    'logprob_sum': 'REAL',
+    'logprob_mean': 'REAL',
+    'logprob_min': 'REAL'
+}
+
+def migrate_messages_table():
+    """Add the usage/model/latency columns and reporting indexes to the messages table"""
+    conn = sqlite3.connect('users.db')
+    c = conn.cursor()
+
+    c.execute("PRAGMA table_info(messages)")
+    columns = [column[1] for column in c.fetchall()]
+    for column_name, column_type in MESSAGE_USAGE_COLUMNS.items():
+        if column_name not in columns:
+            c.execute(f'ALTER TABLE messages ADD COLUMN {column_name} {column_type}')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_password ON messages (user_id, password, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_agent_model ON messages (agent, model)')
+
+    conn.commit()
+    conn.close()
+
+def backfill_message_usage():
+    """Fill the usage columns for messages written before they existed, using interactions.json.
+
+    Rows are matched on user_id, password, message and response in insertion order. This only
+    runs once per database (tracked in agent_settings) because interactions.json can be large.
+    """
+    conn = sqlite3.connect('users.db')
+    conn.text_factory = str
+    c = conn.cursor()
+
+    c.execute('SELECT setting_value FROM agent_settings WHERE setting_name = ?', ('messages_usage_backfilled',))
+    if c.fetchone():
+        conn.close()
+        return
+
+    c.execute('SELECT id, user_id, password, message, response FROM messages WHERE total_tokens IS NULL ORDER BY id')
+    pending = {}
+    for row_id, user_id, password, message, response in c.fetchall():
+        pending.setdefault((str(user_id), password, message, response), []).append(row_id)
+
+    if pending:
+        interactions_json_path = os.path.join(ensure_data_directory(), 'interactions.json')
+        try:
+            with open(interactions_json_path, 'r') as f:
+                file_content = f.read().strip()
+                interactions = json.loads(file_content) if file_content else {"users": {}}
+        except (FileNotFoundError, json.JSONDecodeError):
+            interactions = {"users": {}}
+
+        updates = []
+        for user_data in interactions.get("users", {}).values():
+            user_id = str(user_data.get('user_id', ''))
+            for interaction in user_data.get("interactions", []):
+                if interaction.get('interaction_type') != 'message':
+                    continue
+                key = (user_id, interaction.get('password'), interaction.get('message'), interaction.get('response'))
+                row_ids = pending.get(key)
+                if not row_ids:
+                    continue
+                try:
+                    logprobs = decode_logprobs(interaction.get('logprobs'))
+                except (ValueError, TypeError):
+                    logprobs = []
+                summary = summarize_logprobs(logprobs)
+                updates.append((
+                    interaction.get('agent_name'),
+                    interaction.get('model'),
+                    interaction.get('temperature'),
+                    interaction.get('prompt_tokens'),
+                    interaction.get('completion_tokens'),
+                    interaction.get('total_tokens'),
+                    pack_logprobs(logprobs),
+                    summary['count'],
+                    summary['sum'],
+                    summary['mean'],
+                    summary['min'],
+                    row_ids.pop(0)
+                ))
+
+        c.executemany('''UPDATE messages SET agent = ?, model = ?, temperature = ?, prompt_tokens = ?,
+                         completion_tokens = ?, total_tokens = ?, logprobs = ?, logprob_count = ?,
+                         logprob_sum = ?, logprob_mean = ?, logprob_min = ? WHERE id = ?''', updates)
+        if updates:
+            print(f"Backfilled usage columns for {len(updates)} messages from interactions.json")
+
+    c.execute('INSERT OR REPLACE INTO agent_settings (setting_name, setting_value) VALUES (?, ?)',
+              ('messages_usage_backfilled', datetime.now().isoformat()))
+    conn.commit()
+    conn.close()
+
 def add_passwords():
     conn = sqlite3.connect('users.db')
     c = conn.cursor()
@@ -289,7 +419,9 @@ def init_default_branding_settings():
     conn.close()
 
 init_db()
+migrate_messages_table()
 add_passwords()
+backfill_message_usage()
 init_default_url_settings()
 init_default_branding_settings()
 
@@ -345,13 +477,7 @@ def get_all_agents_with_status():
     conn.close()
     return agents
 
-# Function to calculate joint log probability in models that can call logprobs
-# This functionality is pretty much deprecated in most closed source models now...
-def calculate_joint_log_probability(logprobs):
-    if not logprobs:
-        return 0
-    return sum(logprobs)
-
+@trace_phase('logging')
 def log_visitor(endpoint_name):
     """This logs app visitor data to visitor_log.json"""
     try:
@@ -385,84 +511,19 @@ def log_visitor(endpoint_name):
         else:
             visitor_data['geo'] = {'error': 'GeoIP database not available'}
         
-        data_dir = ensure_data_directory()
-        visitor_log_path = os.path.join(data_dir, 'visitor_log.json')
-        
-        if os.path.exists(visitor_log_path):
-            with open(visitor_log_path, 'r') as f:
-                logs = json.load(f)
-        else:
-            logs = []
-        
-        logs.append(visitor_data)
-        
-        with open(visitor_log_path, 'w') as f:
-            json.dump(logs, f, indent=2)
+        data_log.submit('visitor', visitor_data)
             
     except Exception as e:
         print(f"Error logging visitor: {e}")
 
 # DATA Logging function for interactions.json and interactions_backup.CSV
+# The session values are captured here, the files are written by write_interactions on the data log thread
+@trace_phase('logging')
 def log_user_data(data):
-    data_dir = ensure_data_directory()
-    interactions_json_path = os.path.join(data_dir, 'interactions.json')
-
-    try:
-        with open(interactions_json_path, 'r') as f:
-            file_content = f.read().strip()
-            interactions = json.loads(file_content) if file_content else {"users": {}}
-    except (FileNotFoundError, json.JSONDecodeError):
-        interactions = {"users": {}}
-
-    username = data['username']
-    if username not in interactions["users"]:
-        interactions["users"][username] = {
-            "user_id": data.get('user_id', ''),
-            "interactions": []
-        }
-
-    interaction_content = {k: v for k, v in data.items() if k not in ['username', 'user_id']}
-    interaction_content['password'] = flask_session.get('password', 'N/A')
-    interaction_content['agent_name'] = flask_session.get('agent', 'N/A')
-
-    if 'logprobs' in data:
-        logprobs = data.get('logprobs', [])
-        interaction_content['relativeSequenceJointLogProbability'] = calculate_joint_log_probability(logprobs)
-        all_logprobs = [lp for interaction in interactions["users"][username]["interactions"] if 'logprobs' in interaction for lp in interaction['logprobs']]
-        all_logprobs.extend(logprobs)
-        interaction_content['relativeInteractionJointLogProbability'] = calculate_joint_log_probability(all_logprobs)
-
-    interactions["users"][username]["interactions"].append(interaction_content)
-
-    with open(interactions_json_path, 'w') as f:
-        json.dump(interactions, f, indent=4)
-
-    csv_headers = [
-        "timestamp", "user_id", "username", "password", "agent_name", "interaction_type", 
-        "message", "response", "model", "temperature", "logprobs"
-    ]
-    interaction_data = [
-        data.get('timestamp', ''),
-        data.get('user_id', ''),
-        data.get('username', ''),
-        flask_session.get('password', 'N/A'),
-        flask_session.get('agent', 'N/A'),
-        data.get('interaction_type', ''),
-        data.get('message', ''),
-        data.get('response', ''),
-        data.get('model', ''),
-        data.get('temperature', ''),
-        data.get('logprobs', [])
-    ]
-
-    csv_file = os.path.join(data_dir, 'interactions_backup.csv')
-    write_headers = not os.path.exists(csv_file)
-
-    with open(csv_file, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        if write_headers:
-            writer.writerow(csv_headers)
-        writer.writerow(interaction_data)
+    record = dict(data)
+    record['password'] = flask_session.get('password', 'N/A')
+    record['agent_name'] = flask_session.get('agent', 'N/A')
+    data_log.submit('interaction', record)
 
 # Adding users Prolific ID for the session management in db
 def add_user(username):
@@ -473,15 +534,23 @@ def add_user(username):
     conn.commit()
     conn.close()
 
-def add_message(user_id, password, message, response, model, temperature, prompt_tokens, completion_tokens, total_tokens, logprobs_list):
-    conn = sqlite3.connect('users.db')
-    conn.text_factory = str
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (user_id, password, message, response) VALUES (?, ?, ?, ?)', 
-              (user_id, password, message, response))
-    conn.commit()
-    conn.close()
-    log_user_data({
+def add_message(user_id, password, message, response, model, temperature, prompt_tokens, completion_tokens, total_tokens, logprobs_list, latency_ms=None, ttft_ms=None, audio=None):
+    summary = summarize_logprobs(logprobs_list)
+    with trace_phase('db'):
+        conn = sqlite3.connect('users.db')
+        conn.text_factory = str
+        c = conn.cursor()
+        c.execute('''INSERT INTO messages (user_id, password, message, response, agent, model, temperature,
+                 prompt_tokens, completion_tokens, total_tokens, latency_ms, ttft_ms, logprobs,
+                     logprob_count, logprob_sum, logprob_mean, logprob_min)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, password, message, response, flask_session.get('agent'), model, temperature,
+                   prompt_tokens, completion_tokens, total_tokens, latency_ms, ttft_ms, pack_logprobs(logprobs_list),
+                   summary['count'], summary['sum'], summary['mean'], summary['min']))
+        message_id = c.lastrowid
+        conn.commit()
+        conn.close()
+    record = {
         'user_id': user_id,
         'username': flask_session.get('username'),
         'interaction_type': 'message',
@@ -493,10 +562,42 @@ def add_message(user_id, password, message, response, model, temperature, prompt
         'completion_tokens': completion_tokens,
         'total_tokens': total_tokens,
         'logprobs': logprobs_list,
+        'latency_ms': latency_ms,
+        'ttft_ms': ttft_ms,
         'timestamp': str(datetime.now())
-    })
+    }
+    if audio:
+        # Which audio format the participant got and why (see negotiate_audio_format)
+        record['audio'] = audio
+    log_user_data(record)
+    return message_id
+
+def get_usage_report():
+    """Token usage and provider latency per agent and model, straight from the messages table"""
+    conn = sqlite3.connect('users.db')
+    c = conn.cursor()
+    c.execute('''SELECT agent, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens),
+                 AVG(latency_ms), MAX(latency_ms), AVG(ttft_ms)
+                 FROM messages
+                 WHERE model IS NOT NULL
+                 GROUP BY agent, model
+                 ORDER BY agent, model''')
+    rows = c.fetchall()
+    conn.close()
+    return [{
+        'agent': agent,
+        'model': model,
+        'messages': count,
+        'prompt_tokens': prompt_tokens or 0,
+        'completion_tokens': completion_tokens or 0,
+        'total_tokens': total_tokens or 0,
+        'avg_latency_ms': avg_latency,
+        'max_latency_ms': max_latency,
+        'avg_ttft_ms': avg_ttft
+    } for agent, model, count, prompt_tokens, completion_tokens, total_tokens, avg_latency, max_latency, avg_ttft in rows]
 
 # Function to create conversation history for API calls
+@trace_phase('db')
 def get_messages(user_id, password):
     conn = sqlite3.connect('users.db')
     conn.text_factory = str
@@ -510,6 +611,41 @@ def get_messages(user_id, password):
     conn.close()
     return conversation
 
+# How many of the latest turns the chat page renders. Older turns are loaded as the participant scrolls up.
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', 20))
+# Events of a streamed reply waiting to be sent to a slow client (/chat/stream)
+CHAT_STREAM_BUFFER_EVENTS = 256
+
+@trace_phase('db')
+def get_message_turns(user_id, password, before_id=None, limit=CHAT_HISTORY_PAGE_SIZE):
+    """One page of chat turns (oldest first) before a message id, plus whether there are older ones.
+
+    Uses keyset pagination on messages.id so every page is an index range scan, however long the transcript.
+    """
+    conn = sqlite3.connect('users.db')
+    conn.text_factory = str
+    c = conn.cursor()
+    if before_id is None:
+        c.execute('''SELECT id, message, response FROM messages WHERE user_id = ? AND password = ?
+                     ORDER BY id DESC LIMIT ?''', (user_id, password, limit + 1))
+    else:
+        c.execute('''SELECT id, message, response FROM messages WHERE user_id = ? AND password = ? AND id < ?
+                     ORDER BY id DESC LIMIT ?''', (user_id, password, before_id, limit + 1))
+    rows = c.fetchall()
+    conn.close()
+    has_more = len(rows) > limit
+    turns = [{'id': row_id, 'message': message, 'response': response} for row_id, message, response in reversed(rows[:limit])]
+    return turns, has_more
+
+@trace_phase('db')
+def count_message_turns(user_id, password):
+    conn = sqlite3.connect('users.db')
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM messages WHERE user_id = ? AND password = ?', (user_id, password))
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
 # MAIN login route for chatPsych
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -547,7 +683,7 @@ def login():
             flask_session['assignment_type'] = 'randomised'
             flask_session['session_start_time'] = datetime.now().isoformat()
             flask_session['message_count'] = 0
-            API.update_agent(f"agents/{selected_agent}.json")
+            API.set_agent_data(get_agent_config(selected_agent))
             flash('', 'success')
             conn.close()
             return redirect(url_for('survey'))
@@ -563,7 +699,7 @@ def login():
                 flask_session['assignment_type'] = 'specific'
                 flask_session['session_start_time'] = datetime.now().isoformat()
                 flask_session['message_count'] = 0
-                API.update_agent(f"agents/{agent[0]}.json")
+                API.set_agent_data(get_agent_config(agent[0]))
                 flash('', 'success')
                 conn.close()
                 return redirect(url_for('survey'))
@@ -589,6 +725,8 @@ def survey():
         return redirect(url_for('chat'))
     
     if request.method == 'POST':
+        if survey_submission_too_large():
+            return jsonify({'error': 'Survey submission is too large'}), 413
         try:
             # This gets survey config to determine section needed for form
             survey_config = load_survey_config()
@@ -612,6 +750,8 @@ def survey():
             
             return jsonify({'success': True, 'redirect_url': url_for('chat')}), 200
             
+        except SurveySubmissionError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             app.logger.error(f"Error processing survey: {e}")
             return jsonify({'error': 'Error processing survey'}), 500
@@ -648,11 +788,15 @@ def post_survey():
         return redirect(external_url)
     
     if request.method == 'POST':
+        if survey_submission_too_large():
+            return jsonify({'error': 'Survey submission is too large'}), 413
         try:
             survey_config = load_survey_config()
             post_survey_config = survey_config.get('post_survey', {}) if survey_config else {}
             
-            survey_data = collect_dynamic_survey_data(request.form, post_survey_config, 'post_')
+            # A disabled post-survey config isn't what the participant saw, the static template was
+            dynamic_config = post_survey_config if post_survey_config.get('enabled', False) else None
+            survey_data = collect_dynamic_survey_data(request.form, dynamic_config, 'post_')
             
             survey_end_timestamp = str(datetime.now())
             survey_data.update({
@@ -673,6 +817,8 @@ def post_survey():
             
             return jsonify({'success': True, 'message': 'Post-survey completed successfully'}), 200
             
+        except SurveySubmissionError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             app.logger.error(f"Error processing post-survey: {e}")
             return jsonify({'error': 'Error processing post-survey'}), 500
@@ -735,184 +881,29 @@ def log_post_survey_start(username, password, user_id):
         app.logger.error(f"Error logging post-survey start: {e}")
 
 # Function to log popup data to dedicated popup files
+@trace_phase('logging')
 def log_popup_data(data):
-    """Log popup selections to dedicated popup JSON and CSV files"""
+    """Queue popup selections for popup.json and popup.csv"""
     try:
-        data_dir = ensure_data_directory()
-        popup_json_path = os.path.join(data_dir, 'popup.json')
-        
-        try:
-            with open(popup_json_path, 'r') as f:
-                file_content = f.read().strip()
-                popup_data = json.loads(file_content) if file_content else {"popup_responses": []}
-        except (FileNotFoundError, json.JSONDecodeError):
-            popup_data = {"popup_responses": []}
-
-        popup_data["popup_responses"].append(data)
-
-        with open(popup_json_path, 'w') as f:
-            json.dump(popup_data, f, indent=4)
-
-        csv_headers = [
-            "timestamp", "username", "password", "agent_name", "user_id", 
-            "interaction_type", "button_selected"
-        ]
-        
-        csv_data = [
-            data.get('timestamp', ''),
-            data.get('username', ''),
-            data.get('password', ''),
-            data.get('agent_name', ''),
-            data.get('user_id', ''),
-            data.get('interaction_type', ''),
-            data.get('button_selected', '')
-        ]
-
-        csv_file = os.path.join(data_dir, 'popup.csv')
-        write_headers = not os.path.exists(csv_file)
-
-        with open(csv_file, 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            if write_headers:
-                writer.writerow(csv_headers)
-            writer.writerow(csv_data)
-            
+        data_log.submit('popup', data)
     except Exception as e:
         app.logger.error(f"Error logging popup data: {e}")
 
 # Function to log pre-survey data to dedicated pre-survey files
+@trace_phase('logging')
 def log_pre_survey_data(data):
-    """Log pre-survey responses to dedicated pre-survey JSON and CSV files"""
+    """Queue pre-survey responses for pre_survey.json and pre_survey.csv"""
     try:
-        data_dir = ensure_data_directory()
-        survey_json_path = os.path.join(data_dir, 'pre_survey.json')
-        
-        try:
-            with open(survey_json_path, 'r') as f:
-                file_content = f.read().strip()
-                survey_data = json.loads(file_content) if file_content else {"pre_survey_responses": []}
-        except (FileNotFoundError, json.JSONDecodeError):
-            survey_data = {"pre_survey_responses": []}
-
-        survey_entry = {
-            'username': data.get('pre_username', data.get('username', '')),
-            'password': data.get('pre_password', data.get('password', '')),
-            'agent_name': data.get('pre_agent_name', data.get('agent_name', '')),
-            'user_id': data.get('pre_user_id', data.get('user_id', '')),
-            'survey_start_timestamp': data.get('pre_survey_start_timestamp', data.get('survey_start_timestamp', '')),
-            'survey_end_timestamp': data.get('pre_survey_end_timestamp', data.get('survey_end_timestamp', '')),
-            'survey_completed': data.get('pre_survey_completed', data.get('survey_completed', 'no')),
-            'interaction_type': data.get('pre_interaction_type', 'pre_interaction_survey')
-        }
-        
-        for key, value in data.items():
-            if key not in ['username', 'password', 'agent_name', 'user_id', 'survey_start_timestamp', 'survey_end_timestamp', 'survey_completed', 
-                          'pre_username', 'pre_password', 'pre_agent_name', 'pre_user_id', 'pre_survey_start_timestamp', 'pre_survey_end_timestamp', 'pre_survey_completed',
-                          'pre_interaction_type', 'pre_timestamp']:
-                survey_entry[key] = value
-
-        survey_data["pre_survey_responses"].append(survey_entry)
-
-        # Log pre-survey JSON
-        with open(survey_json_path, 'w') as f:
-            json.dump(survey_data, f, indent=4)
-
-        csv_headers = [
-            "username", "password", "agent_name", "user_id", "survey_start_timestamp", 
-            "survey_end_timestamp", "survey_completed", "interaction_type"
-        ]
-        csv_data = [
-            survey_entry.get('username', ''),
-            survey_entry.get('password', ''),
-            survey_entry.get('agent_name', ''),
-            survey_entry.get('user_id', ''),
-            survey_entry.get('survey_start_timestamp', ''),
-            survey_entry.get('survey_end_timestamp', ''),
-            survey_entry.get('survey_completed', ''),
-            survey_entry.get('interaction_type', 'pre_survey')
-        ]
-        
-        for key, value in survey_entry.items():
-            if key not in csv_headers:
-                csv_headers.append(key)
-                csv_data.append(value)
-        # Log pre-survey CSV
-        csv_file = os.path.join(ensure_data_directory(), 'pre_survey.csv')
-        write_headers = not os.path.exists(csv_file)
-
-        with open(csv_file, 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            if write_headers:
-                writer.writerow(csv_headers)
-            writer.writerow(csv_data)
-            
+        data_log.submit('pre_survey', data)
     except Exception as e:
         app.logger.error(f"Error logging pre-survey data: {e}")
 
 # Function to log post-survey data to dedicated post-survey files
+@trace_phase('logging')
 def log_post_survey_data(data):
-    """Log post-survey responses to dedicated post-survey JSON and CSV files"""
+    """Queue post-survey responses for post_survey.json and post_survey.csv"""
     try:
-        data_dir = ensure_data_directory()
-        survey_json_path = os.path.join(data_dir, 'post_survey.json')
-        
-        try:
-            with open(survey_json_path, 'r') as f:
-                file_content = f.read().strip()
-                survey_data = json.loads(file_content) if file_content else {"post_survey_responses": []}
-        except (FileNotFoundError, json.JSONDecodeError):
-            survey_data = {"post_survey_responses": []}
-
-        survey_entry = {
-            'username': data.get('post_username', ''),
-            'password': data.get('post_password', ''),
-            'agent_name': data.get('post_agent_name', ''),
-            'user_id': data.get('post_user_id', ''),
-            'survey_start_timestamp': data.get('post_survey_start_timestamp', ''),
-            'survey_end_timestamp': data.get('post_survey_end_timestamp', ''),
-            'survey_completed': data.get('post_survey_completed', 'no'),
-            'interaction_type': data.get('post_interaction_type', 'post_interaction_survey')
-        }
-        
-        for key, value in data.items():
-            if key not in ['post_username', 'post_password', 'post_agent_name', 'post_user_id', 'post_survey_start_timestamp', 'post_survey_end_timestamp', 'post_survey_completed',
-                          'post_interaction_type', 'post_timestamp']:
-                survey_entry[key] = value
-
-        survey_data["post_survey_responses"].append(survey_entry)
-
-        # Log post-survey JSON
-        with open(survey_json_path, 'w') as f:
-            json.dump(survey_data, f, indent=4)
-        csv_headers = [
-            "username", "password", "agent_name", "user_id", "survey_start_timestamp", 
-            "survey_end_timestamp", "survey_completed", "interaction_type"
-        ]
-        csv_data = [
-            survey_entry.get('username', ''),
-            survey_entry.get('password', ''),
-            survey_entry.get('agent_name', ''),
-            survey_entry.get('user_id', ''),
-            survey_entry.get('survey_start_timestamp', ''),
-            survey_entry.get('survey_end_timestamp', ''),
-            survey_entry.get('survey_completed', ''),
-            survey_entry.get('interaction_type', 'post_survey')
-        ]
-        
-        for key, value in survey_entry.items():
-            if key not in csv_headers:
-                csv_headers.append(key)
-                csv_data.append(value)
-        # Log post-survey CSV
-        csv_file = os.path.join(ensure_data_directory(), 'post_survey.csv')
-        write_headers = not os.path.exists(csv_file)
-
-        with open(csv_file, 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            if write_headers:
-                writer.writerow(csv_headers)
-            writer.writerow(csv_data)
-            
+        data_log.submit('post_survey', data)
     except Exception as e:
         app.logger.error(f"Error logging post-survey data: {e}")
 
@@ -949,14 +940,36 @@ def log_survey_start(username, password, user_id):
     except Exception as e:
         app.logger.error(f"Error logging survey start: {e}")
 
-def load_survey_config():
-    """Load survey configuration from file, return None if not found"""
+_survey_config_cache = None
+
+def get_cached_survey_config():
+    """survey_config.json from the in-memory cache, None if there isn't one. Read errors are raised.
+
+    The returned dict is shared between requests, so don't modify it.
+    """
+    global _survey_config_cache
+    version = config_watcher.version('survey_config')
+    if _survey_config_cache and _survey_config_cache[0] == version:
+        return _survey_config_cache[1]
     try:
         survey_config_path = os.path.join(ensure_data_directory(), 'survey_config.json')
         with open(survey_config_path, 'r') as f:
-            return json.load(f)
+            config = json.load(f)
     except FileNotFoundError:
-        return None
+        config = None
+    if config:
+        # Compile the pre- and post-survey models now rather than on a participant's request
+        survey_model(config)
+        if 'post_survey' in config:
+            survey_model(config['post_survey'])
+    _survey_config_cache = (version, config)
+    return config
+
+@trace_phase('config')
+def load_survey_config():
+    """Load survey configuration from file, return None if not found"""
+    try:
+        return get_cached_survey_config()
     except Exception as e:
         app.logger.error(f"Error loading survey config: {e}")
         return None
@@ -967,23 +980,32 @@ def collect_dynamic_survey_data(form_data, survey_config, prefix=''):
 
     The survey generator uses hidden researcher-defined column labels as HTML field
     names. Those names become the CSV/JSON column keys (prefixed with pre_/post_).
+    Answers are checked and typed against the compiled survey model (see clean_submission),
+    a submission that doesn't fit raises SurveySubmissionError.
     """
-    survey_data = {}
-
-    for key in form_data.keys():
-        if key.endswith('[]'):
-            base_key = key[:-2]
-            values = form_data.getlist(key)
-            if values:
-                prefixed_key = f"{prefix}{base_key}" if prefix else base_key
-                survey_data[prefixed_key] = values
-        else:
-            value = form_data.get(key)
-            if value is not None and str(value).strip() != '':
-                prefixed_key = f"{prefix}{key}" if prefix else key
-                survey_data[prefixed_key] = value
+    if survey_config:
+        answers = clean_submission(survey_model(survey_config), form_data)
+    else:
+        # No survey config, so the page was the static template and its fields aren't known
+        answers = {}
+        for key in form_data.keys():
+            if key.endswith('[]'):
+                values = form_data.getlist(key)
+                if values:
+                    answers[key[:-2]] = values
+            else:
+                value = form_data.get(key)
+                if value is not None and str(value).strip() != '':
+                    answers[key] = value
+        for value in answers.values():
+            if any(len(item) > SURVEY_TEXT_MAX_CHARS for item in (value if isinstance(value, list) else [value])):
+                raise SurveySubmissionError(f"Answers can't be longer than {SURVEY_TEXT_MAX_CHARS} characters")
 
-    return survey_data
+    return {f"{prefix}{name}" if prefix else name: value for name, value in answers.items()}
+
+def survey_submission_too_large():
+    """Check the size of a survey POST before its form is parsed"""
+    return request.content_length is not None and request.content_length > SURVEY_MAX_SUBMISSION_BYTES
 
 # CHAT route 
 @app.route('/chat', methods=['GET', 'POST'])
@@ -997,8 +1019,8 @@ def chat():
 
     try:
         agent = flask_session.get('agent', 'default')
-        API.update_agent(f"agents/{agent}.json")
-        conversation = get_messages(flask_session['user_id'], flask_session['password'])
+        with trace_phase('agent_load'):
+            API.set_agent_data(get_agent_config(agent))
 
         if request.method == 'POST':
             message = request.form.get('message')
@@ -1006,9 +1028,14 @@ def chat():
                 flash('Message cannot be empty', 'error')
                 return jsonify({'error': 'Message cannot be empty'}), 400
             
+            # The model gets the whole conversation, the page only renders the latest turns
+            conversation = get_messages(flask_session['user_id'], flask_session['password'])
             model = API.agent_data.get("model") or current_model or "gpt-4.1"
             try:
-                conversation, prompt_tokens, completion_tokens, total_tokens, logprobs_list, actual_model = API.thinkAbout(message, conversation, model=model)
+                started = time.perf_counter()
+                with trace_phase('llm'):
+                    conversation, prompt_tokens, completion_tokens, total_tokens, logprobs_list, actual_model = API.thinkAbout(message, conversation, model=model)
+                latency_ms = (time.perf_counter() - started) * 1000
                 response = conversation[-1]["content"]
                 print(f"AI Response complete. Model used: {actual_model}, Tokens: {total_tokens}")
             except Exception as e:
@@ -1017,23 +1044,272 @@ def chat():
 
             user_id = flask_session['user_id']
             password = flask_session['password']
-            add_message(user_id, password, message, str(response), actual_model, API.agent_data.get("temperature", 1), prompt_tokens, completion_tokens, total_tokens, logprobs_list)
+            add_message(user_id, password, message, str(response), actual_model, API.agent_data.get("temperature", 1), prompt_tokens, completion_tokens, total_tokens, logprobs_list, latency_ms=latency_ms)
             return jsonify({'response': response})
 
-        url_settings = get_url_settings_from_db()
-        branding_settings = get_branding_settings_from_db()
-        
-        return render_template('chat.html', 
-                             username=flask_session['username'], 
-                             messages=conversation, 
-                             quit_button_text=url_settings['quit_button_text'],
-                             redirect_button_text=url_settings['redirect_button_text'],
-                             chat_header_line1=branding_settings['chat_header_line1'],
-                             chat_header_line2=branding_settings['chat_header_line2'])
+        turns, has_more_turns = get_message_turns(flask_session['user_id'], flask_session['password'])
+        total_turns = count_message_turns(flask_session['user_id'], flask_session['password']) if has_more_turns else len(turns)
+        with trace_phase('db'):
+            url_settings = get_url_settings_from_db()
+            branding_settings = get_branding_settings_from_db()
+        
+        with trace_phase('render'):
+            return render_template('chat.html', 
+                                 username=flask_session['username'], 
+                                 turns=turns, 
+                                 has_more_turns=has_more_turns,
+                                 total_turns=total_turns,
+                                 quit_button_text=url_settings['quit_button_text'],
+                                 redirect_button_text=url_settings['redirect_button_text'],
+                                 chat_header_line1=branding_settings['chat_header_line1'],
+                                 chat_header_line2=branding_settings['chat_header_line2'],
+                                 chat_bootstrap=build_chat_bootstrap(url_settings, API.agent_data))
     except Exception as ex:
         app.logger.error(f"Unexpected error occurred: {ex}")
         return jsonify({'error': 'Unexpected error occurred'}), 500
 
+# Streamed chat replies, as newline-delimited JSON events:
+#   {"type": "start", "audio_type": "audio/mpeg"}        audio_type is null if the agent has no audio
+#   {"type": "text", "delta": "..."}                     reply text as it is generated
+#   {"type": "audio", "segment": 0, "data": "<base64>"}  speech for agents with audio (see speech_pipeline.py)
+#   {"type": "audio_error", "segment": 0}                a sentence's audio failed, it is skipped
+#   {"type": "audio_end", "segment": 0}                  a sentence's audio is complete
+#   {"type": "done", "response": "...", "ttft_ms": ...,  the reply has been saved, audio_url replays its audio
+#    "audio_url": "/chat/audio/12"}
+#   {"type": "error", "error": "..."}                    instead of done: the reply broke off and wasn't saved
+# The reply is read to the end and saved even if the participant leaves halfway, only its audio stops.
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    if 'username' not in flask_session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not flask_session.get('survey_completed'):
+        return jsonify({'error': 'Survey not completed'}), 403
+
+    message = request.form.get('message')
+    if not message:
+        return jsonify({'error': 'Message cannot be empty'}), 400
+    user_id, password = flask_session['user_id'], flask_session['password']
+
+    try:
+        agent = flask_session.get('agent', 'default')
+        with trace_phase('agent_load'):
+            agent_config = get_agent_config(agent)
+            API.set_agent_data(agent_config)
+        conversation = get_messages(user_id, password)
+        model = agent_config.get("model") or current_model or "gpt-4.1"
+        reply = API.thinkAbout_stream(message, conversation, model=model)
+    except Exception as e:
+        app.logger.error(f"Error starting streamed reply: {e}")
+        return jsonify({'error': 'Error processing message'}), 500
+
+    voice = agent_voice(agent_config)
+    synthesizer = agent_synthesizer(agent_config) if voice else None
+    pipeline = None
+    audio_choice = None
+    if synthesizer:
+        audio_format, reason, connection_kbps = client_audio_format(voice, synthesizer, request.form)
+        voice = dict(voice, audio_format=audio_format)
+        pipeline = SpeechPipeline(synthesizer, voice, study=agent)
+        audio_choice = {'format': audio_format.value, 'reason': reason, 'connection_kbps': connection_kbps}
+    temperature = agent_config.get("temperature", 1)
+
+    def event(data):
+        return json.dumps(data) + '\n'
+
+    # Text and audio arrive at the same time, so both are read in threads and sent in arrival order.
+    # The threads outlive the response if the participant leaves, so the turn is still saved.
+    events = queue.Queue(maxsize=CHAT_STREAM_BUFFER_EVENTS)
+    disconnected = threading.Event()
+    outcome = {}
+
+    def send(item):
+        # Nobody reads the events once the participant has gone
+        while not disconnected.is_set():
+            try:
+                events.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read_audio():
+        audio = pipeline.audio()
+        try:
+            for segment, chunk in audio:
+                if chunk is None:
+                    if pipeline.segments[segment].failed:
+                        send(event({'type': 'audio_error', 'segment': segment}))
+                    send(event({'type': 'audio_end', 'segment': segment}))
+                else:
+                    send(event({'type': 'audio', 'segment': segment,
+                                'data': base64.b64encode(chunk).decode('ascii')}))
+        finally:
+            audio.close()
+            send(None)
+
+    audio_reader = threading.Thread(target=read_audio, daemon=True) if pipeline else None
+
+    @copy_current_request_context
+    def read_reply():
+        try:
+            try:
+                for delta in reply:
+                    send(event({'type': 'text', 'delta': delta}))
+                    if pipeline:
+                        pipeline.add_text(delta)
+                if reply.truncated:
+                    raise RuntimeError(f"the reply broke off ({reply.error})")
+            finally:
+                if pipeline:
+                    pipeline.finish()
+            if audio_reader:
+                # The clip is cached once the audio is complete
+                audio_reader.join()
+            print(f"AI Response complete. Model used: {reply.model}, Tokens: {reply.total_tokens}, TTFT: {reply.ttft_ms}")
+            if pipeline:
+                # The stored audio of the reply, relative to TTS_CACHE_DIR (see /download-audio-clips).
+                # Kept apart from the cache so it isn't evicted while the study refers to it.
+                audio_choice['clip'] = tts_cache.keep(pipeline.clip)
+            outcome['message_id'] = add_message(user_id, password, message, reply.text, reply.model, temperature,
+                                                reply.prompt_tokens, reply.completion_tokens, reply.total_tokens,
+                                                reply.logprobs_list, latency_ms=reply.latency_ms,
+                                                ttft_ms=reply.ttft_ms, audio=audio_choice)
+        except Exception as e:
+            # A partial reply isn't saved as if it were the whole one
+            outcome['error'] = e
+            app.logger.error(f"Error streaming reply: {e}")
+            if pipeline:
+                pipeline.close()
+        finally:
+            send(None)
+
+    def generate():
+        # Started before anything is sent, so the reply is saved even if nothing of it is read
+        threading.Thread(target=read_reply, daemon=True).start()
+        if audio_reader:
+            audio_reader.start()
+        try:
+            yield event({'type': 'start', 'audio_type': audio_mime_type(voice['audio_format']) if pipeline else None})
+            # The request trace is written when the response starts, so the streamed part isn't in it
+            running = 2 if audio_reader else 1
+            while running:
+                item = events.get()
+                if item is None:
+                    running -= 1
+                else:
+                    yield item
+        except GeneratorExit:
+            # The participant has gone: stop the audio, the reply is still read and saved
+            disconnected.set()
+            if pipeline:
+                pipeline.close()
+            raise
+        if 'error' in outcome:
+            yield event({'type': 'error', 'error': 'Error processing message'})
+            return
+        # Replays ask for the same format, so they come from the clip cached while streaming
+        audio_url = url_for('chat_audio', message_id=outcome['message_id'], format=voice['audio_format'].value) if pipeline else None
+        yield event({'type': 'done', 'response': reply.text, 'ttft_ms': reply.ttft_ms, 'audio_url': audio_url})
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def client_audio_format(voice, synthesizer, values):
+    """Audio format for this client from what chat.js reports (see negotiate_audio_format).
+
+    values can hold connection_kbps (measured by chat.js), save_data ('true') and audio_accept (the
+    audio types the browser can play, Accept header syntax). Returns (format, reason, connection_kbps).
+    """
+    connection_kbps = values.get('connection_kbps', type=float)
+    save_data = values.get('save_data') == 'true' or request.headers.get('Save-Data', '').lower() == 'on'
+    accept = values.get('audio_accept') or request.headers.get('Accept')
+    audio_format, reason = negotiate_audio_format(voice, synthesizer, accept, connection_kbps, save_data)
+    return audio_format, reason, connection_kbps
+
+@app.route('/chat/audio/<int:message_id>', methods=['GET'])
+def chat_audio(message_id):
+    """Audio of one of the participant's replies, for replay.
+
+    Clips in the TTS cache are sent as files, with Range support so the browser can seek.
+    Otherwise the provider's audio is relayed chunk by chunk as it arrives and cached on the way.
+    """
+    if 'username' not in flask_session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    with trace_phase('db'):
+        conn = sqlite3.connect('users.db')
+        row = conn.execute('SELECT response, agent FROM messages WHERE id = ? AND user_id = ? AND password = ?',
+                           (message_id, flask_session['user_id'], flask_session['password'])).fetchone()
+        conn.close()
+    if row is None:
+        return jsonify({'error': 'Message not found'}), 404
+
+    response_text, agent = row
+    try:
+        agent_config = get_agent_config(agent or flask_session.get('agent', 'default'))
+    except FileNotFoundError:
+        agent_config = None
+    voice = agent_voice(agent_config)
+    if voice is None or not response_text.strip():
+        return jsonify({'error': 'No audio for this message'}), 404
+    synthesizer = agent_synthesizer(agent_config)
+    if synthesizer is None:
+        return jsonify({'error': 'Audio is not configured'}), 503
+    if request.args.get('format'):
+        try:
+            audio_format = AudioFormat(request.args['format'])
+        except ValueError:
+            return jsonify({'error': 'Unknown audio format'}), 400
+        if not synthesizer.supports_format(audio_format):
+            return jsonify({'error': 'Audio format not available'}), 400
+        reason = 'requested'
+    else:
+        audio_format, reason, _ = client_audio_format(voice, synthesizer, request.args)
+    voice = dict(voice, audio_format=audio_format)
+    print(f"Audio for message {message_id}: {audio_format.value} ({reason})")
+    mimetype = audio_mime_type(voice['audio_format'])
+
+    if synthesizer.cache:
+        cached_path = synthesizer.cache.lookup(synthesizer.cache_key(response_text, **voice), voice['audio_format'].value)
+        if cached_path:
+            response = send_file(cached_path, mimetype=mimetype, conditional=True)
+            response.headers['Cache-Control'] = 'private, max-age=86400'
+            return response
+
+    # Long replies are synthesized in chunks at once and joined in order (see speak_text)
+    with trace_phase('tts'):
+        pipeline = speak_text(synthesizer, voice, response_text, study=agent or flask_session.get('agent', 'default'))
+        audio = pipeline.clip_audio()
+        first_chunk = next(audio, None)
+    # Until the first chunk is sent a failed part can still be reported properly
+    if first_chunk is None or pipeline.failed:
+        audio.close()
+        app.logger.error(f"Error synthesizing audio for message {message_id}, failed part(s): {pipeline.failed}")
+        return jsonify({'error': 'Error synthesizing audio'}), 502
+
+    def stream():
+        yield first_chunk
+        yield from audio
+        if pipeline.failed:
+            app.logger.error(f"Audio for message {message_id} was sent without part(s) {pipeline.failed} "
+                             f"of {len(pipeline.segments)}")
+
+    # Not seekable until it is cached, so no ranges for this one
+    return Response(stream(), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'Accept-Ranges': 'none'})
+
+@app.route('/chat/history', methods=['GET'])
+def chat_history():
+    """Older turns of the participant's transcript, for lazy loading when they scroll up"""
+    if 'username' not in flask_session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    before_id = request.args.get('before_id', type=int)
+    limit = max(1, min(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 100))
+    turns, has_more = get_message_turns(flask_session['user_id'], flask_session['password'], before_id, limit)
+    return jsonify({
+        'turns': turns,
+        'has_more': has_more,
+        'oldest_id': turns[0]['id'] if turns else None
+    })
+
 # Researcher dashboard routes and functions
 @app.route('/researcher', methods=['POST'])
 def researcher_login():
@@ -1088,10 +1364,57 @@ def reload_env():
 
 # These are both for loading in Agent JSON files and reviewing the conditions in the researcher access
 AGENTS_FOLDER = os.path.join(os.path.dirname(__file__), 'agents')
+
+
+# Agent JSONs and survey_config.json are cached in memory. config_watcher bumps a version whenever
+# one of these files changes on disk (from the dashboard or a manual edit), and the caches reload then.
+config_watcher.watch(AGENTS_FOLDER, 'agents', lambda name: name.endswith('.json'))
+config_watcher.watch(ensure_data_directory(), 'survey_config', lambda name: name == 'survey_config.json')
+
+# Parsed agent JSON files keyed by agent name, stored with the watcher version they were read at
+_agent_config_cache = {}
+_agent_file_list_cache = None
+
+def get_agent_config(agent_name):
+    """Cached agents/<agent_name>.json. Raises FileNotFoundError if the file is missing.
+
+    The returned dict is shared between requests, so don't modify it.
+    """
+    version = config_watcher.version('agents')
+    cached = _agent_config_cache.get(agent_name)
+    if cached and cached[0] == version:
+        return cached[1]
+    with open(os.path.join(AGENTS_FOLDER, f'{agent_name}.json'), 'r') as f:
+        config = json.load(f)
+    _agent_config_cache[agent_name] = (version, config)
+    return config
+
+def warm_up_agent_audio(agent_names=None):
+    """Cache the audio of agents' opening lines in the background (see tts_warmup.py).
+    Without agent_names, every agent with an active password is warmed up."""
+    if agent_names is None:
+        agent_names = sorted({agent for _, agent, is_active in get_all_agents_with_status() if is_active})
+    agents = []
+    for agent_name in agent_names:
+        try:
+            agents.append((agent_name, get_agent_config(agent_name)))
+        except (OSError, ValueError) as e:
+            print(f"TTS warm-up: could not read agent {agent_name}: {e}")
+    warm_up_in_background(agents)
+
+def list_agent_files():
+    """Cached list of the JSON files in agents/"""
+    global _agent_file_list_cache
+    version = config_watcher.version('agents')
+    if _agent_file_list_cache and _agent_file_list_cache[0] == version:
+        return _agent_file_list_cache[1]
+    files = [f for f in os.listdir(AGENTS_FOLDER) if f.endswith('.json')]
+    _agent_file_list_cache = (version, files)
+    return files
+
 @app.route('/list-json-files')
 def list_json_files():
-    files = [f for f in os.listdir(AGENTS_FOLDER) if f.endswith('.json')]
-    return jsonify(files)
+    return jsonify(list_agent_files())
 
 @app.route('/get-file-content')
 def get_file_content():
@@ -1112,6 +1435,8 @@ def create_json_file():
     
     with open(f'agents/{filename}.json', 'w') as jsonfile:
         json.dump(data, jsonfile, indent=2)
+    config_watcher.bump('agents')
+    warm_up_agent_audio([filename])
 
     return jsonify({"message": "File created successfully"}), 201
 
@@ -1195,28 +1520,33 @@ def update_randomised_password_route():
 def get_agents_with_status_route():
     """Get all agents with their active status and details"""
     try:
-        agents = get_all_agents_with_status()
-        agent_details = []
-        
-        for password, agent_name, is_active in agents:
-            try:
-                with open(f'agents/{agent_name}.json', 'r') as f:
-                    agent_config = json.load(f)
+        with trace_phase('db'):
+            agents = get_all_agents_with_status()
+
+        # The listing only changes when the passwords table or an agent file changes,
+        # so the dashboard's periodic reload gets a 304 otherwise
+        etag = hashlib.sha1(json.dumps([agents, config_watcher.fingerprint('agents')]).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            agent_details = []
+            for password, agent_name, is_active in agents:
+                try:
+                    with trace_phase('agent_load'):
+                        agent_config = get_agent_config(agent_name)
+                except FileNotFoundError:
+                    agent_config = {'error': 'Agent file not found'}
                 agent_details.append({
                     'password': password,
                     'agent_name': agent_name,
                     'is_active': bool(is_active),
                     'config': agent_config
                 })
-            except FileNotFoundError:
-                agent_details.append({
-                    'password': password,
-                    'agent_name': agent_name,
-                    'is_active': bool(is_active),
-                    'config': {'error': 'Agent file not found'}
-                })
-        
-        return jsonify({'agents': agent_details}), 200
+            response = jsonify({'agents': agent_details})
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1256,34 +1586,122 @@ def delete_agent_route():
         agent_file_path = f'agents/{agent_name}.json'
         if os.path.exists(agent_file_path):
             os.remove(agent_file_path)
+            config_watcher.bump('agents')
             
         return jsonify({'message': 'Agent deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# This is for local download of data files in researcher dashboard
-@app.route('/download/<filename>')
-def download_file(filename):
-    directory = '.'  
+# Token usage and latency per agent/model for the researcher dashboard
+@app.route('/get-usage-report', methods=['GET'])
+def get_usage_report_route():
+    """Get token usage and latency aggregated per agent and model"""
+    if not flask_session.get('researcher'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        return jsonify({'usage': get_usage_report()}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    if not os.path.exists(os.path.join(directory, filename)):
-        abort(404)  
+# LLM latency/token/cost metrics (per gunicorn worker, see metrics.py)
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint. Needs a researcher session or METRICS_TOKEN as a bearer token."""
+    metrics_token = os.environ.get('METRICS_TOKEN')
+    token_ok = bool(metrics_token) and request.headers.get('Authorization') == f'Bearer {metrics_token}'
+    if not (token_ok or flask_session.get('researcher')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return llm_metrics.prometheus_text() + data_log.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/get-metrics-summary', methods=['GET'])
+def get_metrics_summary():
+    """JSON summary of LLM latency, throughput, errors and cost for the researcher dashboard"""
+    if not flask_session.get('researcher'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    window_seconds = request.args.get('window', 300, type=int)
+    summary = llm_metrics.summary(window_seconds=window_seconds)
+    summary['data_log'] = data_log.status()
+    return jsonify(summary), 200
+
+@app.route('/get-tts-voices', methods=['GET'])
+def get_tts_voices():
+    """ElevenLabs voices and models for the agent audio settings (cached, see tts_metadata.py)"""
+    if not flask_session.get('researcher'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    synthesizer = get_synthesizer()
+    if synthesizer is None:
+        return jsonify({'error': 'ElevenLabs is not configured'}), 503
+    refresh = request.args.get('refresh') == 'true'
+    try:
+        voices = synthesizer.get_available_voices(refresh=refresh)
+        models = synthesizer.get_available_models(refresh=refresh)
+    except Exception as e:
+        app.logger.error(f"Error getting TTS voices: {e}")
+        return jsonify({'error': 'Could not retrieve voices'}), 502
+    # Voice details are fetched in the background, so opening a voice is instant too
+    threading.Thread(target=warm_voice_details, args=([voice['voice_id'] for voice in voices],),
+                     daemon=True).start()
+    return jsonify({'voices': voices, 'models': models}), 200
+
+@app.route('/get-tts-voice/<voice_id>', methods=['GET'])
+def get_tts_voice(voice_id):
+    """Details of one ElevenLabs voice (cached, see tts_metadata.py)"""
+    if not flask_session.get('researcher'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    synthesizer = get_synthesizer()
+    if synthesizer is None:
+        return jsonify({'error': 'ElevenLabs is not configured'}), 503
+    try:
+        return jsonify(synthesizer.get_voice_details(voice_id)), 200
+    except Exception as e:
+        app.logger.error(f"Error getting TTS voice {voice_id}: {e}")
+        return jsonify({'error': 'Could not retrieve voice'}), 502
+
+# Slow request profiles (saved when PROFILE_SLOW_REQUESTS is on, see request_tracing.py)
+@app.route('/get-slow-request-profiles', methods=['GET'])
+def get_slow_request_profiles():
+    """List saved profiles of slow requests for the researcher dashboard"""
+    if not flask_session.get('researcher'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({
+        'profiling_enabled': request_tracing.PROFILE_SLOW_REQUESTS,
+        'slow_request_ms': request_tracing.SLOW_REQUEST_MS,
+        'profiles': request_tracing.list_profiles()
+    }), 200
+
+@app.route('/view-request-profile/<name>', methods=['GET'])
+def view_request_profile(name):
+    """Show one saved slow request profile"""
+    if not flask_session.get('researcher'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    path = request_tracing.profile_path(name)
+    if not path:
+        abort(404)
+    mimetype = 'text/html' if name.endswith('.html') else 'text/plain'
+    return send_file(os.path.abspath(path), mimetype=mimetype)
 
+def log_download(filename):
+    """Append a data file download to download_log.json"""
     log_entry = {
         "filename": filename,
         "timestamp": datetime.now().isoformat(),
         "client_ip": request.remote_addr
     }
 
-    data_dir = ensure_data_directory()
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
+    with trace_phase('logging'):
+        data_log.submit('download', log_entry)
+        # Make sure the file being downloaded includes everything logged so far
+        data_log.flush()
+
+# This is for local download of data files in researcher dashboard
+@app.route('/download/<filename>')
+def download_file(filename):
+    directory = '.'  
+
+    if not os.path.exists(os.path.join(directory, filename)):
+        abort(404)  
 
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(directory, filename, as_attachment=True)
 
@@ -1297,20 +1715,7 @@ def download_survey_json():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1323,20 +1728,7 @@ def download_survey_csv():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1350,20 +1742,7 @@ def download_pre_survey_json():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1376,20 +1755,7 @@ def download_pre_survey_csv():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1403,20 +1769,7 @@ def download_post_survey_json():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1429,20 +1782,7 @@ def download_post_survey_csv():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1456,20 +1796,7 @@ def download_popup_json():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1482,20 +1809,7 @@ def download_popup_csv():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1509,20 +1823,7 @@ def download_interactions_json():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1535,20 +1836,7 @@ def download_interactions_csv():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1562,20 +1850,7 @@ def download_download_log():
     if not os.path.exists(os.path.join(data_dir, filename)):
         abort(404)
 
-    log_entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "client_ip": request.remote_addr
-    }
-
-    download_log_path = os.path.join(data_dir, 'download_log.json')
-    
-    if not os.path.exists(download_log_path):
-        with open(download_log_path, 'w') as log_file:
-            log_file.write('')
-
-    with open(download_log_path, 'a') as log_file:
-        log_file.write(json.dumps(log_entry) + '\n')
+    log_download(filename)
 
     return send_from_directory(data_dir, filename, as_attachment=True)
 
@@ -1599,6 +1874,36 @@ def download_visitor_log():
         mimetype='application/json'
     )
 
+@app.route('/download-audio-clips')
+def download_audio_clips():
+    """Zip of the reply audio kept in the TTS cache (?agent=<name> for one agent's replies).
+
+    The clip paths in the zip are the ones in interactions.json ("audio": {"clip": ...}). Clips
+    of replies saved before clips were kept (see TTSCache.keep) are only there if not yet evicted.
+    """
+    if not flask_session.get('researcher'):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    agent = request.args.get('agent')
+    clips = tts_cache.study_clips(agent)
+    if not clips:
+        abort(404)
+
+    # Audio is already compressed, so the clips are stored as they are
+    archive = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+        for clip in clips:
+            try:
+                zip_file.write(os.path.join(tts_cache.directory, clip), clip)
+            except FileNotFoundError:
+                # Evicted since the list was read
+                continue
+    archive.seek(0)
+
+    filename = f'audio_clips_{agent or "all"}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip'
+    log_download(filename)
+    return send_file(archive, as_attachment=True, download_name=filename, mimetype='application/zip')
+
 # Timer settings routes
 @app.route('/get-timer-settings', methods=['GET'])
 def get_timer_settings():
@@ -1813,32 +2118,61 @@ def update_url_settings():
     
     return jsonify({'success': True, 'message': 'URL settings updated successfully'})
 
+def build_chat_bootstrap(settings, agent_config=None):
+    """Everything chat.js needs on page load in one payload, built from get_url_settings_from_db()"""
+    bootstrap = {
+        # Agents with audio stream their replies from /chat/stream
+        'audio': {'enabled': agent_voice(agent_config) is not None},
+        'redirect_urls': {
+            'quit_url': settings['quit_url'],
+            'redirect_url': settings['redirect_url'],
+            'use_post_survey': settings['use_post_survey']
+        },
+        'trigger_settings': {
+            'trigger_type': settings['trigger_type'],
+            'stage1_messages': settings['stage1_messages'],
+            'stage2_messages': settings['stage2_messages'], 
+            'stage3_messages': settings['stage3_messages'],
+            'stage1_time': settings['stage1_time'],
+            'stage2_time': settings['stage2_time'],
+            'stage3_time': settings['stage3_time'],
+            'quit_button_text': settings['quit_button_text'],
+            'redirect_button_text': settings['redirect_button_text'],
+            'use_post_survey': settings['use_post_survey']
+        },
+        'timer_settings': {
+            'duration_minutes': settings['timer_duration_minutes']
+        },
+        'url_settings': settings
+    }
+    # The version changes whenever any setting does, and doubles as the ETag
+    bootstrap['version'] = hashlib.sha1(json.dumps(bootstrap, sort_keys=True).encode()).hexdigest()[:16]
+    return bootstrap
+
+@app.route('/chat/bootstrap', methods=['GET'])
+def chat_bootstrap():
+    """All chat page settings in one request (chat.html normally has them inlined already)"""
+    if 'username' not in flask_session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        agent_config = get_agent_config(flask_session.get('agent', 'default'))
+    except FileNotFoundError:
+        agent_config = None
+    bootstrap = build_chat_bootstrap(get_url_settings_from_db(), agent_config)
+    response = jsonify(bootstrap)
+    response.set_etag(bootstrap['version'])
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
 @app.route('/get-redirect-urls', methods=['GET'])
 def get_redirect_urls():
     """API endpoint for the chat interface to get current redirect URLs"""
-    settings = get_url_settings_from_db()
-    return jsonify({
-        'quit_url': settings['quit_url'],
-        'redirect_url': settings['redirect_url'],
-        'use_post_survey': settings['use_post_survey']
-    })
+    return jsonify(build_chat_bootstrap(get_url_settings_from_db())['redirect_urls'])
 
 @app.route('/get-trigger-settings', methods=['GET'])
 def get_trigger_settings():
     """API endpoint for the chat interface to get trigger settings"""
-    settings = get_url_settings_from_db()
-    return jsonify({
-        'trigger_type': settings['trigger_type'],
-        'stage1_messages': settings['stage1_messages'],
-        'stage2_messages': settings['stage2_messages'], 
-        'stage3_messages': settings['stage3_messages'],
-        'stage1_time': settings['stage1_time'],
-        'stage2_time': settings['stage2_time'],
-        'stage3_time': settings['stage3_time'],
-        'quit_button_text': settings['quit_button_text'],
-        'redirect_button_text': settings['redirect_button_text'],
-        'use_post_survey': settings['use_post_survey']
-    })
+    return jsonify(build_chat_bootstrap(get_url_settings_from_db())['trigger_settings'])
 
 @app.route('/log-post-chat-popup', methods=['POST'])
 def log_post_chat_popup():
@@ -1884,6 +2218,7 @@ def save_survey_config():
         survey_config_path = os.path.join(ensure_data_directory(), 'survey_config.json')
         with open(survey_config_path, 'w') as f:
             json.dump(config, f, indent=4)
+        config_watcher.bump('survey_config')
         
         try:
             generate_survey_html(config)
@@ -1903,36 +2238,14 @@ def validate_survey_config(config):
     if 'title' not in config:
         return "Survey title is required"
     
-    sections = config.get('sections', {})
-    if sections:
-        if sections.get('demographics', {}).get('enabled', False):
-            demo_fields = sections['demographics'].get('fields', {})
-            if not demo_fields:
-                return "Demographics section is enabled but has no fields configured"
-        
-        if sections.get('likert', {}).get('enabled', False):
-            likert_items = sections['likert'].get('items', [])
-            if not likert_items:
-                return "Likert section is enabled but has no items configured"
-        
-        if sections.get('freetext', {}).get('enabled', False):
-            freetext_questions = sections['freetext'].get('questions', [])
-            if not freetext_questions:
-                return "Free text section is enabled but has no questions configured"
-        
-        media_types = ['image', 'video', 'pdf']
-        for media_type in media_types:
-            for section_key in sections:
-                if section_key.startswith(f'{media_type}-') and sections[section_key].get('enabled', False):
-                    media_section = sections[section_key]
-                    if media_type in ['image', 'video', 'pdf']:
-                        if media_type == 'video':
-                            has_file = media_section.get('file_path') or media_section.get('video_url')
-                            if not has_file:
-                                return f"Video section '{section_key}' is enabled but has no file or URL configured"
-                        else:
-                            if not media_section.get('file_path'):
-                                return f"{media_type.title()} section '{section_key}' is enabled but has no file configured"
+    # Compiling checks every enabled section has content and no two fields share a column label
+    problems = compile_survey(config).problems
+    if problems:
+        return problems[0]
+    if isinstance(config.get('post_survey'), dict):
+        problems = compile_survey(config['post_survey']).problems
+        if problems:
+            return f"Post-survey: {problems[0]}"
     
     return None  
 
@@ -1940,12 +2253,7 @@ def validate_survey_config(config):
 def get_survey_config():
     """Get current survey configuration"""
     try:
-        survey_config_path = os.path.join(ensure_data_directory(), 'survey_config.json')
-        with open(survey_config_path, 'r') as f:
-            config = json.load(f)
-        return jsonify(config)
-    except FileNotFoundError:
-        return jsonify(None)
+        return jsonify(get_cached_survey_config())
     except Exception as e:
         app.logger.error(f"Error loading survey config: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1957,6 +2265,7 @@ def reset_survey_config():
         survey_config_path = os.path.join(ensure_data_directory(), 'survey_config.json')
         if os.path.exists(survey_config_path):
             os.remove(survey_config_path)
+            config_watcher.bump('survey_config')
         
         upload_dir = 'static/uploads'
         if os.path.exists(upload_dir):
@@ -2177,6 +2486,7 @@ def generate_survey_html(config):
         app.logger.error(f"Error generating survey HTML: {e}")
         raise
 
+@trace_phase('render')
 def generate_survey_html_content(config, preview=False):
     """Generate the actual HTML content for the survey"""
     # This is a big function to generate the HTML for those surveys
@@ -2201,15 +2511,15 @@ def generate_survey_html_content(config, preview=False):
         download_links += '</div>'
     
     if preview:
-        css_link = '/static/css/styles.css'
-        js_link = '/static/js/pre_survey.js'
+        css_link = asset_url('css/styles.css')
+        js_link = asset_url('js/pre_survey.js')
         quit_link_var = 'window.quitRedirectionLink = "#";'
     else:
-        css_link = '/static/css/styles.css'
-        js_link = '/static/js/pre_survey.js'
+        css_link = asset_url('css/styles.css')
+        js_link = asset_url('js/pre_survey.js')
         quit_link_var = f'window.quitRedirectionLink = "{os.environ.get("QUIT_URL", "https://www.prolific.com/")}";'
     
-    html = f'''<!DOCTYPE html>
+    parts = [f'''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -2250,40 +2560,11 @@ def generate_survey_html_content(config, preview=False):
         
         <div class="survey-content">
             <form id="survey-form">
-'''
+''']
     # adding sections here
-    sections = config.get('sections', {})
-    settings = config.get('settings', {})
-    randomize_items = settings.get('randomizeItems', False)
+    render_survey_sections(parts, config)
     
-    for section_id, section_config in sections.items():
-        if not section_config.get('enabled', False):
-            continue
-            
-        section_type = section_config.get('type', section_id.split('-')[0])
-        
-        if section_type == 'demographics':
-            html += generate_demographics_section(section_config)
-        elif section_type == 'likert':
-            html += generate_likert_section(section_config, randomize_items)
-        elif section_type == 'freetext':
-            html += generate_freetext_section(section_config, randomize_items)
-        elif section_type == 'checkbox':
-            html += generate_checkbox_section(section_config, section_id)
-        elif section_type == 'dropdown':
-            html += generate_dropdown_section(section_config, section_id)
-        elif section_type == 'slider':
-            html += generate_slider_section(section_config, section_id)
-        elif section_type == 'image':
-            html += generate_image_section(section_config, section_id)
-        elif section_type == 'video':
-            html += generate_video_section(section_config, section_id)
-        elif section_type == 'pdf':
-            html += generate_pdf_section(section_config, section_id)
-        elif section_type == 'custom':
-            html += generate_custom_section(section_config)
-    
-    html += '''
+    parts.append('''
                 <div class="submit-section">
                     <button type="submit" id="submit-btn">Submit Survey</button>
                 </div>
@@ -2308,9 +2589,9 @@ def generate_survey_html_content(config, preview=False):
     </script>
     <script src="''' + js_link + '''"></script>
 </body>
-</html>'''
+</html>''')
     
-    return html
+    return ''.join(parts)
 
 def generate_post_survey_html_content(config, quit_redirection_link, finish_redirection_link, completion_instructions, finish_button_text, preview=False):
     """Generate the actual HTML content for the post-interaction survey"""
@@ -2334,23 +2615,23 @@ def generate_post_survey_html_content(config, quit_redirection_link, finish_redi
         download_links += '</div>'
     
     if preview:
-        css_link = '/static/css/styles.css'
-        js_link = '/static/js/post_survey.js'
+        css_link = asset_url('css/styles.css')
+        js_link = asset_url('js/post_survey.js')
         quit_link_var = 'window.quitRedirectionLink = "#";'
         finish_link_var = 'window.finishRedirectionLink = "#";'
     else:
-        css_link = '/static/css/styles.css'
-        js_link = '/static/js/post_survey.js'
+        css_link = asset_url('css/styles.css')
+        js_link = asset_url('js/post_survey.js')
         quit_link_var = f'window.quitRedirectionLink = "{quit_redirection_link}";'
         finish_link_var = f'window.finishRedirectionLink = "{finish_redirection_link}";'
     
-    html = f'''<!DOCTYPE html>
+    parts = [f'''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{config.get('title', 'Survey Form')}</title>
-    <link rel="icon" type="image/x-icon" href="/static/images/IA.ico">
+    <link rel="icon" type="image/x-icon" href="{asset_url('images/IA.ico')}">
     <link rel="stylesheet" href="{css_link}" charset="UTF-8">
 </head>
 <body class="survey-page">
@@ -2363,40 +2644,11 @@ def generate_post_survey_html_content(config, quit_redirection_link, finish_redi
             <!-- Main Survey Form --> 
             <form id="survey-form" class="survey-form">
                 <div id="survey-sections" class="survey-sections">
-'''
+''']
     # adding sections here
-    sections = config.get('sections', {})
-    settings = config.get('settings', {})
-    randomize_items = settings.get('randomizeItems', False)
+    render_survey_sections(parts, config)
     
-    for section_id, section_config in sections.items():
-        if not section_config.get('enabled', False):
-            continue
-            
-        section_type = section_config.get('type', section_id.split('-')[0])
-        
-        if section_type == 'demographics':
-            html += generate_demographics_section(section_config)
-        elif section_type == 'likert':
-            html += generate_likert_section(section_config, randomize_items)
-        elif section_type == 'freetext':
-            html += generate_freetext_section(section_config, randomize_items)
-        elif section_type == 'checkbox':
-            html += generate_checkbox_section(section_config, section_id)
-        elif section_type == 'dropdown':
-            html += generate_dropdown_section(section_config, section_id)
-        elif section_type == 'slider':
-            html += generate_slider_section(section_config, section_id)
-        elif section_type == 'image':
-            html += generate_image_section(section_config, section_id)
-        elif section_type == 'video':
-            html += generate_video_section(section_config, section_id)
-        elif section_type == 'pdf':
-            html += generate_pdf_section(section_config, section_id)
-        elif section_type == 'custom':
-            html += generate_custom_section(section_config)
-    
-    html += '''
+    parts.append('''
                 </div>
                 <div class="survey-navigation">
                     <button type="submit" id="submit-btn">Submit Survey</button>
@@ -2437,9 +2689,9 @@ def generate_post_survey_html_content(config, quit_redirection_link, finish_redi
     </script>
     <script src="''' + js_link + '''"></script>
 </body>
-</html>'''
+</html>''')
     
-    return html
+    return ''.join(parts)
 
 def format_consent_content(content):
     """Format consent content with proper HTML"""
@@ -2466,63 +2718,60 @@ def format_consent_content(content):
     
     return '\n'.join(formatted_lines)
 
-def generate_demographics_section(config):
+def generate_demographics_section(config, section_id=None):
     """Generate demographics section HTML"""
-    html = f'''
+    parts = [f'''
         <!-- Demographics Section -->
         <div class="survey-section" id="demographics-section">
             <div class="survey-section-title">{config.get('title', 'Demographics')}</div>
-'''
+''']
     
     fields = config.get('fields', {})
     
     if fields.get('age', {}).get('enabled', False):
         age_config = fields['age']
         age_name = sanitize_column_label(age_config.get('column_label') or age_config.get('columnLabel'), 'age')
-        html += f'''
+        parts.append(f'''
             <label for="demographics-age">Age:</label>
             <input type="number" id="demographics-age" name="{age_name}" min="{age_config.get('min', 18)}" max="{age_config.get('max', 99)}" required><br><br>
-'''
+''')
     
     if fields.get('gender', {}).get('enabled', False):
         gender_config = fields['gender']
         gender_name = sanitize_column_label(gender_config.get('column_label') or gender_config.get('columnLabel'), 'gender')
-        html += '''
+        parts.append('''
             <label for="demographics-gender">Gender:</label>
             <select id="demographics-gender" name="''' + gender_name + '''" required>
                 <option value="">Select...</option>
-'''
+''')
         for option in gender_config.get('options', ['Female', 'Male', 'Other', 'Prefer not to say']):
-            html += f'                <option value="{option.lower().replace(" ", "_")}">{option}</option>\n'
+            parts.append(f'                <option value="{option.lower().replace(" ", "_")}">{option}</option>\n')
         
-        html += '            </select><br><br>\n'
+        parts.append('            </select><br><br>\n')
     
-    html += '        </div>\n'
-    return html
+    parts.append('        </div>\n')
+    return SurveyFragment(''.join(parts))
 
-def generate_likert_section(config, randomize_items=False):
-    """Generate Likert scale section HTML"""
-    html = f'''
+def generate_likert_section(config, section_id=None):
+    """Generate Likert scale section HTML, one row per item so they can be shuffled"""
+    head = [f'''
         <!-- Likert Scale Section -->
         <div class="survey-section" id="likert-scale-section">
             <div class="survey-section-title">{config.get('title', 'Likert Scale Items')}</div>
             <table class="survey-likert-table">
                 <tr>
                     <th>Statement</th>
-'''
+''']
     
     scale_labels = config.get('scaleLabels', 'Strongly Disagree,Disagree,Neutral,Agree,Strongly Agree').split(',')
     for label in scale_labels:
-        html += f'                    <th>{label.strip()}</th>\n'
-    
-    html += '                </tr>\n'
+        head.append(f'                    <th>{label.strip()}</th>\n')
     
-    items = config.get('items', [])
-    if randomize_items and items:
-        items = items.copy() 
-        random.shuffle(items)
+    head.append('                </tr>\n')
     
-    for i, item in enumerate(items):
+    # Field names follow the item's position in the config, so they stay the same when rows are shuffled
+    rows = []
+    for i, item in enumerate(config.get('items', [])):
         if isinstance(item, dict):
             statement = item.get('text') or item.get('statement') or item.get('item') or ''
             column_label = item.get('column_label') or item.get('columnLabel')
@@ -2531,57 +2780,53 @@ def generate_likert_section(config, randomize_items=False):
             column_label = None
 
         item_name = sanitize_column_label(column_label, f"likert_item_{i}")
-        html += f'''                <tr>
+        row = [f'''                <tr>
                     <td>{statement}</td>
-'''
+''']
         for j, _ in enumerate(scale_labels):
             required = 'required' if j == 0 else ''
-            html += f'                    <td><input type="radio" name="{item_name}" value="{j+1}" {required}></td>\n'
-        html += '                </tr>\n'
+            row.append(f'                    <td><input type="radio" name="{item_name}" value="{j+1}" {required}></td>\n')
+        row.append('                </tr>\n')
+        rows.append(''.join(row))
     
-    html += '''            </table>
+    tail = '''            </table>
         </div>
     '''
-    return html
+    return SurveyFragment(''.join(head), tuple(rows), tail, shuffle=True)
 
-def generate_freetext_section(config, randomize_items=False):
-    """Generate free text section HTML"""
-    html = f'''
+def generate_freetext_section(config, section_id=None):
+    """Generate free text section HTML, one row per question so they can be shuffled"""
+    head = f'''
         <!-- Free Form Text Section -->
         <div class="survey-section" id="free-form-text-section">
             <div class="survey-section-title">{config.get('title', 'Free Form Text')}</div>
 '''
     
-    questions = config.get('questions', [])
-    if randomize_items and questions:
-        questions = questions.copy() 
-        random.shuffle(questions)
-    
-    for i, question_config in enumerate(questions):
+    rows = []
+    for i, question_config in enumerate(config.get('questions', [])):
         question = question_config.get('question', '')
-        rows = question_config.get('rows', 4)
+        textarea_rows = question_config.get('rows', 4)
         column_label = question_config.get('column_label') or question_config.get('columnLabel')
         field_name = sanitize_column_label(column_label, f"free_text_response_{i}")
         field_id = f"free-text-response-{i}"
         
-        html += f'''            <label for="{field_id}">{question}</label><br>
-            <textarea id="{field_id}" name="{field_name}" rows="{rows}" cols="50" required></textarea><br><br>
-'''
+        rows.append(f'''            <label for="{field_id}">{question}</label><br>
+            <textarea id="{field_id}" name="{field_name}" rows="{textarea_rows}" cols="50" maxlength="{SURVEY_TEXT_MAX_CHARS}" required></textarea><br><br>
+''')
     
-    html += '        </div>\n'
-    return html
+    return SurveyFragment(head, tuple(rows), '        </div>\n', shuffle=True)
 
-def generate_custom_section(config):
+def generate_custom_section(config, section_id=None):
     """Generate custom section HTML"""
-    html = f'''
+    parts = [f'''
         <!-- Custom Section -->
         <div class="survey-section" id="custom-section">
             <div class="survey-section-title">{config.get('title', 'Custom Section')}</div>
-'''
+''']
     
     description = config.get('description', '')
     if description:
-        html += f'            <div class="survey-section-description">{description}</div>\n'
+        parts.append(f'            <div class="survey-section-description">{description}</div>\n')
     
     fields = config.get('fields', [])
     for i, field_config in enumerate(fields):
@@ -2593,38 +2838,38 @@ def generate_custom_section(config):
         field_required = field_config.get('required', False)
         required_attr = 'required' if field_required else ''
         
-        html += f'            <label for="{field_id}">{field_label}</label><br>\n'
+        parts.append(f'            <label for="{field_id}">{field_label}</label><br>\n')
         
         if field_type == 'textarea':
-            html += f'            <textarea id="{field_id}" name="{field_name}" rows="4" {required_attr}></textarea><br><br>\n'
+            parts.append(f'            <textarea id="{field_id}" name="{field_name}" rows="4" maxlength="{SURVEY_TEXT_MAX_CHARS}" {required_attr}></textarea><br><br>\n')
         elif field_type == 'select':
-            html += f'            <select id="{field_id}" name="{field_name}" {required_attr}>\n'
+            parts.append(f'            <select id="{field_id}" name="{field_name}" {required_attr}>\n')
             for option in field_options.split(','):
                 option = option.strip()
                 if option:
-                    html += f'                <option value="{option}">{option}</option>\n'
-            html += '            </select><br><br>\n'
+                    parts.append(f'                <option value="{option}">{option}</option>\n')
+            parts.append('            </select><br><br>\n')
         elif field_type == 'radio':
             for j, option in enumerate(field_options.split(',')):
                 option = option.strip()
                 if option:
                     radio_id = f"{field_id}-{j}"
-                    html += f'            <input type="radio" id="{radio_id}" name="{field_name}" value="{option}" {required_attr}>\n'
-                    html += f'            <label for="{radio_id}">{option}</label><br>\n'
-            html += '<br>\n'
+                    parts.append(f'            <input type="radio" id="{radio_id}" name="{field_name}" value="{option}" {required_attr}>\n')
+                    parts.append(f'            <label for="{radio_id}">{option}</label><br>\n')
+            parts.append('<br>\n')
         elif field_type == 'checkbox':
             for j, option in enumerate(field_options.split(',')):
                 option = option.strip()
                 if option:
                     checkbox_id = f"{field_id}-{j}"
-                    html += f'            <input type="checkbox" id="{checkbox_id}" name="{field_name}[]" value="{option}">\n'
-                    html += f'            <label for="{checkbox_id}">{option}</label><br>\n'
-            html += '<br>\n'
+                    parts.append(f'            <input type="checkbox" id="{checkbox_id}" name="{field_name}[]" value="{option}">\n')
+                    parts.append(f'            <label for="{checkbox_id}">{option}</label><br>\n')
+            parts.append('<br>\n')
         else:
-            html += f'            <input type="{field_type}" id="{field_id}" name="{field_name}" {required_attr}><br><br>\n'
+            parts.append(f'            <input type="{field_type}" id="{field_id}" name="{field_name}" {required_attr}><br><br>\n')
     
-    html += '        </div>\n'
-    return html
+    parts.append('        </div>\n')
+    return SurveyFragment(''.join(parts))
 
 def generate_checkbox_section(config, section_id):
     """Generate checkbox section HTML"""
@@ -2635,21 +2880,21 @@ def generate_checkbox_section(config, section_id):
     
     column_label = sanitize_column_label(config.get('column_label') or config.get('columnLabel'), f"{section_id}_response")
 
-    html = f'''
+    parts = [f'''
         <!-- Checkbox Section -->
         <div class="survey-section" id="{section_id}">
             <div class="survey-section-title">{title}</div>
             <div class="survey-section-description">{question}</div>
-'''
+''']
     
     for i, option in enumerate(options):
         checkbox_id = f"{section_id}_option_{i}"
-        html += f'''            <input type="checkbox" id="{checkbox_id}" name="{column_label}[]" value="{option}">
+        parts.append(f'''            <input type="checkbox" id="{checkbox_id}" name="{column_label}[]" value="{option}">
             <label for="{checkbox_id}">{option}</label><br>
-'''
+''')
     
-    html += '        </div>\n'
-    return html
+    parts.append('        </div>\n')
+    return SurveyFragment(''.join(parts))
 
 def generate_dropdown_section(config, section_id):
     """Generate dropdown section HTML"""
@@ -2661,22 +2906,22 @@ def generate_dropdown_section(config, section_id):
     required_attr = 'required' if required else ''
     
     column_label = sanitize_column_label(config.get('column_label') or config.get('columnLabel'), f"{section_id}_response")
-    html = f'''
+    parts = [f'''
         <!-- Dropdown Section -->
         <div class="survey-section" id="{section_id}">
             <div class="survey-section-title">{title}</div>
             <label for="{section_id}_select">{question}</label><br>
             <select id="{section_id}_select" name="{column_label}" {required_attr}>
                 <option value="">Select an option...</option>
-'''
+''']
     
     for option in options:
-        html += f'                <option value="{option}">{option}</option>\n'
+        parts.append(f'                <option value="{option}">{option}</option>\n')
     
-    html += '''            </select><br><br>
+    parts.append('''            </select><br><br>
         </div>
-'''
-    return html
+''')
+    return SurveyFragment(''.join(parts))
 
 def generate_slider_section(config, section_id):
     """Generate slider section HTML"""
@@ -2688,20 +2933,20 @@ def generate_slider_section(config, section_id):
     required_attr = 'required' if required else ''
     column_label = sanitize_column_label(config.get('column_label') or config.get('columnLabel'), f"{section_id}_response")
     
-    html = f'''
+    parts = [f'''
         <!-- Slider Section -->
         <div class="survey-section" id="{section_id}">
             <div class="survey-section-title">{title}</div>
             <label for="{section_id}_slider">{question}</label><br>
             <div class="slider-container">
-'''
+''']
     
     if slider_type == 'numeric':
         min_val = config.get('min_value', 0)
         max_val = config.get('max_value', 100)
         default_val = config.get('default_value', int((min_val + max_val) / 2))
         
-        html += f'''                <div class="slider-labels">
+        parts.append(f'''                <div class="slider-labels">
                     <span class="slider-min">{min_val}</span>
                     <span class="slider-max">{max_val}</span>
                 </div>
@@ -2718,14 +2963,14 @@ def generate_slider_section(config, section_id):
                         updateNextButton();
                     }}
                 </script>
-'''
+''')
     else:
         left_label = config.get('left_label', 'Strongly Disagree')
         right_label = config.get('right_label', 'Strongly Agree')
         steps = config.get('steps', 7)
         default_val = config.get('default_value', int(steps / 2))
         
-        html += f'''                <div class="slider-labels">
+        parts.append(f'''                <div class="slider-labels">
                     <span class="slider-min">{left_label}</span>
                     <span class="slider-max">{right_label}</span>
                 </div>
@@ -2742,12 +2987,12 @@ def generate_slider_section(config, section_id):
                         updateNextButton();
                     }}
                 </script>
-'''
+''')
     
-    html += '''            </div>
+    parts.append('''            </div>
         </div>
-'''
-    return html
+''')
+    return SurveyFragment(''.join(parts))
 
 def generate_image_section(config, section_id):
     """Generate image display section HTML"""
@@ -2766,22 +3011,22 @@ def generate_image_section(config, section_id):
         'full': 'image-full'
     }.get(display_size, 'image-medium')
     
-    html = f'''
+    parts = [f'''
         <!-- Image Section -->
         <div class="survey-section" id="{section_id}-section">
             <div class="survey-section-title">{title}</div>
-'''
+''']
     
     if description:
-        html += f'            <div class="section-description">{description}</div>\n'
+        parts.append(f'            <div class="section-description">{description}</div>\n')
     
     if file_path:
-        html += f'''            <div class="image-display {alignment}">
+        parts.append(f'''            <div class="image-display {alignment}">
                 <img src="{file_path}" alt="{alt_text}" class="{size_class}">
             </div>
-'''
+''')
     else:
-        html += '            <div class="image-placeholder">Image will be displayed here</div>\n'
+        parts.append('            <div class="image-placeholder">Image will be displayed here</div>\n')
     
     if require_response:
         response_type = config.get('response_type', 'rating')
@@ -2793,39 +3038,52 @@ def generate_image_section(config, section_id):
         if response_type == 'rating':
             question = config.get('rating_question', 'How would you rate this image?')
             scale = config.get('rating_scale', 10)
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label for="{section_id}_rating">{question}</label>
                 <select id="{section_id}_rating" name="{response_column_label}" required>
                     <option value="">Select rating...</option>
-'''
+''')
             for i in range(1, scale + 1):
-                html += f'                    <option value="{i}">{i}</option>\n'
-            html += '                </select>\n            </div>\n'
+                parts.append(f'                    <option value="{i}">{i}</option>\n')
+            parts.append('                </select>\n            </div>\n')
             
         elif response_type == 'text':
             question = config.get('text_question', 'What are your thoughts about this image?')
             rows = config.get('text_rows', 4)
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label for="{section_id}_text">{question}</label>
-                <textarea id="{section_id}_text" name="{response_column_label}" rows="{rows}" required></textarea>
+                <textarea id="{section_id}_text" name="{response_column_label}" rows="{rows}" maxlength="{SURVEY_TEXT_MAX_CHARS}" required></textarea>
             </div>
-'''
+''')
         elif response_type == 'checkbox':
             question = config.get('checkbox_question', 'Select all that apply to this image:')
             options = config.get('checkbox_options', [])
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label>{question}</label>
-'''
+''')
             for i, option in enumerate(options):
-                html += f'''                <div class="checkbox-option">
+                parts.append(f'''                <div class="checkbox-option">
                     <input type="checkbox" id="{section_id}_checkbox_{i}" name="{response_column_label}[]" value="{option}">
                     <label for="{section_id}_checkbox_{i}">{option}</label>
                 </div>
-'''
-            html += '            </div>\n'
-    
-    html += '        </div>\n'
-    return html
+''')
+            parts.append('            </div>\n')
+    
+    parts.append('        </div>\n')
+    return SurveyFragment(''.join(parts))
+
+def video_embed_url(video_url):
+    """Player URL for a YouTube or Vimeo link, or None for a direct video file"""
+    parsed = urlparse(video_url)
+    host = parsed.netloc.lower()
+    path_parts = [part for part in parsed.path.split('/') if part]
+    if 'youtube.com' in host or 'youtu.be' in host:
+        # youtube.com/watch?v=ID, youtu.be/ID, youtube.com/embed/ID and youtube.com/shorts/ID
+        video_id = parse_qs(parsed.query).get('v', [None])[0] or (path_parts[-1] if path_parts else '')
+        return f"https://www.youtube.com/embed/{video_id}"
+    if 'vimeo.com' in host:
+        return f"https://player.vimeo.com/video/{path_parts[-1] if path_parts else ''}"
+    return None
 
 def generate_video_section(config, section_id):
     """Generate video display section HTML"""
@@ -2846,48 +3104,40 @@ def generate_video_section(config, section_id):
         'responsive': 'width="100%" height="auto"'
     }.get(video_size, 'width="640" height="480"')
     
-    html = f'''
+    parts = [f'''
         <!-- Video Section -->
         <div class="survey-section" id="{section_id}-section">
             <div class="survey-section-title">{title}</div>
-'''
+''']
     
     if description:
-        html += f'            <div class="section-description">{description}</div>\n'
-    # this external video stuff needs to be fixed i think
+        parts.append(f'            <div class="section-description">{description}</div>\n')
     if video_url:
-        if 'youtube.com' in video_url or 'youtu.be' in video_url:
-            video_id = video_url.split('/')[-1].split('?')[0].replace('watch?v=', '')
-            html += f'''            <div class="video-display">
-                <iframe {size_attrs} src="https://www.youtube.com/embed/{video_id}" 
-                        frameborder="0" allowfullscreen></iframe>
-            </div>
-'''
-        elif 'vimeo.com' in video_url:
-            video_id = video_url.split('/')[-1]
-            html += f'''            <div class="video-display">
-                <iframe {size_attrs} src="https://player.vimeo.com/video/{video_id}" 
+        embed_url = video_embed_url(video_url)
+        if embed_url:
+            parts.append(f'''            <div class="video-display">
+                <iframe {size_attrs} src="{embed_url}" 
                         frameborder="0" allowfullscreen></iframe>
             </div>
-'''
+''')
         else:
-            html += f'''            <div class="video-display">
+            parts.append(f'''            <div class="video-display">
                 <video {size_attrs} {"controls" if controls else ""} {"autoplay" if autoplay else ""} {"loop" if loop else ""}>
                     <source src="{video_url}" type="video/mp4">
                     Your browser does not support the video tag.
                 </video>
             </div>
-'''
+''')
     elif file_path:
-        html += f'''            <div class="video-display">
+        parts.append(f'''            <div class="video-display">
                 <video {size_attrs} {"controls" if controls else ""} {"autoplay" if autoplay else ""} {"loop" if loop else ""}>
                     <source src="{file_path}" type="video/mp4">
                     Your browser does not support the video tag.
                 </video>
             </div>
-'''
+''')
     else:
-        html += '            <div class="video-placeholder">Video will be displayed here</div>\n'
+        parts.append('            <div class="video-placeholder">Video will be displayed here</div>\n')
     
     if require_response:
         response_type = config.get('response_type', 'rating')
@@ -2899,39 +3149,39 @@ def generate_video_section(config, section_id):
         if response_type == 'rating':
             question = config.get('rating_question', 'How would you rate this video?')
             scale = config.get('rating_scale', 10)
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label for="{section_id}_rating">{question}</label>
                 <select id="{section_id}_rating" name="{response_column_label}" required>
                     <option value="">Select rating...</option>
-'''
+''')
             for i in range(1, scale + 1):
-                html += f'                    <option value="{i}">{i}</option>\n'
-            html += '                </select>\n            </div>\n'
+                parts.append(f'                    <option value="{i}">{i}</option>\n')
+            parts.append('                </select>\n            </div>\n')
             
         elif response_type == 'text':
             question = config.get('text_question', 'What are your thoughts about this video?')
             rows = config.get('text_rows', 4)
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label for="{section_id}_text">{question}</label>
-                <textarea id="{section_id}_text" name="{response_column_label}" rows="{rows}" required></textarea>
+                <textarea id="{section_id}_text" name="{response_column_label}" rows="{rows}" maxlength="{SURVEY_TEXT_MAX_CHARS}" required></textarea>
             </div>
-'''
+''')
         elif response_type == 'checkbox':
             question = config.get('checkbox_question', 'Select all that apply to this video:')
             options = config.get('checkbox_options', [])
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label>{question}</label>
-'''
+''')
             for i, option in enumerate(options):
-                html += f'''                <div class="checkbox-option">
+                parts.append(f'''                <div class="checkbox-option">
                     <input type="checkbox" id="{section_id}_checkbox_{i}" name="{response_column_label}[]" value="{option}">
                     <label for="{section_id}_checkbox_{i}">{option}</label>
                 </div>
-'''
-            html += '            </div>\n'
+''')
+            parts.append('            </div>\n')
     
-    html += '        </div>\n'
-    return html
+    parts.append('        </div>\n')
+    return SurveyFragment(''.join(parts))
 
 def generate_pdf_section(config, section_id):
     """Generate PDF display section HTML"""
@@ -2944,34 +3194,34 @@ def generate_pdf_section(config, section_id):
     require_view = config.get('require_view', False)
     require_response = config.get('require_response', False)
     
-    html = f'''
+    parts = [f'''
         <!-- PDF Section -->
         <div class="survey-section" id="{section_id}-section">
             <div class="survey-section-title">{title}</div>
-'''
+''']
     
     if description:
-        html += f'            <div class="section-description">{description}</div>\n'
+        parts.append(f'            <div class="section-description">{description}</div>\n')
     
     if file_path:
         if display_mode in ['embed', 'both']:
             height_attr = f'height="{display_height}px"' if display_height != 'auto' else 'style="height: auto;"'
-            html += f'''            <div class="pdf-display">
+            parts.append(f'''            <div class="pdf-display">
                 <iframe src="{file_path}" width="100%" {height_attr} 
                         frameborder="0">
                     <p>Your browser does not support PDFs. 
                     <a href="{file_path}" target="_blank">Download the PDF</a>.</p>
                 </iframe>
             </div>
-'''
+''')
         
         if display_mode in ['link', 'both'] or allow_download:
-            html += f'''            <div class="pdf-download">
+            parts.append(f'''            <div class="pdf-download">
                 <a href="{file_path}" target="_blank" class="download-link">Download PDF</a>
             </div>
-'''
+''')
     else:
-        html += '            <div class="pdf-placeholder">PDF will be displayed here</div>\n'
+        parts.append('            <div class="pdf-placeholder">PDF will be displayed here</div>\n')
     
     if require_response:
         response_type = config.get('response_type', 'confirmation')
@@ -2982,49 +3232,70 @@ def generate_pdf_section(config, section_id):
         
         if response_type == 'confirmation':
             confirmation_text = config.get('confirmation_text', 'I have read and understood the document')
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <div class="checkbox-option">
                     <input type="checkbox" id="{section_id}_confirmation" name="{response_column_label}" value="confirmed" required>
                     <label for="{section_id}_confirmation">{confirmation_text}</label>
                 </div>
             </div>
-'''
+''')
         elif response_type == 'rating':
             question = config.get('rating_question', 'How would you rate this document?')
             scale = config.get('rating_scale', 10)
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label for="{section_id}_rating">{question}</label>
                 <select id="{section_id}_rating" name="{response_column_label}" required>
                     <option value="">Select rating...</option>
-'''
+''')
             for i in range(1, scale + 1):
-                html += f'                    <option value="{i}">{i}</option>\n'
-            html += '                </select>\n            </div>\n'
+                parts.append(f'                    <option value="{i}">{i}</option>\n')
+            parts.append('                </select>\n            </div>\n')
             
         elif response_type == 'text':
             question = config.get('text_question', 'What are your thoughts about this document?')
             rows = config.get('text_rows', 4)
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label for="{section_id}_text">{question}</label>
-                <textarea id="{section_id}_text" name="{response_column_label}" rows="{rows}" required></textarea>
+                <textarea id="{section_id}_text" name="{response_column_label}" rows="{rows}" maxlength="{SURVEY_TEXT_MAX_CHARS}" required></textarea>
             </div>
-'''
+''')
         elif response_type == 'checkbox':
             question = config.get('checkbox_question', 'Select all that apply to this document:')
             options = config.get('checkbox_options', [])
-            html += f'''            <div class="response-section">
+            parts.append(f'''            <div class="response-section">
                 <label>{question}</label>
-'''
+''')
             for i, option in enumerate(options):
-                html += f'''                <div class="checkbox-option">
+                parts.append(f'''                <div class="checkbox-option">
                     <input type="checkbox" id="{section_id}_checkbox_{i}" name="{response_column_label}[]" value="{option}">
                     <label for="{section_id}_checkbox_{i}">{option}</label>
                 </div>
-'''
-            html += '            </div>\n'
-    
-    html += '        </div>\n'
-    return html
+''')
+            parts.append('            </div>\n')
+    
+    parts.append('        </div>\n')
+    return SurveyFragment(''.join(parts))
+
+# Section generators by type. Each compiles a section config into a SurveyFragment.
+SURVEY_SECTION_GENERATORS = {
+    'demographics': generate_demographics_section,
+    'likert': generate_likert_section,
+    'freetext': generate_freetext_section,
+    'checkbox': generate_checkbox_section,
+    'dropdown': generate_dropdown_section,
+    'slider': generate_slider_section,
+    'image': generate_image_section,
+    'video': generate_video_section,
+    'pdf': generate_pdf_section,
+    'custom': generate_custom_section,
+}
+
+def render_survey_sections(parts, config):
+    """Append the enabled sections of a survey config to parts, using the cached fragments"""
+    model = survey_model(config)
+    for section in model.sections:
+        generator = SURVEY_SECTION_GENERATORS[section.section_type]
+        compiled_section(generator, section.section_type, section.section_id, section.config).render_into(parts, model.randomize_items)
 
 # Branding Configuration Routes
 @app.route('/get-branding-settings', methods=['GET'])
@@ -3139,6 +3410,11 @@ if __name__ == '__main__':
     init_default_url_settings()  
     init_default_branding_settings() 
     
+    # The reloader runs this block in the watcher and in the serving process; warm up only in the latter.
+    # Under gunicorn, on_starting in gunicorn.conf.py does it.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up_agent_audio()
+
     port = int(os.environ.get('PORT', 5000))
     print(f"Starting Flask app on port {port}")
     app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
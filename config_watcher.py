@@ -0,0 +1,244 @@
+# Watches the agent JSON files and data/survey_config.json for changes.
+# Each watched "topic" has a generation counter that goes up whenever one of its files changes,
+# whether the change came from a dashboard route or from someone editing the file by hand.
+# In-memory config caches store the version they were filled at and reload when it moves on,
+# so hot request paths don't need to stat or re-read files.
+#
+# version() is only meaningful inside one worker. fingerprint() hashes the files themselves, so it is
+# the same in every worker and across restarts, which is what an ETag needs.
+#
+# Uses Linux inotify (through ctypes) when available, otherwise polls file mtimes.
+# Every gunicorn worker runs its own watcher thread, started on first use after the fork.
+#
+# Settings (.env):
+#   CONFIG_WATCH_MODE=auto     auto (inotify, falling back to polling) or poll
+#   CONFIG_POLL_SECONDS=2      how often polling checks the files
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import struct
+import threading
+import uuid
+
+CONFIG_WATCH_MODE = os.environ.get('CONFIG_WATCH_MODE', 'auto').lower()
+CONFIG_POLL_SECONDS = float(os.environ.get('CONFIG_POLL_SECONDS', 2))
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """Minimal ctypes wrapper around the inotify syscalls"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        return wd
+
+    def read_events(self, timeout):
+        """Yield (wd, mask, name) for events that arrive within timeout seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0').decode(errors='replace')
+            offset += name_length
+            yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher:
+    def __init__(self):
+        self._rules = []
+        self._generations = {}
+        self._fingerprints = {}  # topic -> (generation, digest)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.mode = None
+
+    def watch(self, directory, topic, match):
+        """Bump topic whenever a file in directory for which match(filename) is true changes"""
+        self._rules.append((os.path.abspath(directory), topic, match))
+        self._generations.setdefault(topic, 0)
+
+    def version(self, topic):
+        """Opaque token that changes whenever a file of this topic changes.
+
+        It includes a per-process id, so tokens from different workers (or from before a
+        restart) never compare equal. Use fingerprint() for anything sent to clients.
+        """
+        self._ensure_started()
+        return f'{self._instance}:{self._generations.get(topic, 0)}'
+
+    def fingerprint(self, topic):
+        """Hash of the names and contents of a topic's files, the same in every worker.
+        It is only recomputed when the topic's version changes."""
+        self._ensure_started()
+        generation = self._generations.get(topic, 0)
+        cached = self._fingerprints.get(topic)
+        if cached and cached[0] == generation:
+            return cached[1]
+        digest = hashlib.sha1()
+        for directory, rule_topic, match in self._rules:
+            if rule_topic != topic:
+                continue
+            try:
+                names = sorted(name for name in os.listdir(directory) if match(name))
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                try:
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        content = f.read()
+                except OSError:
+                    continue
+                digest.update(name.encode() + b'\0' + hashlib.sha1(content).digest())
+        self._fingerprints[topic] = (generation, digest.hexdigest())
+        return self._fingerprints[topic][1]
+
+    def bump(self, topic):
+        """Mark a topic as changed. Call this after the app itself writes one of its files,
+        so this worker sees the change straight away rather than when the event arrives."""
+        with self._lock:
+            self._generations[topic] = self._generations.get(topic, 0) + 1
+
+    def status(self):
+        self._ensure_started()
+        return {'mode': self.mode, 'generations': dict(self._generations)}
+
+    def _topics_for(self, directory, name):
+        return {topic for rule_directory, topic, match in self._rules
+                if rule_directory == directory and (name is None or match(name))}
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so each gunicorn worker starts its own watcher
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._instance = uuid.uuid4().hex[:8]
+            self._stop.clear()
+            for directory in {rule[0] for rule in self._rules}:
+                os.makedirs(directory, exist_ok=True)
+
+            self.mode = 'poll'
+            if CONFIG_WATCH_MODE == 'poll':
+                # The files as they are now, so a change made before the thread's first poll counts
+                snapshot = self._scan()
+                target = lambda: self._run_polling(snapshot)
+            else:
+                try:
+                    inotify = _Inotify()
+                    watches = {inotify.add_watch(directory): directory for directory in {rule[0] for rule in self._rules}}
+                    target = lambda: self._run_inotify(inotify, watches)
+                    self.mode = 'inotify'
+                except OSError as e:
+                    print(f"Config watcher: inotify unavailable ({e}), polling every {CONFIG_POLL_SECONDS}s instead")
+                    snapshot = self._scan()
+                    target = lambda: self._run_polling(snapshot)
+
+            self._thread = threading.Thread(target=target, name='config-watcher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _bump_all(self, topics):
+        with self._lock:
+            for topic in topics:
+                self._generations[topic] = self._generations.get(topic, 0) + 1
+
+    def _run_inotify(self, inotify, watches):
+        try:
+            while not self._stop.is_set():
+                for wd, mask, name in inotify.read_events(1.0):
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were dropped, so assume everything changed
+                        self._bump_all(set(self._generations))
+                        continue
+                    directory = watches.get(wd)
+                    if directory is None:
+                        continue
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        self._bump_all(self._topics_for(directory, None))
+                    elif name:
+                        self._bump_all(self._topics_for(directory, name))
+        except Exception as e:
+            # Never leave caches trusting a dead watcher
+            print(f"Config watcher: inotify failed ({e}), switching to polling")
+            self.mode = 'poll'
+            self._bump_all(set(self._generations))
+            self._run_polling()
+        finally:
+            inotify.close()
+
+    def _scan(self):
+        snapshot = {}
+        for directory, topic, match in self._rules:
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if not match(name):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                snapshot[(topic, name)] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _run_polling(self, previous=None):
+        if previous is None:
+            previous = self._scan()
+        while not self._stop.wait(CONFIG_POLL_SECONDS):
+            current = self._scan()
+            changed = {topic for (topic, name) in set(previous) | set(current)
+                       if previous.get((topic, name)) != current.get((topic, name))}
+            if changed:
+                self._bump_all(changed)
+            previous = current
+
+    def stop(self):
+        self._stop.set()
+
+
+config_watcher = ConfigWatcher()
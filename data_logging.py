@@ -0,0 +1,568 @@
+# Write-behind queue for the study data logs in data/ (interactions, surveys, popups, visitors, downloads).
+#
+# Request handlers call data_log.submit(kind, record) and return straight away. A writer thread in
+# each worker takes records off a bounded queue and commits them in batches: every data file a
+# batch touches is rewritten or appended once and fsynced before the batch counts as committed.
+#
+# No record is lost if a worker crashes. submit() first appends the record to a per-worker journal
+# in data/.log_journal and fsyncs it (so it survives a power cut too), and the writer marks it done
+# after the commit. Journals of workers that
+# are no longer running (their file lock is free) are replayed when the next worker starts logging.
+# A crash between the commit and the done mark replays that batch, so records are written at least
+# once. Queued records are drained when the worker exits (atexit and gunicorn's worker_exit hook).
+#
+# If the queue is full the request tries once to write its record itself rather than dropping it. If
+# that fails too, the record (still in the journal) is put aside for the writer thread, which tries
+# it again before its next batch, so the request never waits through the retries.
+#
+# A batch that fails to write is retried DATA_LOG_MAX_RETRIES times, then record by record. Records
+# that still fail are moved to data/data_log_quarantine.jsonl with the error, so one bad record (or a
+# broken writer) doesn't stall the queue for everyone else. Fix the cause and re-submit them from there.
+#
+# With several gunicorn workers, set LOG_AGGREGATOR_SOCKET to hand batches to the log aggregator
+# process (log_aggregator.py) instead, which is then the only writer of data/. A batch only counts as
+# committed once the aggregator has it on disk. If the aggregator can't be reached, the worker writes
+# the batch itself under the data/ file lock, so nothing waits on it. A batch the aggregator received
+# but didn't confirm in time is never written by the worker (the aggregator may still write it). It is
+# sent again with the same batch id instead, and the aggregator answers for a batch it already has
+# rather than writing it twice. A batch that still times out after its retries is put aside for the
+# writer thread with its batch id, not split or quarantined. When a failing batch is split, record n
+# is sent as "<batch id>:<n>", which the aggregator skips if it did write the whole batch.
+#
+# Settings (.env):
+#   DATA_LOG_MODE=async            async (writer thread) or sync (write during the request, old behaviour)
+#   DATA_LOG_QUEUE_SIZE=1000       records waiting to be written before backpressure kicks in
+#   DATA_LOG_BATCH_SIZE=100        most records committed in one batch
+#   DATA_LOG_ENQUEUE_TIMEOUT=2     seconds a request waits for queue space before writing itself
+#   DATA_LOG_MAX_RETRIES=5         retries of a failing batch (0.5s, 1s, 2s ... apart) before quarantining it
+#   LOG_AGGREGATOR_SOCKET=         Unix socket of the log aggregator, e.g. /tmp/chatpsych-log.sock
+#   LOG_AGGREGATOR_TIMEOUT=10      seconds to wait for the aggregator to confirm a batch
+
+import atexit
+import collections
+import csv
+import fcntl
+import glob
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+DATA_LOG_MODE = os.environ.get('DATA_LOG_MODE', 'async').lower()
+DATA_LOG_QUEUE_SIZE = int(os.environ.get('DATA_LOG_QUEUE_SIZE', 1000))
+DATA_LOG_BATCH_SIZE = int(os.environ.get('DATA_LOG_BATCH_SIZE', 100))
+DATA_LOG_ENQUEUE_TIMEOUT = float(os.environ.get('DATA_LOG_ENQUEUE_TIMEOUT', 2))
+DATA_LOG_MAX_RETRIES = int(os.environ.get('DATA_LOG_MAX_RETRIES', 5))
+# First wait before retrying a failed batch, doubled each time
+DATA_LOG_RETRY_DELAY = 0.5
+LOG_AGGREGATOR_SOCKET = os.environ.get('LOG_AGGREGATOR_SOCKET', '')
+LOG_AGGREGATOR_TIMEOUT = float(os.environ.get('LOG_AGGREGATOR_TIMEOUT', 10))
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+JOURNAL_DIR = os.path.join(DATA_DIR, '.log_journal')
+# Held while a batch is written, so workers don't interleave read-modify-write of the same JSON file
+WRITE_LOCK_PATH = os.path.join(DATA_DIR, '.data_log.lock')
+QUARANTINE_PATH = os.path.join(DATA_DIR, 'data_log_quarantine.jsonl')
+
+# Only the log aggregator turns these on (enable_write_caches). As the single writer it can keep the
+# JSON documents in memory and the CSV files open instead of re-reading/re-opening them every batch.
+# Entries are checked against the file on disk, so an edit or a worker's fallback write is picked up.
+_documents = None  # path -> ((mtime_ns, size, inode), parsed JSON)
+_append_files = None  # path -> open file
+
+
+def enable_write_caches():
+    global _documents, _append_files
+    _documents, _append_files = {}, {}
+
+
+def _drop_write_caches():
+    # After a failed batch the cached documents may hold half-applied records
+    if _documents is not None:
+        _documents.clear()
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_json(path, default):
+    """Load a JSON data file, or return default if it is missing or empty"""
+    if _documents is not None and path in _documents:
+        signature, document = _documents[path]
+        try:
+            if _file_signature(path) == signature:
+                return document
+        except FileNotFoundError:
+            pass
+        del _documents[path]
+    try:
+        with open(path, 'r') as f:
+            content = f.read().strip()
+            return json.loads(content) if content else default
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def write_json(path, obj, indent=4):
+    """Replace a JSON data file durably: write a temp file, fsync it, then rename over the old one"""
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(obj, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    _fsync_directory(os.path.dirname(path) or '.')
+    if _documents is not None:
+        _documents[path] = (_file_signature(path), obj)
+
+
+def append_csv_rows(path, headers, rows):
+    """Append rows to a CSV data file (writing headers if it is new) and fsync it"""
+    with _open_for_append(path, newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if csvfile.tell() == 0:
+            writer.writerow(headers)
+        writer.writerows(rows)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+
+
+def append_lines(path, lines):
+    """Append text lines to a log file and fsync it"""
+    with _open_for_append(path) as f:
+        f.write(''.join(line + '\n' for line in lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@contextmanager
+def _open_for_append(path, newline=None):
+    if _append_files is None:
+        with open(path, 'a', newline=newline) as f:
+            yield f
+        return
+    f = _append_files.get(path)
+    try:
+        # Reopen if the file was deleted or replaced since it was opened
+        if f is not None and os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+            f.close()
+            f = None
+    except FileNotFoundError:
+        f.close()
+        f = None
+    if f is None:
+        f = open(path, 'a', newline=newline)
+        _append_files[path] = f
+    f.seek(0, os.SEEK_END)
+    yield f
+
+
+@contextmanager
+def _write_lock():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(WRITE_LOCK_PATH, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class _Journal:
+    """Append-only record of submitted and committed records for one worker"""
+
+    def __init__(self):
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        self.path = os.path.join(JOURNAL_DIR, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl')
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        _fsync_directory(JOURNAL_DIR)
+        # The lock tells other workers this journal is live, they only replay unlocked ones
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.pending = set()
+
+    def add(self, kind, record):
+        with self.lock:
+            self.sequence += 1
+            os.write(self.fd, (json.dumps({'seq': self.sequence, 'kind': kind, 'record': record}) + '\n').encode())
+            os.fsync(self.fd)
+            self.pending.add(self.sequence)
+            return self.sequence
+
+    def mark_done(self, sequences):
+        with self.lock:
+            self.pending.difference_update(sequences)
+            if not self.pending:
+                # Everything submitted so far is committed, start the journal afresh
+                os.ftruncate(self.fd, 0)
+            else:
+                os.write(self.fd, (json.dumps({'done': sorted(sequences)}) + '\n').encode())
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            empty = not self.pending
+            os.close(self.fd)
+            self.fd = None
+            if empty:
+                os.remove(self.path)
+
+
+def _read_journal(path):
+    """(kind, record) pairs in a journal that were never marked done"""
+    entries, done = {}, set()
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by the crash, the record was never acknowledged
+                continue
+            if 'done' in entry:
+                done.update(entry['done'])
+            else:
+                entries[entry['seq']] = (entry['kind'], entry['record'])
+    return [entries[seq] for seq in sorted(entries) if seq not in done]
+
+
+class AggregatorTimeout(Exception):
+    """The aggregator got the batch but didn't confirm it in time, so it may still be written"""
+
+
+class AggregatorClient:
+    """A worker's connection to the log aggregator. Sends one batch at a time and waits for the commit."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def send(self, records, batch_id):
+        """Send [(kind, record), ...] and return once the aggregator has written them.
+        Sending the same batch_id again never writes the records twice."""
+        with self._lock:
+            sent = False
+            try:
+                if self._sock is None:
+                    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._sock.settimeout(LOG_AGGREGATOR_TIMEOUT)
+                    self._sock.connect(self.socket_path)
+                    self._reader = self._sock.makefile('rb')
+                self._sock.sendall((json.dumps({'batch': batch_id, 'records': records}) + '\n').encode())
+                sent = True
+                line = self._reader.readline()
+                if not line:
+                    raise ConnectionError('log aggregator closed the connection')
+                reply = json.loads(line)
+            except socket.timeout as e:
+                self._disconnect()
+                if sent:
+                    raise AggregatorTimeout(f'no reply from the log aggregator within {LOG_AGGREGATOR_TIMEOUT}s') from e
+                raise
+            except (OSError, ValueError):
+                self._disconnect()
+                raise
+        if not reply.get('ok'):
+            raise RuntimeError(f"log aggregator failed to write the batch: {reply.get('error')}")
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = self._reader = None
+
+
+class DataLogQueue:
+    def __init__(self):
+        self._writers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._journal = None
+        self._thread = None
+        self._closed = False
+        # (batch id, batch) put aside to be written again by the writer thread, see submit
+        self._deferred = collections.deque()
+        self._aggregator = None
+        self._aggregator_warned_at = 0
+        self.committed = 0
+        self.recovered = 0
+        self.overflow_writes = 0
+        self.failed = 0
+        self.quarantined = 0
+        self.aggregator_fallbacks = 0
+        self.last_batch_ms = 0.0
+
+    def register(self, kind, write_batch):
+        """Register the function that writes a list of records of this kind to disk"""
+        self._writers[kind] = write_batch
+
+    def submit(self, kind, record):
+        """Queue a record to be written. Records must be plain JSON data, not request or session objects."""
+        if kind not in self._writers:
+            raise ValueError(f'No data log writer registered for {kind!r}')
+        if DATA_LOG_MODE == 'sync' or self._closed:
+            self._commit([(None, kind, record)])
+            return
+
+        self._ensure_started()
+        sequence = self._journal.add(kind, record)
+        try:
+            self._queue.put((sequence, kind, record), timeout=DATA_LOG_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            # Backpressure: the writer is behind, so this request writes its own record, once
+            self.overflow_writes += 1
+            batch_id = uuid.uuid4().hex
+            try:
+                self._commit([(sequence, kind, record)], batch_id)
+            except Exception as e:
+                self.failed += 1
+                print(f"Data log: failed to write a record ({e}), leaving it to the writer")
+                self._deferred.append((batch_id, [(sequence, kind, record)]))
+
+    def flush(self, timeout=10):
+        """Wait until everything queued so far is on disk (e.g. before a researcher downloads a file)"""
+        if self._queue is None or self._pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        while (self._queue.unfinished_tasks or self._deferred) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not (self._queue.unfinished_tasks or self._deferred)
+
+    def close(self, timeout=30):
+        """Write out everything still queued and stop the writer thread"""
+        with self._lock:
+            if self._pid != os.getpid() or self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._journal.close()
+
+    def status(self):
+        return {
+            'mode': DATA_LOG_MODE,
+            'queued': self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+            'capacity': DATA_LOG_QUEUE_SIZE,
+            'deferred': len(self._deferred),
+            'committed': self.committed,
+            'recovered': self.recovered,
+            'overflow_writes': self.overflow_writes,
+            'failed': self.failed,
+            'quarantined': self.quarantined,
+            'aggregator': LOG_AGGREGATOR_SOCKET or None,
+            'aggregator_fallbacks': self.aggregator_fallbacks,
+            'last_batch_ms': round(self.last_batch_ms, 2)
+        }
+
+    def prometheus_text(self):
+        status = self.status()
+        worker = os.getpid()
+        lines = []
+        for name, kind, help_text in (
+                ('queued', 'gauge', 'Data log records waiting to be written.'),
+                ('deferred', 'gauge', 'Data log batches put aside to be written again by the writer thread.'),
+                ('committed', 'counter', 'Data log records written to disk.'),
+                ('recovered', 'counter', 'Data log records replayed from the journal of a crashed worker.'),
+                ('overflow_writes', 'counter', 'Data log records written by the request because the queue was full.'),
+                ('failed', 'counter', 'Data log batches that failed to write and were retried.'),
+                ('quarantined', 'counter', 'Data log records moved to the quarantine file after repeated failures.'),
+                ('aggregator_fallbacks', 'counter', 'Data log batches written by the worker because the log aggregator was unreachable.')):
+            metric = f'chatpsych_data_log_{name}' + ('_total' if kind == 'counter' else '')
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}',
+                      f'{metric}{{worker="{worker}"}} {status[name]}']
+        return '\n'.join(lines) + '\n'
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so each gunicorn worker starts its own writer
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=DATA_LOG_QUEUE_SIZE)
+            self._journal = _Journal()
+            self._deferred = collections.deque()
+            self._aggregator = AggregatorClient(LOG_AGGREGATOR_SOCKET) if LOG_AGGREGATOR_SOCKET else None
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name='data-log-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+            self._pid = os.getpid()
+
+    def _recover(self):
+        """Replay records from journals left behind by workers that died"""
+        for path in glob.glob(os.path.join(JOURNAL_DIR, '*.jsonl')):
+            if path == self._journal.path:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # a live worker's journal
+                records = _read_journal(path)
+                if records:
+                    # If this times out the journal is replayed again later, and the aggregator
+                    # recognises the batch id
+                    self._commit([(None, kind, record) for kind, record in records],
+                                 batch_id=f'recovered-{os.path.basename(path)}')
+                    self.recovered += len(records)
+                    print(f"Data log: recovered {len(records)} unwritten records from {os.path.basename(path)}")
+                os.remove(path)
+            except Exception as e:
+                print(f"Data log: could not recover {path}: {e}")
+            finally:
+                os.close(fd)
+
+    def write_records(self, records):
+        """Write [(kind, record), ...] to the data files, one writer call per kind, in submission order"""
+        by_kind = {}
+        for kind, record in records:
+            by_kind.setdefault(kind, []).append(record)
+        with _write_lock():
+            try:
+                for kind, kind_records in by_kind.items():
+                    self._writers[kind](kind_records)
+            except Exception:
+                _drop_write_caches()
+                raise
+
+    def _commit(self, batch, batch_id=None):
+        """Write a batch of (sequence, kind, record), through the log aggregator if there is one.
+        Retries of a batch pass the same batch_id, so the aggregator writes it only once."""
+        started = time.perf_counter()
+        records = [(kind, record) for _, kind, record in batch]
+        aggregator = self._aggregator if self._pid == os.getpid() else None
+        try:
+            if aggregator is None:
+                self.write_records(records)
+            else:
+                aggregator.send(records, batch_id or uuid.uuid4().hex)
+        except (OSError, ValueError) as e:
+            if aggregator is None:
+                raise
+            # Aggregator down or restarting, the file lock still keeps this write safe
+            self.aggregator_fallbacks += 1
+            if time.monotonic() - self._aggregator_warned_at > 60:
+                self._aggregator_warned_at = time.monotonic()
+                print(f"Data log: log aggregator at {aggregator.socket_path} unavailable ({e}), writing directly")
+            self.write_records(records)
+        self.committed += len(batch)
+        self.last_batch_ms = (time.perf_counter() - started) * 1000
+        sequences = [sequence for sequence, _, _ in batch if sequence is not None]
+        if sequences and self._journal is not None and self._pid == os.getpid():
+            self._journal.mark_done(sequences)
+
+    def _run(self):
+        self._recover()
+        stopping = False
+        while not stopping:
+            # Batches put aside earlier go first, with their own batch ids
+            for _ in range(len(self._deferred)):
+                batch_id, batch = self._deferred.popleft()
+                self._commit_with_retry(batch, batch_id)
+            try:
+                # Wake up now and then while something is put aside
+                item = self._queue.get(timeout=DATA_LOG_RETRY_DELAY * 10 if self._deferred else None)
+            except queue.Empty:
+                continue
+            batch = []
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+            while len(batch) < DATA_LOG_BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+
+            if batch:
+                self._commit_with_retry(batch)
+            for _ in range(len(batch) + (1 if stopping else 0)):
+                self._queue.task_done()
+
+    def _commit_with_retry(self, batch, batch_id=None):
+        delay = DATA_LOG_RETRY_DELAY
+        batch_id = batch_id or uuid.uuid4().hex
+        for attempt in range(DATA_LOG_MAX_RETRIES + 1):
+            try:
+                self._commit(batch, batch_id)
+                return
+            except Exception as e:
+                self.failed += 1
+                error = e
+                if self._closed:
+                    # Shutting down, leave them in the journal for the next worker to replay
+                    print(f"Data log: failed to write {len(batch)} records ({e}), leaving them in the journal")
+                    return
+                if attempt < DATA_LOG_MAX_RETRIES:
+                    print(f"Data log: failed to write {len(batch)} records ({e}), retrying in {delay}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 30)
+
+        if isinstance(error, AggregatorTimeout):
+            # The aggregator may have written it after all, so it is sent again later under the same id
+            print(f"Data log: no reply from the log aggregator for {len(batch)} records, trying again later")
+            self._deferred.append((batch_id, batch))
+            return
+        # Find the records that can't be written, so the rest of the batch still gets in
+        failures = [(batch[0], error)] if len(batch) == 1 else []
+        if len(batch) > 1:
+            for number, item in enumerate(batch):
+                # Derived from the batch's id, so the aggregator knows it if the whole batch got written
+                part_id = f'{batch_id}:{number}'
+                try:
+                    self._commit([item], part_id)
+                except AggregatorTimeout:
+                    self._deferred.append((part_id, [item]))
+                except Exception as e:
+                    failures.append((item, e))
+        self._quarantine(failures)
+
+    def _quarantine(self, failures):
+        """Move records that keep failing out of the way, into QUARANTINE_PATH"""
+        if not failures:
+            return
+        failed_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        lines = [json.dumps({'failed_at': failed_at, 'error': str(error), 'kind': kind, 'record': record})
+                 for (_, kind, record), error in failures]
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            append_lines(QUARANTINE_PATH, lines)
+        except OSError as e:
+            # They stay in the journal and are replayed when the next worker starts
+            print(f"Data log: could not quarantine {len(failures)} records ({e}), they stay in the journal")
+            return
+        self.quarantined += len(failures)
+        print(f"Data log: moved {len(failures)} records that keep failing to {QUARANTINE_PATH}")
+        sequences = [sequence for (sequence, _, _), _ in failures if sequence is not None]
+        if sequences and self._journal is not None and self._pid == os.getpid():
+            self._journal.mark_done(sequences)
+
+
+data_log = DataLogQueue()
@@ -0,0 +1,218 @@
+# Writers for the study data files in data/. Each takes a list of records queued by the request
+# handlers in chatPsych.py and appends them to the JSON and CSV files. They run on the data log
+# writer thread (or in the log aggregator process, see log_aggregator.py), never in a request,
+# so they only use what is in the records.
+
+import json
+import os
+
+from data_logging import DATA_DIR, data_log, read_json, write_json, append_csv_rows, append_lines
+from logprob_codec import csv_logprobs, encode_logprobs, decode_logprobs, summarize_logprobs
+
+# Logprob arrays in interactions.json/CSV are float32 by default. Set LOGPROB_EXPORT_DTYPE=f16 to halve them again.
+LOGPROB_EXPORT_DTYPE = os.environ.get('LOGPROB_EXPORT_DTYPE', 'f32')
+
+
+# Function to calculate joint log probability in models that can call logprobs
+# This functionality is pretty much deprecated in most closed source models now...
+def calculate_joint_log_probability(logprobs):
+    if not logprobs:
+        return 0
+    return sum(logprobs)
+
+
+def write_visitor_log(records):
+    """Data log writer for visitor_log.json"""
+    visitor_log_path = os.path.join(DATA_DIR, 'visitor_log.json')
+    logs = read_json(visitor_log_path, [])
+    logs.extend(records)
+    write_json(visitor_log_path, logs, indent=2)
+
+
+def write_interactions(records):
+    """Data log writer for interactions.json and interactions_backup.csv"""
+    interactions_json_path = os.path.join(DATA_DIR, 'interactions.json')
+    interactions = read_json(interactions_json_path, {"users": {}})
+
+    csv_rows = []
+    for data in records:
+        username = data['username']
+        if username not in interactions["users"]:
+            interactions["users"][username] = {
+                "user_id": data.get('user_id', ''),
+                "interactions": []
+            }
+
+        interaction_content = {k: v for k, v in data.items() if k not in ['username', 'user_id']}
+
+        # Logprobs are exported as a packed base64 array plus precomputed summary stats (see logprob_codec.py).
+        # The interaction joint probability is summed from earlier summaries instead of decoding every array.
+        if 'logprobs' in data:
+            logprobs = data.get('logprobs') or []
+            summary = summarize_logprobs(logprobs)
+            interaction_content['logprobs'] = encode_logprobs(logprobs, LOGPROB_EXPORT_DTYPE)
+            interaction_content['logprobs_summary'] = summary
+            interaction_content['relativeSequenceJointLogProbability'] = calculate_joint_log_probability(logprobs)
+            previous_joint = 0
+            for interaction in interactions["users"][username]["interactions"]:
+                if 'logprobs_summary' in interaction:
+                    previous_joint += interaction['logprobs_summary'].get('sum', 0)
+                elif 'logprobs' in interaction:
+                    previous_joint += calculate_joint_log_probability(decode_logprobs(interaction['logprobs']))
+            interaction_content['relativeInteractionJointLogProbability'] = previous_joint + summary['sum']
+
+        interactions["users"][username]["interactions"].append(interaction_content)
+
+        csv_rows.append([
+            data.get('timestamp', ''),
+            data.get('user_id', ''),
+            data.get('username', ''),
+            data.get('password', 'N/A'),
+            data.get('agent_name', 'N/A'),
+            data.get('interaction_type', ''),
+            data.get('message', ''),
+            data.get('response', ''),
+            data.get('model', ''),
+            data.get('temperature', ''),
+            csv_logprobs(interaction_content.get('logprobs'))
+        ])
+
+    write_json(interactions_json_path, interactions, indent=4)
+
+    csv_headers = [
+        "timestamp", "user_id", "username", "password", "agent_name", "interaction_type", 
+        "message", "response", "model", "temperature", "logprobs"
+    ]
+    append_csv_rows(os.path.join(DATA_DIR, 'interactions_backup.csv'), csv_headers, csv_rows)
+
+
+def write_popup_data(records):
+    """Data log writer for popup.json and popup.csv"""
+    popup_json_path = os.path.join(DATA_DIR, 'popup.json')
+    popup_data = read_json(popup_json_path, {"popup_responses": []})
+    popup_data["popup_responses"].extend(records)
+    write_json(popup_json_path, popup_data, indent=4)
+
+    csv_headers = [
+        "timestamp", "username", "password", "agent_name", "user_id", 
+        "interaction_type", "button_selected"
+    ]
+    csv_rows = [[
+        data.get('timestamp', ''),
+        data.get('username', ''),
+        data.get('password', ''),
+        data.get('agent_name', ''),
+        data.get('user_id', ''),
+        data.get('interaction_type', ''),
+        data.get('button_selected', '')
+    ] for data in records]
+    append_csv_rows(os.path.join(DATA_DIR, 'popup.csv'), csv_headers, csv_rows)
+
+
+def write_pre_survey_data(records):
+    """Data log writer for pre_survey.json and pre_survey.csv"""
+    survey_json_path = os.path.join(DATA_DIR, 'pre_survey.json')
+    survey_data = read_json(survey_json_path, {"pre_survey_responses": []})
+
+    entries = []
+    for data in records:
+        survey_entry = {
+            'username': data.get('pre_username', data.get('username', '')),
+            'password': data.get('pre_password', data.get('password', '')),
+            'agent_name': data.get('pre_agent_name', data.get('agent_name', '')),
+            'user_id': data.get('pre_user_id', data.get('user_id', '')),
+            'survey_start_timestamp': data.get('pre_survey_start_timestamp', data.get('survey_start_timestamp', '')),
+            'survey_end_timestamp': data.get('pre_survey_end_timestamp', data.get('survey_end_timestamp', '')),
+            'survey_completed': data.get('pre_survey_completed', data.get('survey_completed', 'no')),
+            'interaction_type': data.get('pre_interaction_type', 'pre_interaction_survey')
+        }
+        
+        for key, value in data.items():
+            if key not in ['username', 'password', 'agent_name', 'user_id', 'survey_start_timestamp', 'survey_end_timestamp', 'survey_completed', 
+                          'pre_username', 'pre_password', 'pre_agent_name', 'pre_user_id', 'pre_survey_start_timestamp', 'pre_survey_end_timestamp', 'pre_survey_completed',
+                          'pre_interaction_type', 'pre_timestamp']:
+                survey_entry[key] = value
+        entries.append(survey_entry)
+
+    survey_data["pre_survey_responses"].extend(entries)
+
+    # Log pre-survey JSON
+    write_json(survey_json_path, survey_data, indent=4)
+    # Log pre-survey CSV
+    write_survey_csv(os.path.join(DATA_DIR, 'pre_survey.csv'), entries, 'pre_survey')
+
+
+def write_post_survey_data(records):
+    """Data log writer for post_survey.json and post_survey.csv"""
+    survey_json_path = os.path.join(DATA_DIR, 'post_survey.json')
+    survey_data = read_json(survey_json_path, {"post_survey_responses": []})
+
+    entries = []
+    for data in records:
+        survey_entry = {
+            'username': data.get('post_username', ''),
+            'password': data.get('post_password', ''),
+            'agent_name': data.get('post_agent_name', ''),
+            'user_id': data.get('post_user_id', ''),
+            'survey_start_timestamp': data.get('post_survey_start_timestamp', ''),
+            'survey_end_timestamp': data.get('post_survey_end_timestamp', ''),
+            'survey_completed': data.get('post_survey_completed', 'no'),
+            'interaction_type': data.get('post_interaction_type', 'post_interaction_survey')
+        }
+        
+        for key, value in data.items():
+            if key not in ['post_username', 'post_password', 'post_agent_name', 'post_user_id', 'post_survey_start_timestamp', 'post_survey_end_timestamp', 'post_survey_completed',
+                          'post_interaction_type', 'post_timestamp']:
+                survey_entry[key] = value
+        entries.append(survey_entry)
+
+    survey_data["post_survey_responses"].extend(entries)
+
+    # Log post-survey JSON
+    write_json(survey_json_path, survey_data, indent=4)
+    # Log post-survey CSV
+    write_survey_csv(os.path.join(DATA_DIR, 'post_survey.csv'), entries, 'post_survey')
+
+
+def write_survey_csv(csv_file, entries, default_interaction_type):
+    """Append survey entries to a survey CSV. The fixed columns come first, then each entry's answers."""
+    base_headers = [
+        "username", "password", "agent_name", "user_id", "survey_start_timestamp", 
+        "survey_end_timestamp", "survey_completed", "interaction_type"
+    ]
+    csv_headers = None
+    csv_rows = []
+    for survey_entry in entries:
+        headers = list(base_headers)
+        csv_data = [
+            survey_entry.get('username', ''),
+            survey_entry.get('password', ''),
+            survey_entry.get('agent_name', ''),
+            survey_entry.get('user_id', ''),
+            survey_entry.get('survey_start_timestamp', ''),
+            survey_entry.get('survey_end_timestamp', ''),
+            survey_entry.get('survey_completed', ''),
+            survey_entry.get('interaction_type', default_interaction_type)
+        ]
+        for key, value in survey_entry.items():
+            if key not in headers:
+                headers.append(key)
+                csv_data.append(value)
+        # Headers are only written when the file is new, from the first entry (as before batching)
+        csv_headers = csv_headers or headers
+        csv_rows.append(csv_data)
+    append_csv_rows(csv_file, csv_headers, csv_rows)
+
+
+def write_download_log(records):
+    """Data log writer for download_log.json (one JSON object per line)"""
+    append_lines(os.path.join(DATA_DIR, 'download_log.json'), [json.dumps(entry) for entry in records])
+
+
+# Writers for the background data log queue (see data_logging.py)
+data_log.register('interaction', write_interactions)
+data_log.register('visitor', write_visitor_log)
+data_log.register('popup', write_popup_data)
+data_log.register('pre_survey', write_pre_survey_data)
+data_log.register('post_survey', write_post_survey_data)
+data_log.register('download', write_download_log)
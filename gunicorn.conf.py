@@ -0,0 +1,57 @@
+# Gunicorn picks this file up automatically when started from the app directory.
+# Workers, bind address etc. still come from the command line (see the Dockerfile and DEPLOYMENT docs).
+
+import os
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOG_AGGREGATOR_SOCKET = os.environ.get('LOG_AGGREGATOR_SOCKET', '')
+LOG_AGGREGATOR_AUTOSTART = os.environ.get('LOG_AGGREGATOR_AUTOSTART', 'true').lower() == 'true'
+TTS_WARMUP = os.environ.get('TTS_WARMUP', 'true').lower() == 'true'
+
+_aggregator = None
+
+
+def on_starting(server):
+    """Start the log aggregator, then the TTS warm-up, once for all workers"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    if LOG_AGGREGATOR_SOCKET and LOG_AGGREGATOR_AUTOSTART:
+        _start_aggregator(server, app_dir)
+    if TTS_WARMUP:
+        # Runs alongside the workers; users.db is found like the app finds it, in the working directory
+        subprocess.Popen([sys.executable, os.path.join(app_dir, 'tts_warmup.py'), '--db', os.path.abspath('users.db')])
+
+
+def _start_aggregator(server, app_dir):
+    """Start the log aggregator before any worker so it is the only writer of data/ (see log_aggregator.py)"""
+    global _aggregator
+    _aggregator = subprocess.Popen([sys.executable, os.path.join(app_dir, 'log_aggregator.py'),
+                                    '--socket', LOG_AGGREGATOR_SOCKET], cwd=app_dir)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(LOG_AGGREGATOR_SOCKET) and time.monotonic() < deadline:
+        if _aggregator.poll() is not None:
+            server.log.error('Log aggregator exited on startup, workers will write data/ directly')
+            return
+        time.sleep(0.1)
+
+
+def worker_exit(server, worker):
+    """Write out any queued study data before the worker goes away (see data_logging.py)"""
+    from data_logging import data_log
+    data_log.close()
+
+
+def on_exit(server):
+    """Stop the log aggregator after the workers have handed over their last records"""
+    if _aggregator is None or _aggregator.poll() is not None:
+        return
+    _aggregator.terminate()
+    try:
+        _aggregator.wait(30)
+    except subprocess.TimeoutExpired:
+        _aggregator.kill()
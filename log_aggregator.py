@@ -0,0 +1,209 @@
+# Log aggregator: one process that owns every write to the study data files in data/.
+#
+# With gunicorn -w 4, every worker would otherwise read-modify-write the same JSON files and append
+# to the same CSVs. Workers started with LOG_AGGREGATOR_SOCKET set send their batches here over a
+# Unix socket instead (see data_logging.py). The aggregator groups batches from all workers, writes
+# them in arrival order with one open handle per CSV and the JSON documents kept in memory, fsyncs,
+# and only then confirms each batch. Workers keep records in their journals until confirmed.
+# A worker that gave up waiting sends the batch again with the same id. The aggregator remembers the
+# last RECENT_BATCH_IDS ids and answers for the batch it already has instead of writing it twice.
+# Records of a batch the worker split up come as "<batch id>:<n>", and are skipped if that batch was
+# written after all.
+#
+# gunicorn.conf.py starts and stops it with gunicorn when LOG_AGGREGATOR_SOCKET is set.
+# To run it yourself (set LOG_AGGREGATOR_AUTOSTART=false so gunicorn doesn't start a second one):
+#   python log_aggregator.py --socket /tmp/chatpsych-log.sock
+
+import argparse
+from collections import OrderedDict
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import data_logging
+from data_logging import data_log, enable_write_caches
+import data_writers  # registers the data file writers with data_log
+
+# Most records written in one group commit
+AGGREGATOR_BATCH_SIZE = int(os.environ.get('LOG_AGGREGATOR_BATCH_SIZE', 500))
+# Batch ids remembered to spot a worker sending a batch again
+RECENT_BATCH_IDS = 10000
+
+
+class _Batch:
+    def __init__(self, records):
+        self.records = records
+        self.done = threading.Event()
+        self.error = None
+
+
+class LogAggregator:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='log-aggregator-writer', daemon=True)
+        self._recent = OrderedDict()  # batch id -> _Batch, oldest first
+        self._recent_lock = threading.Lock()
+        self.duplicates = 0
+        self.batches = 0
+        self.records = 0
+
+    def start(self):
+        enable_write_caches()
+        self._thread.start()
+
+    def write(self, records, batch_id=None):
+        """Queue a worker's batch for the next group commit and wait until it is on disk.
+        A batch id seen before waits for (or reports) that batch instead of writing it again."""
+        if batch_id and ':' in batch_id:
+            with self._recent_lock:
+                whole = self._recent.get(batch_id.rpartition(':')[0])
+            if whole is not None:
+                whole.done.wait()
+                if not whole.error:
+                    with self._recent_lock:
+                        self.duplicates += 1
+                    return
+        with self._recent_lock:
+            batch = self._recent.get(batch_id) if batch_id else None
+            if batch is not None and not (batch.done.is_set() and batch.error):
+                self.duplicates += 1
+                queued = False
+            else:
+                batch = _Batch(records)
+                queued = True
+                if batch_id:
+                    self._recent[batch_id] = batch
+                    while len(self._recent) > RECENT_BATCH_IDS:
+                        self._recent.popitem(last=False)
+        if queued:
+            self._queue.put(batch)
+        batch.done.wait()
+        if batch.error:
+            raise batch.error
+
+    def stop(self):
+        """Write everything already received, then stop"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            group = []
+            if item is None:
+                stopping = True
+            else:
+                group.append(item)
+            count = sum(len(batch.records) for batch in group)
+            while count < AGGREGATOR_BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    continue
+                group.append(item)
+                count += len(item.records)
+            if group:
+                self._commit(group)
+
+    def _commit(self, group):
+        try:
+            data_log.write_records([record for batch in group for record in batch.records])
+            self.batches += len(group)
+            self.records += sum(len(batch.records) for batch in group)
+        except Exception as e:
+            print(f"Log aggregator: failed to write {len(group)} batches: {e}")
+            for batch in group:
+                batch.error = e
+        for batch in group:
+            batch.done.set()
+
+
+class _WorkerConnection(socketserver.StreamRequestHandler):
+    """One gunicorn worker. Each line is a JSON batch, each reply says whether it was written."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                records = [tuple(record) for record in message['records']]
+                self.server.aggregator.write(records, message.get('batch'))
+                reply = {'ok': True, 'count': len(records)}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+            except OSError:
+                # The worker gave up waiting, it will send the batch again
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise SystemExit(f'Another log aggregator is already listening on {path}')
+
+
+def serve(socket_path):
+    _remove_stale_socket(socket_path)
+    aggregator = LogAggregator()
+    aggregator.start()
+
+    old_umask = os.umask(0o077)
+    try:
+        server = _Server(socket_path, _WorkerConnection)
+    finally:
+        os.umask(old_umask)
+    server.aggregator = aggregator
+
+    def shut_down(signum, frame):
+        # shutdown() waits for serve_forever, so it can't be called from the serving thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+
+    print(f"Log aggregator writing {data_logging.DATA_DIR} for workers on {socket_path}")
+    started = time.monotonic()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        aggregator.stop()
+        os.remove(socket_path)
+        print(f"Log aggregator stopped: {aggregator.records} records in {aggregator.batches} batches "
+              f"({aggregator.duplicates} resent) over {time.monotonic() - started:.0f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Single writer for the chatPsych data files')
+    parser.add_argument('--socket', default=data_logging.LOG_AGGREGATOR_SOCKET,
+                        help='Unix socket to listen on (default: LOG_AGGREGATOR_SOCKET)')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('set LOG_AGGREGATOR_SOCKET or pass --socket')
+    serve(args.socket)
@@ -0,0 +1,130 @@
+# Compact encoding for token logprobs.
+# Logprob lists from API_LLM.litellm_api_request are stored as packed little-endian float32
+# (or float16) arrays. SQLite gets the raw bytes, the JSON/CSV exports get a base64 string.
+# The CSV cell carries its dtype as a prefix ("f16:AAB..."), so it can be decoded on its own.
+# Finite values beyond what the dtype can hold (about ±65504 for float16) are stored as its largest
+# value, infinities stay infinite.
+# This module has no Flask imports so it can be used straight from an analysis notebook.
+
+import base64
+import math
+import struct
+
+# dtype name -> (struct format character, bytes per value, largest finite value)
+LOGPROB_DTYPES = {
+    'f32': ('f', 4, 3.4028234663852886e38),
+    'f16': ('e', 2, 65504.0)
+}
+
+DEFAULT_DTYPE = 'f32'
+
+
+def _dtype_format(dtype):
+    if dtype not in LOGPROB_DTYPES:
+        raise ValueError(f"Unsupported logprob dtype '{dtype}'. Use one of: {', '.join(LOGPROB_DTYPES)}")
+    return LOGPROB_DTYPES[dtype]
+
+
+def pack_logprobs(logprobs, dtype=DEFAULT_DTYPE):
+    """Pack a list of logprobs into little-endian bytes, or None if there are none"""
+    if not logprobs:
+        return None
+    format_char, _, largest = _dtype_format(dtype)
+    # struct refuses finite values out of range
+    values = [min(max(value, -largest), largest) if math.isfinite(value) else value for value in logprobs]
+    return struct.pack(f'<{len(values)}{format_char}', *values)
+
+
+def unpack_logprobs(blob, dtype=DEFAULT_DTYPE):
+    """Unpack bytes written by pack_logprobs back into a list of floats"""
+    if not blob:
+        return []
+    format_char, width, _ = _dtype_format(dtype)
+    return list(struct.unpack(f'<{len(blob) // width}{format_char}', blob))
+
+
+def summarize_logprobs(logprobs):
+    """Summary stats computed once at write time so exports don't need to decode the array"""
+    if not logprobs:
+        return {'count': 0, 'sum': 0, 'mean': None, 'min': None}
+    total = sum(logprobs)
+    return {
+        'count': len(logprobs),
+        'sum': total,
+        'mean': total / len(logprobs),
+        'min': min(logprobs)
+    }
+
+
+def encode_logprobs(logprobs, dtype=DEFAULT_DTYPE):
+    """Encode logprobs for the JSON export, e.g. {"encoding": "f32le-b64", "data": "...", "count": 12}"""
+    blob = pack_logprobs(logprobs, dtype)
+    return {
+        'encoding': f'{dtype}le-b64',
+        'data': base64.b64encode(blob).decode('ascii') if blob else '',
+        'count': len(logprobs) if logprobs else 0
+    }
+
+
+def csv_logprobs(encoded):
+    """The interactions_backup.csv cell for an encode_logprobs dict, e.g. f32:AACAvw=="""
+    if not encoded or not encoded.get('data'):
+        return ''
+    return f"{_encoded_dtype(encoded)}:{encoded['data']}"
+
+
+def _split_csv_value(value, dtype):
+    """(dtype, base64 data) of a CSV cell. Cells without a prefix are from older exports and use dtype."""
+    prefix, separator, data = value.partition(':')
+    if separator:
+        _dtype_format(prefix)
+        return prefix, data
+    return dtype, value
+
+
+def _encoded_dtype(encoded):
+    encoding = encoded.get('encoding', f'{DEFAULT_DTYPE}le-b64')
+    if not encoding.endswith('le-b64'):
+        raise ValueError(f"Unknown logprob encoding '{encoding}'")
+    return encoding[:-len('le-b64')]
+
+
+def decode_logprobs(value, dtype=DEFAULT_DTYPE):
+    """Decode a logprob value from interactions.json or interactions_backup.csv.
+
+    Accepts the encoded dict written by encode_logprobs, the CSV column ("f16:<base64>", or bare
+    base64 decoded with dtype in older exports), or the plain float list older exports used.
+    """
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        dtype, data = _split_csv_value(value, dtype)
+        return unpack_logprobs(base64.b64decode(data), dtype)
+    return unpack_logprobs(base64.b64decode(value.get('data', '')), _encoded_dtype(value))
+
+
+def to_numpy(value, dtype=DEFAULT_DTYPE):
+    """Decode logprobs straight into a NumPy float array for analysis.
+
+    value can be raw bytes (the messages.logprobs column), an encoded dict or a CSV cell.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError("NumPy is required for to_numpy. Install it with: pip install numpy")
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        blob = bytes(value)
+    elif isinstance(value, str):
+        dtype, data = _split_csv_value(value, dtype)
+        blob = base64.b64decode(data)
+    elif isinstance(value, dict):
+        dtype = _encoded_dtype(value)
+        blob = base64.b64decode(value.get('data', ''))
+    else:
+        return np.asarray(value or [], dtype=np.float32)
+
+    _dtype_format(dtype)
+    return np.frombuffer(blob, dtype='<f4' if dtype == 'f32' else '<f2')
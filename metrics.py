@@ -0,0 +1,194 @@
+# In-memory metrics for LLM calls (latency, time to first token, tokens, errors and cost).
+# Every gunicorn worker keeps its own copy. Series are labelled with the worker pid so a
+# Prometheus scrape of each worker can be summed, and the dashboard summary says which worker it came from.
+
+import os
+import threading
+import time
+from collections import deque
+
+# Histogram buckets (milliseconds) for provider latency and time to first token
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+# How many recent calls per series are kept for the rolling percentiles on the dashboard
+RECENT_SAMPLES = 500
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def prometheus_lines(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS_MS, self.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total:.3f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class _Series:
+    """Running totals for one (agent, provider, model) combination"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.latency = _Histogram()
+        self.ttft = _Histogram()
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+
+class LLMMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._errors = {}
+        self.started_at = time.time()
+
+    def record_call(self, agent, provider, model, latency_ms, prompt_tokens=0, completion_tokens=0,
+                    cost_usd=None, ttft_ms=None, error=None):
+        """Record one provider call. error is the exception class name for failed calls."""
+        key = (agent or 'unknown', provider or 'unknown', model or 'unknown')
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.calls += 1
+            series.latency.observe(latency_ms)
+            if ttft_ms is not None:
+                series.ttft.observe(ttft_ms)
+            if error:
+                series.errors += 1
+                error_key = (key[1], key[2], error)
+                self._errors[error_key] = self._errors.get(error_key, 0) + 1
+            else:
+                series.prompt_tokens += prompt_tokens or 0
+                series.completion_tokens += completion_tokens or 0
+                series.cost_usd += cost_usd or 0.0
+            series.recent.append((time.time(), latency_ms, ttft_ms, completion_tokens or 0, bool(error)))
+
+    def summary(self, window_seconds=300):
+        """Per agent/provider/model totals plus percentiles over the last window_seconds"""
+        cutoff = time.time() - window_seconds
+        rows = []
+        with self._lock:
+            snapshot = [(key, series.calls, series.errors, series.prompt_tokens, series.completion_tokens,
+                         series.cost_usd, series.latency.total, list(series.recent))
+                        for key, series in self._series.items()]
+            errors = [{'provider': provider, 'model': model, 'error': error, 'count': count}
+                      for (provider, model, error), count in self._errors.items()]
+
+        for (agent, provider, model), calls, error_count, prompt_tokens, completion_tokens, cost, latency_total, recent in snapshot:
+            window = [sample for sample in recent if sample[0] >= cutoff]
+            latencies = sorted(sample[1] for sample in window)
+            ttfts = sorted(sample[2] for sample in window if sample[2] is not None)
+            successful = [sample for sample in window if not sample[4]]
+            busy_seconds = sum(sample[1] for sample in successful) / 1000
+            rows.append({
+                'agent': agent,
+                'provider': provider,
+                'model': model,
+                'calls': calls,
+                'errors': error_count,
+                'error_rate': error_count / calls if calls else 0,
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'estimated_cost_usd': round(cost, 6),
+                'avg_latency_ms': latency_total / calls if calls else None,
+                'window_calls': len(window),
+                'window_p50_latency_ms': _percentile(latencies, 0.5),
+                'window_p95_latency_ms': _percentile(latencies, 0.95),
+                'window_p50_ttft_ms': _percentile(ttfts, 0.5),
+                'window_tokens_per_second': sum(sample[3] for sample in successful) / busy_seconds if busy_seconds else None
+            })
+
+        rows.sort(key=lambda row: (row['agent'], row['model']))
+        return {
+            'worker_pid': os.getpid(),
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'window_seconds': window_seconds,
+            'series': rows,
+            'errors': errors
+        }
+
+    def prometheus_text(self):
+        """Render all series in the Prometheus text exposition format"""
+        worker = os.getpid()
+        lines = [
+            '# HELP chatpsych_llm_requests_total LLM provider calls.',
+            '# TYPE chatpsych_llm_requests_total counter',
+        ]
+        with self._lock:
+            series_items = list(self._series.items())
+            error_items = list(self._errors.items())
+
+            def labels_for(key):
+                agent, provider, model = key
+                return f'worker="{worker}",agent="{_escape_label(agent)}",provider="{_escape_label(provider)}",model="{_escape_label(model)}"'
+
+            for key, series in series_items:
+                lines.append(f'chatpsych_llm_requests_total{{{labels_for(key)}}} {series.calls}')
+
+            lines += ['# HELP chatpsych_llm_errors_total Failed LLM provider calls by error type.',
+                      '# TYPE chatpsych_llm_errors_total counter']
+            for (provider, model, error), count in error_items:
+                lines.append(f'chatpsych_llm_errors_total{{worker="{worker}",provider="{_escape_label(provider)}",'
+                             f'model="{_escape_label(model)}",error="{_escape_label(error)}"}} {count}')
+
+            lines += ['# HELP chatpsych_llm_prompt_tokens_total Prompt tokens sent to providers.',
+                      '# TYPE chatpsych_llm_prompt_tokens_total counter']
+            for key, series in series_items:
+                lines.append(f'chatpsych_llm_prompt_tokens_total{{{labels_for(key)}}} {series.prompt_tokens}')
+
+            lines += ['# HELP chatpsych_llm_completion_tokens_total Completion tokens returned by providers.',
+                      '# TYPE chatpsych_llm_completion_tokens_total counter']
+            for key, series in series_items:
+                lines.append(f'chatpsych_llm_completion_tokens_total{{{labels_for(key)}}} {series.completion_tokens}')
+
+            lines += ['# HELP chatpsych_llm_cost_usd_total Estimated provider cost in USD.',
+                      '# TYPE chatpsych_llm_cost_usd_total counter']
+            for key, series in series_items:
+                lines.append(f'chatpsych_llm_cost_usd_total{{{labels_for(key)}}} {series.cost_usd:.6f}')
+
+            lines += ['# HELP chatpsych_llm_latency_ms Provider call latency in milliseconds.',
+                      '# TYPE chatpsych_llm_latency_ms histogram']
+            for key, series in series_items:
+                lines += series.latency.prometheus_lines('chatpsych_llm_latency_ms', labels_for(key))
+
+            lines += ['# HELP chatpsych_llm_ttft_ms Time to first token in milliseconds (streamed calls only).',
+                      '# TYPE chatpsych_llm_ttft_ms histogram']
+            for key, series in series_items:
+                if series.ttft.count:
+                    lines += series.ttft.prometheus_lines('chatpsych_llm_ttft_ms', labels_for(key))
+
+        return '\n'.join(lines) + '\n'
+
+
+llm_metrics = LLMMetrics()
@@ -0,0 +1,218 @@
+# Request-level tracing for chatPsych.
+# Every request gets a request id (echoed back as X-Request-ID) and a breakdown of time spent in
+# named phases (db, agent_load, llm, logging, render...). One JSON line per request is written to
+# data/request_trace.log. Slow requests can optionally be profiled and the output viewed from
+# the research dashboard.
+#
+# Settings (.env):
+#   SLOW_REQUEST_MS=2000        requests slower than this are flagged "slow" in the trace log
+#   PROFILE_SLOW_REQUESTS=false set to true to profile requests and keep the output for slow ones
+#   PROFILE_SAMPLE_RATE=1.0     fraction of requests to profile when profiling is on
+#   PROFILE_KEEP=50             how many profile files to keep
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import g, has_request_context, request
+
+try:
+    # pyinstrument is optional. It gives a sampled call tree (HTML flamegraph-style view),
+    # otherwise cProfile's cumulative stats are saved as text.
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+TRACE_LOG_PATH = os.path.join(DATA_DIR, 'request_trace.log')
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 2000))
+PROFILE_SLOW_REQUESTS = os.environ.get('PROFILE_SLOW_REQUESTS', 'false').lower() in ('true', '1', 'yes', 'on')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+
+# Static files are not worth a trace line each
+UNTRACED_ENDPOINTS = {'static', 'assets'}
+
+_PROFILE_NAME_RE = re.compile(r'^[0-9]{8}_[0-9]{6}_[A-Za-z0-9]+\.(html|txt)$')
+_UNSAFE_ID_CHARS = re.compile(r'[^A-Za-z0-9]')
+
+trace_logger = logging.getLogger('chatpsych.trace')
+trace_logger.propagate = False
+
+
+def _ensure_trace_handler():
+    if trace_logger.handlers:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    handler = logging.FileHandler(TRACE_LOG_PATH)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+
+
+@contextmanager
+def trace_phase(name):
+    """Time a block of work and add it to the current request's phase breakdown.
+
+    Repeated phases with the same name are summed. Outside a request this does nothing.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and hasattr(g, 'trace_phases'):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            g.trace_phases[name] = g.trace_phases.get(name, 0) + elapsed_ms
+
+
+def current_request_id():
+    """The id of the request being handled, or None outside a request"""
+    if has_request_context():
+        return getattr(g, 'request_id', None)
+    return None
+
+
+class _RequestProfiler:
+    """Wraps pyinstrument if it is installed, cProfile otherwise"""
+
+    def __init__(self):
+        self.sampling = SamplingProfiler is not None
+        self.profiler = SamplingProfiler() if self.sampling else cProfile.Profile()
+
+    def start(self):
+        if self.sampling:
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.sampling:
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+
+    def render(self):
+        """Return (file extension, content) for the saved profile"""
+        if self.sampling:
+            return 'html', self.profiler.output_html()
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(60)
+        return 'txt', stream.getvalue()
+
+
+def _save_profile(profiler, record):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    extension, content = profiler.render()
+    # The request id may come from the client (X-Request-ID), so only letters and digits go in the
+    # filename. Anything else would fail _PROFILE_NAME_RE and the file would never be listed or pruned.
+    file_id = _UNSAFE_ID_CHARS.sub('', record['request_id'])[:64] or uuid.uuid4().hex[:16]
+    filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file_id}.{extension}"
+    with open(os.path.join(PROFILE_DIR, filename), 'w') as f:
+        if extension == 'txt':
+            f.write(json.dumps(record) + '\n\n')
+        f.write(content)
+
+    # Only keep the newest PROFILE_KEEP files
+    profiles = sorted(name for name in os.listdir(PROFILE_DIR) if _PROFILE_NAME_RE.match(name))
+    for old_name in profiles[:-PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old_name))
+        except OSError:
+            pass
+    return filename
+
+
+def list_profiles():
+    """Saved slow-request profiles, newest first"""
+    if not os.path.exists(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not _PROFILE_NAME_RE.match(name):
+            continue
+        path = os.path.join(PROFILE_DIR, name)
+        profiles.append({
+            'name': name,
+            'request_id': name.rsplit('.', 1)[0].split('_', 2)[-1],
+            'created': datetime.fromtimestamp(os.path.getmtime(path)).isoformat(),
+            'size': os.path.getsize(path)
+        })
+    return profiles
+
+
+def profile_path(name):
+    """Full path of a saved profile, or None if the name is not a profile we wrote"""
+    if not name or not _PROFILE_NAME_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.exists(path) else None
+
+
+def init_request_tracing(app):
+    """Register the before/after request hooks on the Flask app"""
+    _ensure_trace_handler()
+
+    @app.before_request
+    def _start_request_trace():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+        g.request_started = time.perf_counter()
+        g.trace_phases = {}
+        g.request_profiler = None
+        if PROFILE_SLOW_REQUESTS and request.endpoint not in UNTRACED_ENDPOINTS and random.random() < PROFILE_SAMPLE_RATE:
+            profiler = _RequestProfiler()
+            try:
+                profiler.start()
+                g.request_profiler = profiler
+            except (ValueError, RuntimeError):
+                # Another profiler is already running in this process
+                pass
+
+    @app.after_request
+    def _finish_request_trace(response):
+        started = getattr(g, 'request_started', None)
+        if started is None:
+            return response
+
+        profiler = getattr(g, 'request_profiler', None)
+        if profiler:
+            profiler.stop()
+
+        duration_ms = (time.perf_counter() - started) * 1000
+        response.headers['X-Request-ID'] = g.request_id
+        if request.endpoint in UNTRACED_ENDPOINTS:
+            return response
+
+        phases = {name: round(ms, 2) for name, ms in g.trace_phases.items()}
+        record = {
+            'timestamp': datetime.now().isoformat(),
+            'request_id': g.request_id,
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 2),
+            'phases': phases,
+            'unaccounted_ms': round(max(0.0, duration_ms - sum(phases.values())), 2),
+            'slow': duration_ms >= SLOW_REQUEST_MS
+        }
+
+        if profiler and record['slow']:
+            try:
+                record['profile'] = _save_profile(profiler, record)
+            except Exception as e:
+                app.logger.error(f"Error saving request profile: {e}")
+
+        trace_logger.info(json.dumps(record))
+        return response
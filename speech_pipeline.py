@@ -0,0 +1,561 @@
+# Spoken replies for agents with audio enabled, synthesized while the reply is still being generated.
+#
+# The LLM reply is cut into sentences as its tokens stream in (SentenceSegmenter). Each sentence is
+# sent to ElevenLabs' streaming endpoint on a shared thread pool, so several sentences are
+# synthesized at once, and audio() hands the chunks back in sentence order. The first sentence is
+# sent as soon as it is complete, so audio starts one sentence after the first token. Later
+# sentences wait until the sentence after them is known, so they can be sent with next_text.
+# Each request also gets the text before it (previous_text) or, when the previous sentence has
+# already started, its request id (previous_request_ids), so the sentences join up naturally.
+# Sentences longer than TTS_MAX_CHUNK_CHARS are cut at clause boundaries, and each one is cleaned up
+# for speaking (markdown removed etc., see tts_text.py) before it is sent.
+#
+# Text that is already complete (replaying a reply that isn't cached) goes through the same
+# pipeline with speak_text, so long replies are synthesized in parallel chunks too, in every format.
+# clip_audio() relays the chunks as one clip: WAV chunks lose their own headers after the first one
+# and Ogg chunks follow each other as a chained stream.
+#
+# At most TTS_PIPELINE_LOOKAHEAD sentences are synthesized ahead of the one being read. Each one's
+# stream is read as fast as the provider sends it, so a slow reader never keeps a provider request
+# (and its TTS_MAX_CONCURRENCY slot) open: the first TTS_SEGMENT_BUFFER_CHUNKS chunks wait in memory,
+# the rest in a temporary file. A sentence whose synthesis fails is skipped and reported: failed
+# lists it, and the reply isn't cached.
+#
+# A sentence sent without context hints (the first one of a reply) is played from the TTS cache when
+# it is there, which is how the opening lines warmed up by tts_warmup.py start instantly.
+#
+# The reply's audio is also written to the TTS cache as it passes, under the key of the whole reply
+# text and in the agent's study (see tts_cache.py), so replaying it later (/chat/audio/<message id>)
+# is served from disk and the clip can be referenced from the interaction log.
+#
+# Agents turn audio on in their JSON:
+#   "audio": {"enabled": true, "voice_id": "...", "model_id": "eleven_multilingual_v2",
+#             "stability": 0.5, "similarity_boost": 0.5, "style": 0.0, "format": "mp3_44100_128",
+#             "text_normalization": "auto"}
+# "backend": "local" uses espeak-ng or piper on the server instead of ElevenLabs (see tts_local.py):
+#   "audio": {"enabled": true, "backend": "local", "model_id": "espeak-ng", "voice_id": "en-us",
+#             "speed": 1.0, "format": "wav_22050"}
+#
+# The agent's "format" is what participants get by default. negotiate_audio_format picks a smaller
+# one for participants on a slow connection (chat.js reports its speed) or with Save-Data on:
+# Opus at 32 kbps if their browser says it plays Ogg Opus, MP3 at 32 kbps otherwise. Formats the
+# browser doesn't accept are swapped for MP3.
+#
+# Settings (.env):
+#   TTS_PIPELINE_WORKERS=8         sentences synthesized at once per worker (all participants together)
+#   TTS_MIN_SEGMENT_CHARS=25       shorter sentences are joined with the next one
+#   TTS_PIPELINE_LOOKAHEAD=4       sentences synthesized ahead of the one being played, per reply
+#   TTS_SEGMENT_BUFFER_CHUNKS=64   audio chunks kept in memory per sentence, the rest go to a temporary file
+#   AUDIO_LOW_BANDWIDTH_KBPS=400   connections slower than this get the compact formats
+
+import collections
+import os
+import queue
+import re
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from API_AUDIO import (TTS_STREAM_CHUNK_BYTES, AudioFormat, CachedAudioStream, TextProcessingMode, VoiceSettings,
+                       shared_synthesizer)
+from tts_local import shared_local_synthesizer
+from tts_text import TTS_MAX_CHUNK_CHARS, normalize_text, split_text
+
+TTS_PIPELINE_WORKERS = int(os.environ.get('TTS_PIPELINE_WORKERS', 8))
+TTS_MIN_SEGMENT_CHARS = int(os.environ.get('TTS_MIN_SEGMENT_CHARS', 25))
+TTS_PIPELINE_LOOKAHEAD = max(1, int(os.environ.get('TTS_PIPELINE_LOOKAHEAD', 4)))
+TTS_SEGMENT_BUFFER_CHUNKS = max(1, int(os.environ.get('TTS_SEGMENT_BUFFER_CHUNKS', 64)))
+AUDIO_LOW_BANDWIDTH_KBPS = float(os.environ.get('AUDIO_LOW_BANDWIDTH_KBPS', 400))
+
+# ElevenLabs uses up to 3 previous request ids, and only the last bit of previous_text matters
+MAX_CONTINUITY_IDS = 3
+MAX_CONTEXT_CHARS = 500
+
+AUDIO_MIME_TYPES = {'mp3': 'audio/mpeg', 'pcm': 'audio/L16', 'ulaw': 'audio/basic', 'opus': 'audio/ogg', 'wav': 'audio/wav'}
+# Formats whose sentences can be joined into one clip by just appending them. Every WAV sentence
+# has its own header and joined Ogg streams don't play everywhere, so those aren't cached.
+CONCATENABLE_FAMILIES = ('mp3', 'pcm', 'ulaw')
+
+# WAV sizes that mean "until the end of the stream"
+_WAV_UNKNOWN_SIZE = struct.pack('<I', 0xFFFFFFFF)
+# Audio that still has no "data" chunk after this much isn't a WAV header we understand
+_MAX_WAV_HEADER_BYTES = 4096
+
+# End of a sentence (punctuation, closing quotes/brackets, then whitespace) or a line break
+_SENTENCE_END = re.compile(r'[.!?…]+["\')\]*_]*\s+|\n+')
+
+BACKENDS = {'elevenlabs': shared_synthesizer, 'local': shared_local_synthesizer}
+
+_executor = None
+_synthesizers = {}
+_synthesizer_errors = {}
+_setup_lock = threading.Lock()
+
+
+def agent_backend(agent_config):
+    return ((agent_config or {}).get('audio') or {}).get('backend', 'elevenlabs')
+
+
+def agent_voice(agent_config):
+    """Synthesis settings from an agent's "audio" block, or None if the agent has no audio"""
+    audio = (agent_config or {}).get('audio') or {}
+    if not audio.get('enabled') or not audio.get('voice_id'):
+        return None
+    text_processing = TextProcessingMode(audio.get('text_normalization', TextProcessingMode.AUTO_DETECT.value))
+    if agent_backend(agent_config) == 'local':
+        return {
+            'voice_id': audio['voice_id'],
+            'model_id': audio.get('model_id', 'espeak-ng'),
+            'speed': audio.get('speed', 1.0),
+            'audio_format': AudioFormat(audio.get('format', AudioFormat.WAV_22050.value)),
+            'text_processing': text_processing,
+        }
+    return {
+        'voice_id': audio['voice_id'],
+        'model_id': audio.get('model_id', 'eleven_multilingual_v2'),
+        'voice_settings': VoiceSettings(
+            stability=audio.get('stability', 0.5),
+            similarity_boost=audio.get('similarity_boost', 0.5),
+            style=audio.get('style', 0.0),
+            use_speaker_boost=audio.get('use_speaker_boost', True)
+        ),
+        'audio_format': AudioFormat(audio.get('format', AudioFormat.MP3_PROFESSIONAL_128.value)),
+        'text_processing': text_processing,
+    }
+
+
+def audio_mime_type(audio_format):
+    return AUDIO_MIME_TYPES.get(audio_format.value.split('_')[0], 'application/octet-stream')
+
+
+def _accepted_types(accept):
+    """{media type: quality} from an Accept header"""
+    accepted = {}
+    for part in (accept or '').split(','):
+        media_type, *params = [piece.strip() for piece in part.split(';')]
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        accepted[media_type.lower()] = quality
+    return accepted
+
+
+def _accepts(accepted, audio_format, explicitly=False):
+    mime_type = audio_mime_type(audio_format)
+    if mime_type in accepted:
+        return accepted[mime_type] > 0
+    if explicitly:
+        return False
+    wildcard = accepted.get('audio/*', accepted.get('*/*'))
+    # No Accept header at all means anything goes
+    return wildcard > 0 if wildcard is not None else not accepted
+
+
+def negotiate_audio_format(voice, synthesizer, accept=None, connection_kbps=None, save_data=False):
+    """The format to send one client, and why: (AudioFormat, reason)
+
+    Compact formats are only ever picked instead of the agent's format, never a bigger one.
+    Opus is only picked when the client names it, browsers that can't play it still send */*.
+    """
+    accepted = _accepted_types(accept)
+    slow = connection_kbps is not None and connection_kbps < AUDIO_LOW_BANDWIDTH_KBPS
+    candidates = []
+    if save_data or slow:
+        reason = 'save_data' if save_data else 'low_bandwidth'
+        if _accepts(accepted, AudioFormat.OPUS_COMPACT_32, explicitly=True):
+            candidates.append((AudioFormat.OPUS_COMPACT_32, reason))
+        candidates.append((AudioFormat.MP3_COMPACT_32, reason))
+    candidates.append((voice['audio_format'], 'agent'))
+    candidates.append((AudioFormat.MP3_PROFESSIONAL_128, 'accept'))
+    for audio_format, reason in candidates:
+        if _accepts(accepted, audio_format) and synthesizer.supports_format(audio_format):
+            return audio_format, reason
+    return voice['audio_format'], 'agent'
+
+
+def get_synthesizer(backend='elevenlabs'):
+    """The worker's shared synthesizer for a backend, or None if that backend isn't configured"""
+    with _setup_lock:
+        if backend not in _synthesizers and backend not in _synthesizer_errors:
+            try:
+                if backend not in BACKENDS:
+                    raise ValueError(f"unknown TTS backend {backend!r}")
+                _synthesizers[backend] = BACKENDS[backend]()
+            except ValueError as e:
+                _synthesizer_errors[backend] = e
+                print(f"Audio is disabled for the {backend} backend: {e}")
+        return _synthesizers.get(backend)
+
+
+def agent_synthesizer(agent_config):
+    """The synthesizer for an agent's backend, or None if it can't be used"""
+    synthesizer = get_synthesizer(agent_backend(agent_config))
+    if synthesizer is not None and agent_backend(agent_config) == 'local':
+        try:
+            synthesizer.check_engine(agent_voice(agent_config)['model_id'])
+        except ValueError as e:
+            print(f"Audio is disabled for this agent: {e}")
+            return None
+    return synthesizer
+
+
+def _get_executor():
+    global _executor
+    with _setup_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=TTS_PIPELINE_WORKERS, thread_name_prefix='tts')
+        return _executor
+
+
+class SentenceSegmenter:
+    """Cuts streamed text into sentences of at most max_chars for synthesis"""
+
+    def __init__(self, min_chars=TTS_MIN_SEGMENT_CHARS, max_chars=TTS_MAX_CHUNK_CHARS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ''
+
+    def feed(self, text):
+        """Add streamed text, returns the sentences it completed"""
+        self._buffer += text
+        segments = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            if match.end() - start < self.min_chars:
+                continue
+            segments.extend(split_text(self._buffer[start:match.end()], self.max_chars))
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        if len(self._buffer) > self.max_chars:
+            # A sentence that goes on and on is sent in parts, the last part may still grow
+            *complete, rest = split_text(self._buffer, self.max_chars)
+            # split_text strips the parts, the space before the next word has to stay
+            self._buffer = rest + self._buffer[len(self._buffer.rstrip()):]
+            segments.extend(complete)
+        return segments
+
+    def flush(self):
+        """The rest of the text once the stream has ended"""
+        segments = split_text(self._buffer, self.max_chars)
+        self._buffer = ''
+        return segments
+
+
+class _SegmentBuffer:
+    """A segment's audio on its way from the stream to audio(), None marks the end.
+
+    put() never waits: the first max_chunks chunks are kept in memory and the rest are spooled
+    to a temporary file until they are read.
+    """
+
+    def __init__(self, max_chunks=None):
+        self.max_chunks = max_chunks or TTS_SEGMENT_BUFFER_CHUNKS
+        self._memory = collections.deque()
+        self._spool = None
+        self._read_at = 0
+        self._written_at = 0
+        self._ended = False
+        self._closed = False
+        self._changed = threading.Condition()
+
+    def put(self, chunk):
+        with self._changed:
+            if self._closed:
+                return
+            if chunk is None:
+                self._ended = True
+            elif self._read_at == self._written_at and len(self._memory) < self.max_chunks:
+                self._memory.append(chunk)
+            else:
+                # Nothing may overtake what is already spooled, so once it spills it spills until read
+                if self._spool is None:
+                    self._spool = tempfile.TemporaryFile(prefix='tts-segment-')
+                self._spool.seek(self._written_at)
+                self._spool.write(chunk)
+                self._written_at += len(chunk)
+            self._changed.notify_all()
+
+    def get(self, timeout=None):
+        """The next chunk, or None at the end. Raises queue.Empty if nothing came within timeout."""
+        with self._changed:
+            while True:
+                if self._memory:
+                    return self._memory.popleft()
+                if self._read_at < self._written_at:
+                    self._spool.seek(self._read_at)
+                    chunk = self._spool.read(min(self._written_at - self._read_at, TTS_STREAM_CHUNK_BYTES))
+                    self._read_at += len(chunk)
+                    if self._read_at == self._written_at:
+                        # All read, the file is reused from the start
+                        self._spool.truncate(0)
+                        self._read_at = self._written_at = 0
+                    return chunk
+                if self._ended:
+                    return None
+                if not self._changed.wait(timeout):
+                    raise queue.Empty
+
+    def close(self):
+        """Drop whatever is buffered, later chunks are ignored"""
+        with self._changed:
+            self._closed = True
+            self._memory.clear()
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+            self._read_at = self._written_at = 0
+
+
+class _Segment:
+    def __init__(self, index, text):
+        self.index = index
+        self.text = text
+        self.chunks = _SegmentBuffer()
+        self.request_id = None
+        self.dispatched = False
+        self.failed = False
+
+
+class SpeechPipeline:
+    """Synthesizes a reply sentence by sentence while it streams in.
+
+    Feed it the reply with add_text() and call finish() when the reply is complete, from the
+    thread reading the LLM stream. audio() yields (segment index, audio chunk) in order, and
+    (segment index, None) as soon as a segment's audio is complete. Read audio() to the end or
+    close it, the segments' streams wait for it.
+    """
+
+    def __init__(self, synthesizer, voice, executor=None, study=None):
+        self.synthesizer = synthesizer
+        self.voice = voice
+        self.executor = executor or _get_executor()
+        self.study = study
+        # Where the whole reply's audio was stored in the TTS cache, once audio() has finished
+        self.clip = None
+        self.segmenter = SentenceSegmenter()
+        self.segments = []
+        self.text = ''
+        self.finished = False
+        self.errors = 0
+        self.closed = False
+        # The segment audio() is reading, segments are only dispatched up to TTS_PIPELINE_LOOKAHEAD past it
+        self._reading = 0
+        self._changed = threading.Condition()
+
+    def add_text(self, text):
+        self.text += text
+        self._add_segments(self.segmenter.feed(text))
+
+    def finish(self):
+        self._add_segments(self.segmenter.flush(), finished=True)
+
+    def speak(self, text):
+        """Synthesize text that is already complete, instead of add_text() and finish()"""
+        self.text = text
+        # All of it is known, so sentences are packed into chunks as big as a request may be
+        self._add_segments(split_text(text, self.segmenter.max_chars), finished=True)
+
+    @property
+    def concatenable(self):
+        return self.voice['audio_format'].value.split('_')[0] in CONCATENABLE_FAMILIES
+
+    def close(self):
+        """Stop synthesizing (the participant has gone), audio() ends without caching anything"""
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    @property
+    def failed(self):
+        """Indexes of the segments whose synthesis failed so far"""
+        return [segment.index for segment in self.segments if segment.failed]
+
+    def clip_audio(self):
+        """The audio as one clip, bytes only: WAV segments after the first one lose their header"""
+        audio = self.audio()
+        try:
+            if self.voice['audio_format'].value.split('_')[0] != 'wav':
+                yield from (chunk for _, chunk in audio if chunk is not None)
+                return
+            # The start of the current segment until its samples begin, then None
+            header = b''
+            started = False
+            for _, chunk in audio:
+                if chunk is None:
+                    header = b''
+                elif header is None:
+                    yield chunk
+                else:
+                    header += chunk
+                    data_start = _wav_data_start(header)
+                    if data_start is None:
+                        if len(header) < _MAX_WAV_HEADER_BYTES:
+                            continue
+                        # Passed on as it is
+                        yield header
+                    elif not started:
+                        # The first segment with any audio keeps its header
+                        yield _wav_streaming_header(header[:data_start]) + header[data_start:]
+                    elif len(header) > data_start:
+                        yield header[data_start:]
+                    started = True
+                    header = None
+        finally:
+            audio.close()
+
+    def audio(self):
+        cache = getattr(self.synthesizer, 'cache', None)
+        cache_writer = cache.writer(self.voice['audio_format'].value, study=self.study) if cache else None
+        try:
+            index = 0
+            while True:
+                with self._changed:
+                    while index >= len(self.segments) and not self.finished and not self.closed:
+                        self._changed.wait()
+                    if self.closed:
+                        return
+                    if index >= len(self.segments):
+                        break
+                    segment = self.segments[index]
+                    self._reading = index
+                    self._dispatch_ready()
+                while True:
+                    try:
+                        chunk = segment.chunks.get(timeout=1)
+                    except queue.Empty:
+                        if self.closed:
+                            return
+                        continue
+                    if chunk is None:
+                        break
+                    if cache_writer:
+                        cache_writer.write(chunk)
+                    yield segment.index, chunk
+                segment.chunks.close()
+                # The next segment may not even be dispatched yet, so don't wait for it to say this one is done
+                yield segment.index, None
+                index += 1
+            if self.failed:
+                print(f"TTS: audio is missing part(s) {', '.join(map(str, self.failed))} of {len(self.segments)}, "
+                      f"not cached")
+            # Only a complete reply is worth replaying
+            whole_clip = self.concatenable or len(self.segments) == 1
+            if cache_writer and whole_clip and not self.errors and self.text.strip():
+                self.clip = cache_writer.commit(self.synthesizer.cache_key(self.text, **self.voice))
+        finally:
+            with self._changed:
+                # Segments still streaming stop, the ones not started never will
+                self.closed = True
+            for segment in self.segments:
+                segment.chunks.close()
+            if cache_writer:
+                cache_writer.abort()
+
+    def _add_segments(self, texts, finished=False):
+        with self._changed:
+            for text in texts:
+                self.segments.append(_Segment(len(self.segments), text))
+            self.finished = self.finished or finished
+            self._dispatch_ready()
+            self._changed.notify_all()
+
+    def _dispatch_ready(self):
+        """Dispatch the segments that may start (call with self._changed held)"""
+        if self.closed:
+            return
+        # The first sentence goes straight away, the others once the next sentence is known
+        for segment in self.segments[:self._reading + TTS_PIPELINE_LOOKAHEAD]:
+            if segment.dispatched:
+                continue
+            is_last = segment.index == len(self.segments) - 1
+            if segment.index == 0 or not is_last or self.finished:
+                self._dispatch(segment)
+
+    def _dispatch(self, segment):
+        """Start synthesizing a segment (call with self._changed held)"""
+        segment.dispatched = True
+        earlier = self.segments[:segment.index]
+        mode = self.voice.get('text_processing', TextProcessingMode.AUTO_DETECT)
+        request = dict(self.voice)
+        request['text_content'] = normalize_text(segment.text, mode)
+        if not request['text_content']:
+            # Nothing to say (a code block, a bare link)
+            segment.chunks.put(None)
+            return
+        if segment.index + 1 < len(self.segments):
+            request['next_text'] = normalize_text(self.segments[segment.index + 1].text, mode)
+        # ElevenLabs ignores previous_text when it gets request ids, so only use them if all are known
+        ids = [earlier_segment.request_id for earlier_segment in earlier[-MAX_CONTINUITY_IDS:]]
+        if ids and all(ids):
+            request['previous_request_ids'] = ids
+        elif earlier:
+            request['previous_text'] = normalize_text(' '.join(s.text for s in earlier)[-MAX_CONTEXT_CHARS:], mode)
+        self.executor.submit(self._synthesize, segment, request)
+
+    def _synthesize(self, segment, request):
+        try:
+            stream = self._cached_stream(request)
+            if stream is None:
+                # Sentences with their context hints won't come up again, the whole reply is cached in audio()
+                stream = self.synthesizer.synthesize_speech_streaming(use_cache=False, **request)
+            segment.request_id = stream.request_id
+            try:
+                for chunk in stream:
+                    if self.closed:
+                        # Nobody reads on, so the provider request is ended early
+                        return
+                    if chunk:
+                        segment.chunks.put(chunk)
+            finally:
+                stream.close()
+        except Exception as e:
+            # Skip the sentence rather than stopping the whole reply
+            segment.failed = True
+            self.errors += 1
+            print(f"TTS failed for sentence {segment.index} of {len(self.segments)}: {e}")
+        finally:
+            segment.chunks.put(None)
+
+    def _cached_stream(self, request):
+        """The cached clip for a request without context hints (e.g. a warmed-up opening line), or None"""
+        cache = getattr(self.synthesizer, 'cache', None)
+        if cache is None or any(hint in request for hint in ('previous_text', 'next_text', 'previous_request_ids')):
+            return None
+        cached_path = cache.lookup(self.synthesizer.cache_key(**request), request['audio_format'].value)
+        return CachedAudioStream(cached_path) if cached_path else None
+
+
+def _wav_data_start(header):
+    """Where the samples start in the beginning of a WAV stream, or None if the header isn't all there yet"""
+    if header[:4] != b'RIFF':
+        # Raw samples
+        return 0
+    position = 12
+    while len(header) >= position + 8:
+        chunk_id = header[position:position + 4]
+        size = struct.unpack('<I', header[position + 4:position + 8])[0]
+        if chunk_id == b'data':
+            return position + 8
+        position += 8 + size + (size & 1)
+    return None
+
+
+def _wav_streaming_header(header):
+    """A WAV header whose sizes say the samples go on until the stream ends, so joined segments all play"""
+    if header[:4] != b'RIFF':
+        return header
+    return header[:4] + _WAV_UNKNOWN_SIZE + header[8:-4] + _WAV_UNKNOWN_SIZE
+
+
+def speak_text(synthesizer, voice, text, study=None):
+    """A SpeechPipeline synthesizing text that is already complete, in parallel chunks"""
+    pipeline = SpeechPipeline(synthesizer, voice, study=study)
+    pipeline.speak(text)
+    return pipeline
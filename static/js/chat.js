@@ -43,9 +43,13 @@ document.getElementById('chat-input').focus();
 // Scroll bottom on refresh and initialize trigger system
 document.addEventListener('DOMContentLoaded', function() {
     const chatContainer = document.getElementById('chat-messages-container');
-    chatContainer.scrollTo({
-        top: chatContainer.scrollHeight,
-        behavior: 'smooth'
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+    
+    // Only the latest turns are rendered, older ones load when scrolling up
+    chatContainer.addEventListener('scroll', function() {
+        if (chatContainer.scrollTop < 200) {
+            loadOlderTurns();
+        }
     });
     
     // Initialize message trigger system when page loads
@@ -123,6 +127,29 @@ function setupButtonEventListeners() {
     }
 }
 
+// Chat page settings are inlined into chat.html as window.chatBootstrap, so no requests are needed.
+// If they're missing (e.g. an old cached page) they are fetched once from /chat/bootstrap.
+let chatBootstrapPromise = null;
+
+function getChatSettings(key) {
+    if (!chatBootstrapPromise) {
+        chatBootstrapPromise = window.chatBootstrap
+            ? Promise.resolve(window.chatBootstrap)
+            : fetch('/chat/bootstrap')
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .catch(error => {
+                    chatBootstrapPromise = null;
+                    throw error;
+                });
+    }
+    return chatBootstrapPromise.then(bootstrap => bootstrap[key]);
+}
+
 // Quit study popup functions
 function showQuitPrompt() {
     document.getElementById('quit-prompt').style.display = 'block';
@@ -133,9 +160,8 @@ function hideQuitPrompt() {
 }
 
 function quitStudy() {
-    // Fetch the current quit URL from the backend
-    fetch('/get-redirect-urls')
-        .then(response => response.json())
+    // Get the configured quit URL
+    getChatSettings('redirect_urls')
         .then(data => {
             // Redirect to the dynamically configured URL
             window.location.href = data.quit_url;
@@ -156,9 +182,8 @@ function quitStudy() {
 }
 
 function redirectStudy() {
-    // Fetch the current redirect URL and post-survey settings
-    fetch('/get-redirect-urls')
-        .then(response => response.json())
+    // Get the configured redirect URL and post-survey settings
+    getChatSettings('redirect_urls')
         .then(data => {
             // Check if post-survey override is enabled
             if (data.use_post_survey) {
@@ -204,8 +229,7 @@ function finishStudy() {
 // function to handle the "Yes" button in the finish prompt
 function handleFinishYes() {
     // Check if post-chat popup is enabled
-    fetch('/get-url-settings')
-        .then(response => response.json())
+    getChatSettings('url_settings')
         .then(data => {
             if (data.post_chat_popup_enabled) {
                 // Show post-chat popup instead of finishing directly
@@ -410,6 +434,59 @@ function appendMessage(message, role, callback) {
     }
 }
 
+// Lazy loading of earlier turns from /chat/history
+let loadingOlderTurns = false;
+
+function createHistoryBubble(content, role) {
+    const bubble = document.createElement('div');
+    bubble.className = `chat-bubble ${role}-message`;
+    bubble.innerHTML = `<span class="${role === 'user' ? 'user-label' : 'assistant-label'}">${role === 'user' ? 'User' : 'AI'}</span>`;
+    // Same as the server-rendered transcript in chat.html
+    bubble.insertAdjacentHTML('beforeend', content);
+    return bubble;
+}
+
+function loadOlderTurns() {
+    const chatContainer = document.getElementById('chat-messages-container');
+    if (loadingOlderTurns || chatContainer.dataset.hasMore !== 'true') return;
+    loadingOlderTurns = true;
+
+    fetch(`/chat/history?before_id=${encodeURIComponent(chatContainer.dataset.oldestId)}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            const fragment = document.createDocumentFragment();
+            data.turns.forEach(turn => {
+                fragment.appendChild(createHistoryBubble(turn.message, 'user'));
+                fragment.appendChild(createHistoryBubble(turn.response, 'llm'));
+            });
+
+            // Keep the participant at the same place in the transcript
+            const previousHeight = chatContainer.scrollHeight;
+            chatContainer.insertBefore(fragment, chatContainer.firstChild);
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+
+            chatContainer.dataset.hasMore = data.has_more ? 'true' : 'false';
+            if (data.oldest_id !== null) {
+                chatContainer.dataset.oldestId = data.oldest_id;
+            }
+        })
+        .catch(error => console.error('Error loading earlier messages:', error))
+        .finally(() => {
+            loadingOlderTurns = false;
+        });
+}
+
+// Messages sent before this page load, including turns that haven't been loaded into the page
+function countExistingUserMessages() {
+    const totalTurns = document.getElementById('chat-messages-container').dataset.totalTurns;
+    return totalTurns !== undefined ? Number(totalTurns) : document.querySelectorAll('.user-message').length;
+}
+
 // Auto-scroll to bottom on manual submit 
 function appendUserMessage() {
     const inputField = document.getElementById('chat-input');
@@ -433,58 +510,276 @@ function generateAssistantResponse(userMessage) {
     const randomDelay = Math.floor(Math.random() * (1800 - 500 + 1)) + 500;
 
     setTimeout(() => {
-        const formData = new FormData();
-        formData.append('message', userMessage);
+        getChatSettings('audio')
+            .catch(() => null)
+            .then(audio => {
+                if (audio && audio.enabled) {
+                    streamAssistantResponse(userMessage, gifPlaceholder);
+                } else {
+                    requestAssistantResponse(userMessage, gifPlaceholder);
+                }
+            });
+    }, randomDelay);
+}
 
-        fetch('/chat', {
-            method: 'POST',
-            body: formData,
-        })
-        .then(response => response.json())
-        .then(data => {
-            // Remove the GIF placeholder
+function requestAssistantResponse(userMessage, gifPlaceholder) {
+    const formData = new FormData();
+    formData.append('message', userMessage);
+
+    fetch('/chat', {
+        method: 'POST',
+        body: formData,
+    })
+    .then(response => response.json())
+    .then(data => {
+        // Remove the GIF placeholder
+        gifPlaceholder.remove();
+    
+        // Show the sphere
+        const sphere = document.querySelector('.sphere');
+        sphere.classList.add('visible');
+        sphere.classList.remove('hidden');
+    
+        if (data.error) {
+            console.error('Error:', data.error);
+            appendMessage('Error retrieving response from the assistant.', 'llm', () => {
+                chatContainer.scrollTo({
+                    top: chatContainer.scrollHeight,
+                    behavior: 'smooth'
+                });
+            });
+        } else {
+            appendMessage(data.response, 'llm', () => {
+                chatContainer.scrollTo({
+                    top: chatContainer.scrollHeight,
+                    behavior: 'smooth'
+                });
+            });
+        }
+    })
+    .catch(error => {
+        // Remove the GIF placeholder
+        gifPlaceholder.remove();
+    
+        // Show the sphere
+        const sphere = document.querySelector('.sphere');
+        sphere.classList.add('visible');
+        sphere.classList.remove('hidden');
+    
+        console.error('Error:', error);
+        appendMessage('Error retrieving response from the assistant.', 'llm', () => {
+            chatContainer.scrollTo({
+                top: chatContainer.scrollHeight,
+                behavior: 'smooth'
+            });
+        });
+    });
+}
+
+// Agents with audio: the reply streams from /chat/stream as newline-delimited JSON events.
+// The text is shown as it arrives and each sentence is played as soon as its audio is complete.
+function streamAssistantResponse(userMessage, gifPlaceholder) {
+    const chatContainer = document.getElementById('chat-messages-container');
+    const player = createSpeechPlayer();
+    let messageContent = null;
+    let replyText = '';
+
+    const formData = new FormData();
+    formData.append('message', userMessage);
+    Object.entries(audioClientInfo()).forEach(([name, value]) => formData.append(name, value));
+
+    function showReply(text) {
+        if (!messageContent) {
             gifPlaceholder.remove();
-        
-            // Show the sphere
             const sphere = document.querySelector('.sphere');
             sphere.classList.add('visible');
             sphere.classList.remove('hidden');
-        
-            if (data.error) {
-                console.error('Error:', data.error);
-                appendMessage('Error retrieving response from the assistant.', 'llm', () => {
-                    chatContainer.scrollTo({
-                        top: chatContainer.scrollHeight,
-                        behavior: 'smooth'
-                    });
-                });
-            } else {
-                appendMessage(data.response, 'llm', () => {
-                    chatContainer.scrollTo({
-                        top: chatContainer.scrollHeight,
-                        behavior: 'smooth'
-                    });
-                });
+
+            const bubble = document.createElement('div');
+            bubble.className = 'chat-bubble llm-message';
+            bubble.innerHTML = '<span class="assistant-label">AI</span><span class="message-content"></span>';
+            chatContainer.appendChild(bubble);
+            messageContent = bubble.querySelector('.message-content');
+        }
+        if (typeof marked !== 'undefined') {
+            messageContent.innerHTML = marked.parse(text);
+        } else {
+            messageContent.textContent = text;
+        }
+        chatContainer.scrollTo({
+            top: chatContainer.scrollHeight,
+            behavior: 'smooth'
+        });
+    }
+
+    function handleEvent(data) {
+        if (data.type === 'start') {
+            player.audioType = data.audio_type || player.audioType;
+        } else if (data.type === 'text') {
+            replyText += data.delta;
+            showReply(replyText);
+        } else if (data.type === 'audio') {
+            player.addChunk(data.segment, data.data);
+        } else if (data.type === 'audio_error') {
+            console.warn(`No audio for sentence ${data.segment}, it is skipped`);
+        } else if (data.type === 'audio_end') {
+            player.endSegment(data.segment);
+        } else if (data.type === 'error') {
+            console.error('Error:', data.error);
+            showReply(replyText ? `${replyText}\n\n*The response was interrupted.*` : 'Error retrieving response from the assistant.');
+        } else if (data.type === 'done') {
+            showReply(data.response);
+            if (data.audio_url) {
+                addReplayButton(messageContent.parentElement, data.audio_url);
             }
-        })
-        .catch(error => {
-            // Remove the GIF placeholder
+        }
+    }
+
+    fetch('/chat/stream', {
+        method: 'POST',
+        body: formData,
+    })
+    .then(response => {
+        if (!response.ok || !response.body) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
+
+        function read() {
+            return reader.read().then(({ done, value }) => {
+                if (done) {
+                    if (buffered.trim()) {
+                        handleEvent(JSON.parse(buffered));
+                    }
+                    return;
+                }
+                buffered += decoder.decode(value, { stream: true });
+                const lines = buffered.split('\n');
+                buffered = lines.pop();
+                lines.forEach(line => {
+                    if (line.trim()) {
+                        handleEvent(JSON.parse(line));
+                    }
+                });
+                return read();
+            });
+        }
+        return read();
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        if (!messageContent) {
             gifPlaceholder.remove();
-        
-            // Show the sphere
             const sphere = document.querySelector('.sphere');
             sphere.classList.add('visible');
             sphere.classList.remove('hidden');
-        
-            console.error('Error:', error);
-            appendMessage('Error retrieving response from the assistant.', 'llm', () => {
-                chatContainer.scrollTo({
-                    top: chatContainer.scrollHeight,
-                    behavior: 'smooth'
-                });
-            });
+            appendMessage('Error retrieving response from the assistant.', 'llm');
+        }
+    });
+}
+
+// What the server needs to pick the audio format: the connection speed (so slow connections get
+// smaller audio), Save-Data, and the audio types this browser can play
+function audioClientInfo() {
+    const info = {};
+    const connection = navigator.connection || navigator.mozConnection || navigator.webkitConnection;
+    let kbps = null;
+    if (connection && connection.downlink) {
+        kbps = connection.downlink * 1000;
+    } else if (window.performance && performance.getEntriesByType) {
+        // Otherwise estimate it from how fast this page's own files came in (bits per ms = kbps)
+        let bytes = 0;
+        let ms = 0;
+        performance.getEntriesByType('resource').forEach(entry => {
+            if (entry.transferSize > 10000 && entry.duration > 0) {
+                bytes += entry.transferSize;
+                ms += entry.duration;
+            }
         });
-    }, randomDelay);
+        if (ms > 0) {
+            kbps = bytes * 8 / ms;
+        }
+    }
+    if (kbps !== null) {
+        info.connection_kbps = Math.round(kbps);
+    }
+    if (connection && connection.saveData) {
+        info.save_data = 'true';
+    }
+
+    const probe = document.createElement('audio');
+    const playable = [['audio/ogg', 'audio/ogg; codecs=opus'], ['audio/mpeg', 'audio/mpeg'], ['audio/wav', 'audio/wav']]
+        .filter(([, type]) => probe.canPlayType(type))
+        .map(([mimeType]) => mimeType);
+    if (playable.length) {
+        info.audio_accept = playable.join(', ');
+    }
+    return info;
+}
+
+// Replays a reply's audio from /chat/audio/<id> (seekable once the server has it cached)
+function addReplayButton(bubble, audioUrl) {
+    const button = document.createElement('button');
+    button.type = 'button';
+    button.className = 'replay-audio-button';
+    button.title = 'Play again';
+    button.textContent = '\u25B6';
+    let audio = null;
+    button.addEventListener('click', () => {
+        if (!audio) {
+            audio = new Audio(audioUrl);
+        }
+        audio.currentTime = 0;
+        audio.play().catch(error => console.error('Error playing audio:', error));
+    });
+    bubble.appendChild(button);
+}
+
+// Plays the sentences of a streamed reply one after another, in the order they were sent
+function createSpeechPlayer() {
+    const player = {
+        audioType: 'audio/mpeg',
+        chunks: {},
+        ready: [],
+        playing: false
+    };
+
+    player.addChunk = (segment, base64Data) => {
+        const bytes = Uint8Array.from(atob(base64Data), c => c.charCodeAt(0));
+        (player.chunks[segment] = player.chunks[segment] || []).push(bytes);
+    };
+
+    player.endSegment = (segment) => {
+        // Sentences with nothing to say (a code block) or whose synthesis failed have no audio
+        if (!player.chunks[segment]) {
+            return;
+        }
+        const blob = new Blob(player.chunks[segment], { type: player.audioType });
+        delete player.chunks[segment];
+        player.ready.push(URL.createObjectURL(blob));
+        player.playNext();
+    };
+
+    player.playNext = () => {
+        if (player.playing || player.ready.length === 0) {
+            return;
+        }
+        const url = player.ready.shift();
+        const audio = new Audio(url);
+        player.playing = true;
+        const next = () => {
+            URL.revokeObjectURL(url);
+            player.playing = false;
+            player.playNext();
+        };
+        audio.onended = next;
+        audio.onerror = next;
+        audio.play().catch(next);
+    };
+
+    return player;
 }
 
 // Stuff for the sphere icon 
@@ -517,21 +812,15 @@ let currentButtonStage = 0; // 0 = hidden, 1 = dark, 2 = orange, 3 = bouncing ar
 async function initializeTriggerSystem() {
     try {
         // Count existing user messages in the chat
-        const existingUserMessages = document.querySelectorAll('.user-message').length;
+        const existingUserMessages = countExistingUserMessages();
         messageCount = existingUserMessages;
         currentButtonStage = 0;
         sessionStartTime = Date.now();
         
         console.log(`Initializing trigger system. Found ${existingUserMessages} existing user messages.`);
-        console.log('Fetching trigger settings...');
-        
-        // Fetch trigger settings from backend
-        const response = await fetch('/get-trigger-settings');
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
+        console.log('Loading trigger settings...');
         
-        triggerSettings = await response.json();
+        triggerSettings = await getChatSettings('trigger_settings');
         
         console.log('Trigger settings loaded successfully:', triggerSettings);
         
@@ -655,7 +944,7 @@ function initializeFallbackTriggerSystem() {
     console.log('Using fallback trigger system');
     
     // Count existing user messages
-    const existingUserMessages = document.querySelectorAll('.user-message').length;
+    const existingUserMessages = countExistingUserMessages();
     messageCount = existingUserMessages;
     currentButtonStage = 0;
     
@@ -780,9 +1069,8 @@ const chatMessagesContainer = document.getElementById('chat-messages-container')
 function initializeTimer() {
     let timer = document.getElementById("timer");
     
-    // Fetch timer settings from server
-    fetch('/get-timer-settings')
-        .then(response => response.json())
+    // Timer settings come from the page bootstrap
+    getChatSettings('timer_settings')
         .then(timerSettings => {
             const durationMinutes = timerSettings.duration_minutes || 10;
             
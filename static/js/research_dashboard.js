@@ -351,6 +351,8 @@ function showForm(formId) {
         loadSurveyConfiguration();
     } else if (formId === 'post-interaction-survey') {
         loadPostSurveyConfiguration();
+    } else if (formId === 'performance-section') {
+        loadPerformanceMetrics();
     } else if (formId === 'agent-creation') {
         console.log('Agent creation form shown, loading provider status...');
         setTimeout(() => {
@@ -703,6 +705,109 @@ document.getElementById('model').addEventListener('change', function() {
     }
 });
 
+// Performance metrics (LLM latency, tokens and cost)
+let performanceRefreshTimer = null;
+
+function formatMetric(value, digits = 0) {
+    return value === null || value === undefined ? '-' : Number(value).toFixed(digits);
+}
+
+function fillPerformanceTable(tbodyId, rows, columns) {
+    const tbody = document.getElementById(tbodyId);
+    tbody.innerHTML = '';
+    if (!rows.length) {
+        const row = document.createElement('tr');
+        const cell = document.createElement('td');
+        cell.colSpan = columns.length;
+        cell.textContent = 'No data yet';
+        row.appendChild(cell);
+        tbody.appendChild(row);
+        return;
+    }
+    rows.forEach(item => {
+        const row = document.createElement('tr');
+        columns.forEach(column => {
+            const cell = document.createElement('td');
+            cell.textContent = column(item);
+            row.appendChild(cell);
+        });
+        tbody.appendChild(row);
+    });
+}
+
+function loadPerformanceMetrics() {
+    const section = document.getElementById('performance-section');
+    if (performanceRefreshTimer) {
+        clearTimeout(performanceRefreshTimer);
+        performanceRefreshTimer = null;
+    }
+
+    fetch('/get-metrics-summary')
+        .then(response => response.json())
+        .then(data => {
+            fillPerformanceTable('performance-metrics-body', data.series || [], [
+                item => item.agent,
+                item => item.model,
+                item => item.calls,
+                item => item.errors,
+                item => formatMetric(item.window_p50_latency_ms),
+                item => formatMetric(item.window_p95_latency_ms),
+                item => formatMetric(item.window_tokens_per_second, 1),
+                item => formatMetric(item.estimated_cost_usd, 4)
+            ]);
+        })
+        .catch(error => console.error('Error loading performance metrics:', error));
+
+    fetch('/get-usage-report')
+        .then(response => response.json())
+        .then(data => {
+            fillPerformanceTable('performance-usage-body', data.usage || [], [
+                item => item.agent || '-',
+                item => item.model,
+                item => item.messages,
+                item => item.prompt_tokens,
+                item => item.completion_tokens,
+                item => formatMetric(item.avg_latency_ms),
+                item => formatMetric(item.max_latency_ms)
+            ]);
+        })
+        .catch(error => console.error('Error loading usage report:', error));
+
+    fetch('/get-slow-request-profiles')
+        .then(response => response.json())
+        .then(data => {
+            document.getElementById('performance-profiles-note').textContent = data.profiling_enabled
+                ? `Requests slower than ${data.slow_request_ms} ms are profiled and saved here.`
+                : 'Profiling is off. Set PROFILE_SLOW_REQUESTS=true in .env to save profiles of slow requests.';
+            const profiles = data.profiles || [];
+            fillPerformanceTable('performance-profiles-body', profiles, [
+                item => new Date(item.created).toLocaleString(),
+                item => item.request_id,
+                item => formatMetric(item.size / 1024, 1),
+                item => item.name
+            ]);
+            // Turn the last column into a link to the saved profile
+            const rows = document.querySelectorAll('#performance-profiles-body tr');
+            profiles.forEach((item, index) => {
+                const cell = rows[index].lastChild;
+                const link = document.createElement('a');
+                link.href = `/view-request-profile/${encodeURIComponent(item.name)}`;
+                link.target = '_blank';
+                link.textContent = 'View';
+                cell.textContent = '';
+                cell.appendChild(link);
+            });
+        })
+        .catch(error => console.error('Error loading slow request profiles:', error));
+
+    // Keep refreshing while the section is open
+    performanceRefreshTimer = setTimeout(() => {
+        if (section.style.display === 'block') {
+            loadPerformanceMetrics();
+        }
+    }, 10000);
+}
+
 // Timer Settings
 function loadTimerSettings() {
     fetch('/get-timer-settings')
@@ -0,0 +1,210 @@
+# Static asset pipeline and HTTP caching for chatPsych.
+#
+# Static files: templates link to assets through asset_url('css/styles.css'), which gives a
+# content-hashed URL such as /assets/css/styles.3f2a9c1b7e.css. Because the URL changes whenever
+# the file does, browsers can cache it for a year (Cache-Control: immutable). Text assets are
+# precompressed once to .gz (and .br when the optional brotli package is installed) and the best
+# variant for the browser's Accept-Encoding is served. The old /static/ URLs still work.
+#
+# Dynamic responses: HTML and JSON get gzip when the browser accepts it, and HTML gets an ETag so
+# unchanged pages come back as 304. Pages depend on the session, so they are cached privately.
+#
+# Precompressed files go in static/.compressed. They are built on first request, or ahead of time with:
+#   python static_assets.py
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from flask import abort, request, send_file
+
+try:
+    # Optional, gives ~15-20% smaller JS/CSS than gzip: pip install brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+COMPRESSED_DIR = os.path.join(STATIC_DIR, '.compressed')
+
+# Only text files are worth compressing, images and video already are
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.html', '.svg', '.json', '.txt', '.map'}
+# Files under these folders are researcher uploads, not part of the app
+UNHASHED_PREFIXES = ('uploads/', '.compressed/')
+
+# Dynamic responses smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+
+HASH_LENGTH = 10
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+_HASHED_NAME_RE = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[A-Za-z0-9]+)$' % HASH_LENGTH)
+
+# filename -> (mtime_ns, size, content hash)
+_manifest = {}
+
+
+def _static_path(filename):
+    path = os.path.abspath(os.path.join(STATIC_DIR, filename))
+    if not path.startswith(os.path.abspath(STATIC_DIR) + os.sep):
+        return None
+    return path
+
+
+def asset_hash(filename):
+    """Short content hash of a static file, recomputed only when the file changes"""
+    path = _static_path(filename)
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cached = _manifest.get(filename)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+    _manifest[filename] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+def asset_url(filename):
+    """Content-hashed URL for a file in static/, e.g. /assets/js/chat.1a2b3c4d5e.js.
+
+    Falls back to the plain /static/ URL for uploads and missing files.
+    """
+    filename = filename.lstrip('/')
+    digest = None if filename.startswith(UNHASHED_PREFIXES) else asset_hash(filename)
+    if not digest:
+        return f'/static/{filename}'
+    stem, ext = os.path.splitext(filename)
+    return f'/assets/{stem}.{digest}{ext}'
+
+
+def _compressed_variant(filename, digest, encoding):
+    """Path of the .gz/.br copy of a static file, building it if needed"""
+    suffix = '.br' if encoding == 'br' else '.gz'
+    stem, ext = os.path.splitext(filename)
+    variant = os.path.join(COMPRESSED_DIR, f'{stem}.{digest}{ext}{suffix}')
+    if os.path.exists(variant):
+        return variant
+
+    with open(_static_path(filename), 'rb') as f:
+        data = f.read()
+    compressed = brotli.compress(data, quality=11) if encoding == 'br' else gzip.compress(data, compresslevel=9, mtime=0)
+    os.makedirs(os.path.dirname(variant), exist_ok=True)
+    # Write then rename so another worker never serves a half-written file
+    temp_path = f'{variant}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(compressed)
+    os.replace(temp_path, variant)
+
+    # Remove copies for older versions of this file
+    directory = os.path.dirname(variant)
+    base = os.path.basename(stem)
+    for name in os.listdir(directory):
+        match = _HASHED_NAME_RE.match(name[:-len(suffix)]) if name.endswith(suffix) else None
+        if match and match.group('stem') == base and match.group('ext') == ext and match.group('hash') != digest:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+    return variant
+
+
+def _preferred_encoding(filename):
+    if os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+        return None
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def build_compressed_assets():
+    """Hash and precompress every text asset in static/. Returns the number of files built."""
+    count = 0
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != 'uploads']
+        for name in files:
+            filename = os.path.relpath(os.path.join(root, name), STATIC_DIR).replace(os.sep, '/')
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            digest = asset_hash(filename)
+            _compressed_variant(filename, digest, 'gzip')
+            if brotli:
+                _compressed_variant(filename, digest, 'br')
+            count += 1
+    return count
+
+
+def serve_asset(hashed_name):
+    """Serve /assets/<hashed_name> with long-lived caching and the best precompressed variant"""
+    match = _HASHED_NAME_RE.match(hashed_name)
+    if not match:
+        abort(404)
+    filename = match.group('stem') + match.group('ext')
+    path = _static_path(filename)
+    if not path or filename.startswith(UNHASHED_PREFIXES) or not os.path.isfile(path):
+        abort(404)
+
+    digest = asset_hash(filename)
+    encoding = _preferred_encoding(filename)
+    if encoding:
+        response = send_file(_compressed_variant(filename, digest, encoding), mimetype=_mimetype(filename),
+                             etag=f'{digest}-{encoding}', conditional=True)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_file(path, etag=digest, conditional=True)
+    response.vary.add('Accept-Encoding')
+
+    if match.group('hash') == digest:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE
+    else:
+        # An old URL from a cached page. Serve the current file but don't let it stick.
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def compress_and_tag_response(response):
+    """after_request hook: gzip HTML/JSON and answer repeat HTML requests with 304"""
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+
+    if request.accept_encodings['gzip'] and response.content_length and response.content_length >= MIN_COMPRESS_BYTES:
+        # mtime=0 keeps the output identical for identical pages, so the ETag below is stable
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+
+    if response.mimetype == 'text/html' and request.method == 'GET':
+        # Pages depend on the participant's session, so only their browser may cache them
+        response.headers.setdefault('Cache-Control', 'private, no-cache')
+        response.vary.add('Cookie')
+        if 'ETag' not in response.headers:
+            response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def init_static_assets(app):
+    """Register /assets, the asset_url template helper and the response compression hook"""
+    app.add_url_rule('/assets/<path:hashed_name>', 'assets', serve_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.after_request(compress_and_tag_response)
+
+
+if __name__ == '__main__':
+    built = build_compressed_assets()
+    print(f"Precompressed {built} assets into {COMPRESSED_DIR} ({'gzip + brotli' if brotli else 'gzip only, pip install brotli for .br'})")
@@ -0,0 +1,91 @@
+# Pre-rendered survey sections.
+#
+# Each survey section is compiled once into a SurveyFragment: its HTML split into a head, the item
+# rows and a tail. Fragments are cached under a hash of the section's config, so a survey page is
+# only rendered from scratch when the researcher changes a section. When items are randomized,
+# only the pre-rendered rows are shuffled. Pages are assembled into a list and joined once.
+
+import hashlib
+import json
+import random
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+# Distinct section configs kept. Old versions of edited sections fall out of the cache.
+FRAGMENT_CACHE_SIZE = 512
+
+_fragments = OrderedDict()
+# The survey config is cached as one object until survey_config.json changes, so the same section
+# dicts come back on every request. Looking them up by identity skips hashing them each time.
+# The dict is kept alongside so its id can't be reused, and section configs must not be
+# modified in place after rendering (the dashboard always saves a new config).
+_by_identity = OrderedDict()
+_lock = threading.Lock()
+hits = 0
+misses = 0
+
+
+class SurveyFragment(NamedTuple):
+    """Rendered HTML of one survey section. rows are the items that may be shuffled."""
+    head: str
+    rows: tuple = ()
+    tail: str = ''
+    shuffle: bool = False
+
+    def render_into(self, parts, randomize_items=False):
+        """Append this section's HTML to parts, shuffling the rows if asked to"""
+        parts.append(self.head)
+        if randomize_items and self.shuffle and len(self.rows) > 1:
+            parts.extend(random.sample(self.rows, len(self.rows)))
+        else:
+            parts.extend(self.rows)
+        parts.append(self.tail)
+
+
+def config_key(*values):
+    """Stable hash of JSON-like config values"""
+    encoded = json.dumps(values, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest()
+
+
+def compiled_section(compile_section, section_type, section_id, section_config):
+    """The fragment for a section, compiled with compile_section(config, section_id) on first use"""
+    global hits, misses
+    identity = (id(section_config), section_type, section_id)
+    with _lock:
+        known = _by_identity.get(identity)
+        if known is not None and known[0] is section_config:
+            _by_identity.move_to_end(identity)
+            hits += 1
+            return known[1]
+
+    # A config seen before under another object (e.g. after a reload) is found by its content
+    key = config_key(section_type, section_id, section_config)
+    with _lock:
+        fragment = _fragments.get(key)
+    if fragment is None:
+        fragment = compile_section(section_config, section_id)
+    with _lock:
+        if key in _fragments:
+            hits += 1
+        else:
+            misses += 1
+        _fragments[key] = fragment
+        _by_identity[identity] = (section_config, fragment)
+        for cache in (_fragments, _by_identity):
+            while len(cache) > FRAGMENT_CACHE_SIZE:
+                cache.popitem(last=False)
+    return fragment
+
+
+def clear_cache():
+    global hits, misses
+    with _lock:
+        _fragments.clear()
+        _by_identity.clear()
+        hits = misses = 0
+
+
+def cache_info():
+    return {'fragments': len(_fragments), 'hits': hits, 'misses': misses}
@@ -0,0 +1,319 @@
+# Compiled survey configs.
+#
+# survey_config.json is compiled once (when it is saved, and when a changed file is loaded) into a
+# SurveyModel: the enabled sections in page order and every form field the generators will render,
+# with its column name, type, allowed values and whether it is required. Rendering walks
+# model.sections. Submissions are mapped to columns by walking model.fields, without re-reading the
+# raw config.
+#
+# The field rules below have to match the HTML the section generators in chatPsych.py produce.
+#
+# Submissions are checked against the model before they are logged (clean_submission): unknown
+# fields are dropped, Likert/slider/rating answers are stored as ints, choices must be ones the page
+# offered and text answers are length-limited.
+#
+# Settings (.env):
+#   SURVEY_TEXT_MAX_CHARS=5000          longest accepted text answer
+#   SURVEY_MAX_SUBMISSION_BYTES=65536   larger survey submissions are rejected before parsing
+
+import math
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+_COLUMN_LABEL_SANITIZE_RE = re.compile(r"[^A-Za-z0-9_]+")
+
+SURVEY_TEXT_MAX_CHARS = int(os.environ.get('SURVEY_TEXT_MAX_CHARS', 5000))
+SURVEY_MAX_SUBMISSION_BYTES = int(os.environ.get('SURVEY_MAX_SUBMISSION_BYTES', 64 * 1024))
+
+DEFAULT_LIKERT_LABELS = 'Strongly Disagree,Disagree,Neutral,Agree,Strongly Agree'
+DEFAULT_GENDER_OPTIONS = ['Female', 'Male', 'Other', 'Prefer not to say']
+
+
+def sanitize_column_label(label, fallback):
+    """Return a safe column label for HTML field names and CSV headers."""
+    candidate = (label or "").strip()
+    if not candidate:
+        candidate = (fallback or "").strip()
+    candidate = candidate.replace(" ", "_")
+    candidate = _COLUMN_LABEL_SANITIZE_RE.sub("_", candidate)
+    candidate = candidate.strip("_")
+    return candidate or "field"
+
+
+@dataclass(slots=True, frozen=True)
+class SurveyField:
+    """One form field. kind is 'int', 'number', 'choice', 'multi' (checkbox list) or 'text'."""
+    name: str
+    kind: str
+    section_id: str
+    required: bool = False
+    choices: frozenset = None
+    minimum: float = None
+    maximum: float = None
+
+    @property
+    def form_key(self):
+        # Checkbox lists are submitted as name[]
+        return f'{self.name}[]' if self.kind == 'multi' else self.name
+
+
+@dataclass(slots=True, frozen=True)
+class SurveySection:
+    section_id: str
+    section_type: str
+    config: dict
+    fields: tuple
+
+
+@dataclass(slots=True, frozen=True)
+class SurveyModel:
+    title: str
+    randomize_items: bool
+    sections: tuple
+    fields: tuple
+    required: frozenset
+    by_name: dict
+    problems: tuple = ()
+
+
+class SurveySubmissionError(ValueError):
+    """A survey submission that doesn't fit the survey it was made for"""
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _label_of(config):
+    return config.get('column_label') or config.get('columnLabel')
+
+
+def _demographics_fields(config, section_id):
+    fields = []
+    demo_fields = config.get('fields', {})
+    age = demo_fields.get('age', {})
+    if age.get('enabled', False):
+        fields.append(SurveyField(sanitize_column_label(_label_of(age), 'age'), 'int', section_id, required=True,
+                                  minimum=_int_or_none(age.get('min', 18)), maximum=_int_or_none(age.get('max', 99))))
+    gender = demo_fields.get('gender', {})
+    if gender.get('enabled', False):
+        options = gender.get('options', DEFAULT_GENDER_OPTIONS)
+        fields.append(SurveyField(sanitize_column_label(_label_of(gender), 'gender'), 'choice', section_id, required=True,
+                                  choices=frozenset(option.lower().replace(' ', '_') for option in options)))
+    return fields
+
+
+def _likert_fields(config, section_id):
+    scale_size = len(config.get('scaleLabels', DEFAULT_LIKERT_LABELS).split(','))
+    fields = []
+    for i, item in enumerate(config.get('items', [])):
+        column_label = _label_of(item) if isinstance(item, dict) else None
+        fields.append(SurveyField(sanitize_column_label(column_label, f"likert_item_{i}"), 'int', section_id,
+                                  required=True, minimum=1, maximum=scale_size))
+    return fields
+
+
+def _freetext_fields(config, section_id):
+    return [SurveyField(sanitize_column_label(_label_of(question), f"free_text_response_{i}"), 'text', section_id, required=True)
+            for i, question in enumerate(config.get('questions', []))]
+
+
+def _custom_fields(config, section_id):
+    fields = []
+    for i, field_config in enumerate(config.get('fields', [])):
+        name = sanitize_column_label(_label_of(field_config), f"custom-field-{i}")
+        field_type = field_config.get('type', 'text')
+        required = bool(field_config.get('required', False))
+        options = frozenset(option.strip() for option in field_config.get('options', '').split(',') if option.strip())
+        if field_type in ('select', 'radio'):
+            fields.append(SurveyField(name, 'choice', section_id, required=required, choices=options))
+        elif field_type == 'checkbox':
+            fields.append(SurveyField(name, 'multi', section_id, choices=options))
+        elif field_type == 'number':
+            fields.append(SurveyField(name, 'number', section_id, required=required))
+        else:
+            fields.append(SurveyField(name, 'text', section_id, required=required))
+    return fields
+
+
+def _checkbox_fields(config, section_id):
+    default = f"{section_id.replace('-', '_')}_response"
+    return [SurveyField(sanitize_column_label(_label_of(config), default), 'multi', section_id,
+                        choices=frozenset(str(option) for option in config.get('options', [])))]
+
+
+def _dropdown_fields(config, section_id):
+    default = f"{section_id.replace('-', '_')}_response"
+    return [SurveyField(sanitize_column_label(_label_of(config), default), 'choice', section_id,
+                        required=bool(config.get('required', False)),
+                        choices=frozenset(str(option) for option in config.get('options', [])))]
+
+
+def _slider_fields(config, section_id):
+    default = f"{section_id.replace('-', '_')}_response"
+    if config.get('slider_type', 'labels') == 'numeric':
+        minimum, maximum = _int_or_none(config.get('min_value', 0)), _int_or_none(config.get('max_value', 100))
+    else:
+        minimum, maximum = 1, _int_or_none(config.get('steps', 7))
+    return [SurveyField(sanitize_column_label(_label_of(config), default), 'int', section_id,
+                        required=bool(config.get('required', False)), minimum=minimum, maximum=maximum)]
+
+
+def _media_fields(config, section_id, section_type):
+    if not config.get('require_response', False):
+        return []
+    default_type = 'confirmation' if section_type == 'pdf' else 'rating'
+    response_type = config.get('response_type', default_type)
+    name = sanitize_column_label(
+        config.get('response_column_label') or config.get('responseColumnLabel') or _label_of(config),
+        f"{section_id}_{response_type}"
+    )
+    if response_type == 'rating':
+        return [SurveyField(name, 'int', section_id, required=True, minimum=1, maximum=_int_or_none(config.get('rating_scale', 10)))]
+    if response_type == 'text':
+        return [SurveyField(name, 'text', section_id, required=True)]
+    if response_type == 'checkbox':
+        return [SurveyField(name, 'multi', section_id, choices=frozenset(str(option) for option in config.get('checkbox_options', [])))]
+    if response_type == 'confirmation' and section_type == 'pdf':
+        return [SurveyField(name, 'choice', section_id, required=True, choices=frozenset({'confirmed'}))]
+    return []
+
+
+_FIELD_BUILDERS = {
+    'demographics': _demographics_fields,
+    'likert': _likert_fields,
+    'freetext': _freetext_fields,
+    'custom': _custom_fields,
+    'checkbox': _checkbox_fields,
+    'dropdown': _dropdown_fields,
+    'slider': _slider_fields,
+    'image': lambda config, section_id: _media_fields(config, section_id, 'image'),
+    'video': lambda config, section_id: _media_fields(config, section_id, 'video'),
+    'pdf': lambda config, section_id: _media_fields(config, section_id, 'pdf'),
+}
+
+
+def _section_problem(section_id, section_type, config):
+    """The first thing wrong with an enabled section that would leave it empty, or None"""
+    if section_type == 'demographics' and not config.get('fields'):
+        return "Demographics section is enabled but has no fields configured"
+    if section_type == 'likert' and not config.get('items'):
+        return "Likert section is enabled but has no items configured"
+    if section_type == 'freetext' and not config.get('questions'):
+        return "Free text section is enabled but has no questions configured"
+    if section_type == 'video' and not (config.get('file_path') or config.get('video_url')):
+        return f"Video section '{section_id}' is enabled but has no file or URL configured"
+    if section_type in ('image', 'pdf') and not config.get('file_path'):
+        return f"{section_type.title()} section '{section_id}' is enabled but has no file configured"
+    return None
+
+
+def compile_survey(config):
+    """Compile a survey config dict (pre-survey, or the post_survey part) into a SurveyModel"""
+    config = config or {}
+    sections, fields, problems = [], [], []
+    seen_names = {}
+    for section_id, section_config in config.get('sections', {}).items():
+        if not isinstance(section_config, dict) or not section_config.get('enabled', False):
+            continue
+        section_type = section_config.get('type', section_id.split('-')[0])
+        builder = _FIELD_BUILDERS.get(section_type)
+        if builder is None:
+            continue
+        problem = _section_problem(section_id, section_type, section_config)
+        if problem:
+            problems.append(problem)
+        section_fields = tuple(builder(section_config, section_id))
+        for survey_field in section_fields:
+            if survey_field.name in seen_names:
+                problems.append(f"Column label '{survey_field.name}' is used in both '{seen_names[survey_field.name]}' "
+                                f"and '{section_id}', so one would overwrite the other")
+            seen_names[survey_field.name] = section_id
+        sections.append(SurveySection(section_id, section_type, section_config, section_fields))
+        fields.extend(section_fields)
+
+    return SurveyModel(
+        title=config.get('title', 'Survey Form'),
+        randomize_items=bool(config.get('settings', {}).get('randomizeItems', False)),
+        sections=tuple(sections),
+        fields=tuple(fields),
+        required=frozenset(survey_field.name for survey_field in fields if survey_field.required),
+        by_name={survey_field.name: survey_field for survey_field in fields},
+        problems=tuple(problems),
+    )
+
+
+# Compiled models by config identity. The cached survey config is one shared dict until the file
+# changes (see get_cached_survey_config), so this only compiles once per saved version.
+_compiled = {}
+_compiled_lock = threading.Lock()
+_COMPILED_KEEP = 16
+
+
+def survey_model(config):
+    """The compiled model for a survey config dict, compiling it on first use"""
+    known = _compiled.get(id(config))
+    if known is not None and known[0] is config:
+        return known[1]
+    model = compile_survey(config)
+    with _compiled_lock:
+        if len(_compiled) >= _COMPILED_KEEP:
+            _compiled.pop(next(iter(_compiled)))
+        # Keep the dict alive with its model so its id can't be reused by another config
+        _compiled[id(config)] = (config, model)
+    return model
+
+
+def _coerce_number(survey_field, value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise SurveySubmissionError(f"'{survey_field.name}' must be a number")
+    # float() also takes "nan" and "inf", which json.dump would write as invalid JSON
+    if not math.isfinite(number):
+        raise SurveySubmissionError(f"'{survey_field.name}' must be a number")
+    if survey_field.kind == 'int' and not number.is_integer():
+        raise SurveySubmissionError(f"'{survey_field.name}' must be a whole number")
+    if (survey_field.minimum is not None and number < survey_field.minimum) or \
+            (survey_field.maximum is not None and number > survey_field.maximum):
+        raise SurveySubmissionError(f"'{survey_field.name}' must be between {survey_field.minimum} and {survey_field.maximum}")
+    return int(number) if number.is_integer() else number
+
+
+def clean_submission(model, form_data):
+    """Answers from a submitted survey form as {column name: value}, in page order.
+
+    Only fields of the survey are kept. Numbers are converted, choices and lengths are checked,
+    and anything that doesn't fit raises SurveySubmissionError. Unanswered fields are left out.
+    """
+    answers = {}
+    for survey_field in model.fields:
+        if survey_field.kind == 'multi':
+            values = [value for value in form_data.getlist(survey_field.form_key) if value.strip() != '']
+            if not values:
+                continue
+            if survey_field.choices and not set(values) <= survey_field.choices:
+                raise SurveySubmissionError(f"'{survey_field.name}' has an option that isn't on the survey")
+            # Each option once, in the order they were ticked
+            answers[survey_field.name] = list(dict.fromkeys(values))
+            continue
+
+        value = form_data.get(survey_field.form_key)
+        if value is None or value.strip() == '':
+            continue
+        if survey_field.kind in ('int', 'number'):
+            answers[survey_field.name] = _coerce_number(survey_field, value.strip())
+        elif survey_field.kind == 'choice':
+            if survey_field.choices and value not in survey_field.choices:
+                raise SurveySubmissionError(f"'{survey_field.name}' has an option that isn't on the survey")
+            answers[survey_field.name] = value
+        else:
+            if len(value) > SURVEY_TEXT_MAX_CHARS:
+                raise SurveySubmissionError(f"'{survey_field.name}' is longer than {SURVEY_TEXT_MAX_CHARS} characters")
+            answers[survey_field.name] = value
+    return answers
@@ -0,0 +1,54 @@
+# Choosing the audio format for a client (negotiate_audio_format in speech_pipeline.py).
+# Run with: python -m pytest tests
+
+import pytest
+
+from API_AUDIO import AudioFormat
+from speech_pipeline import AUDIO_LOW_BANDWIDTH_KBPS, negotiate_audio_format
+
+# What chat.js reports for a browser that plays Ogg Opus, and for one that doesn't
+OPUS_BROWSER = 'audio/ogg, audio/mpeg, audio/wav'
+MP3_BROWSER = 'audio/mpeg, audio/wav'
+SLOW = AUDIO_LOW_BANDWIDTH_KBPS / 2
+FAST = AUDIO_LOW_BANDWIDTH_KBPS * 10
+
+
+class FakeSynthesizer:
+    def __init__(self, formats=None):
+        self.formats = formats
+
+    def supports_format(self, audio_format):
+        return self.formats is None or audio_format in self.formats
+
+
+def voice(audio_format=AudioFormat.MP3_PROFESSIONAL_128):
+    return {'voice_id': 'v', 'audio_format': audio_format}
+
+
+@pytest.mark.parametrize('accept, kbps, save_data, expected', [
+    (None, None, False, (AudioFormat.MP3_PROFESSIONAL_128, 'agent')),
+    (OPUS_BROWSER, FAST, False, (AudioFormat.MP3_PROFESSIONAL_128, 'agent')),
+    (OPUS_BROWSER, SLOW, False, (AudioFormat.OPUS_COMPACT_32, 'low_bandwidth')),
+    (MP3_BROWSER, SLOW, False, (AudioFormat.MP3_COMPACT_32, 'low_bandwidth')),
+    (OPUS_BROWSER, None, True, (AudioFormat.OPUS_COMPACT_32, 'save_data')),
+    # Wildcards don't count as being able to play Opus
+    ('*/*', SLOW, False, (AudioFormat.MP3_COMPACT_32, 'low_bandwidth')),
+    ('audio/ogg;q=0, audio/mpeg', SLOW, False, (AudioFormat.MP3_COMPACT_32, 'low_bandwidth')),
+])
+def test_negotiation(accept, kbps, save_data, expected):
+    assert negotiate_audio_format(voice(), FakeSynthesizer(), accept, kbps, save_data) == expected
+
+
+def test_browsers_that_cant_play_the_agent_format_get_mp3():
+    agent_voice = voice(AudioFormat.OPUS_COMPACT_32)
+    assert negotiate_audio_format(agent_voice, FakeSynthesizer(), OPUS_BROWSER, FAST) == (AudioFormat.OPUS_COMPACT_32, 'agent')
+    assert negotiate_audio_format(agent_voice, FakeSynthesizer(), MP3_BROWSER, FAST) == (AudioFormat.MP3_PROFESSIONAL_128, 'accept')
+
+
+def test_only_formats_the_synthesizer_produces():
+    local = FakeSynthesizer({AudioFormat.WAV_22050, AudioFormat.MP3_PROFESSIONAL_128})
+    assert negotiate_audio_format(voice(AudioFormat.WAV_22050), local, OPUS_BROWSER, SLOW) == (AudioFormat.WAV_22050, 'agent')
+
+
+def test_nothing_playable_falls_back_to_the_agent_format():
+    assert negotiate_audio_format(voice(), FakeSynthesizer(), 'video/mp4', FAST) == (AudioFormat.MP3_PROFESSIONAL_128, 'agent')
@@ -0,0 +1,163 @@
+# Streamed chat replies (/chat/stream in chatPsych.py): the order of the NDJSON events and which
+# turns are saved when the participant leaves or the provider breaks off.
+# Run with: python -m pytest tests
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from API_AUDIO import AudioFormat, TextProcessingMode
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeReply:
+    """Stands in for API_LLM.StreamedReply"""
+
+    model = 'fake-model'
+    prompt_tokens = completion_tokens = total_tokens = 0
+    ttft_ms = latency_ms = 1.0
+
+    def __init__(self, deltas, break_after=None, delay=0):
+        self.deltas = deltas
+        self.break_after = break_after
+        self.delay = delay
+        self.text = ''
+        self.logprobs_list = []
+        self.error = None
+        self.truncated = False
+
+    def __iter__(self):
+        for number, delta in enumerate(self.deltas):
+            if number == self.break_after:
+                # What StreamedReply does when the provider fails halfway
+                self.error = 'APIConnectionError'
+                self.truncated = True
+                return
+            time.sleep(self.delay)
+            self.text += delta
+            yield delta
+
+
+class FakeStream:
+    request_id = None
+
+    def __init__(self, text):
+        self.text = text
+
+    def __iter__(self):
+        yield self.text.encode()
+
+    def close(self):
+        pass
+
+
+class FakeSynthesizer:
+    cache = None
+
+    def supports_format(self, audio_format):
+        return True
+
+    def synthesize_speech_streaming(self, use_cache=False, **request):
+        return FakeStream(request['text_content'])
+
+
+class SavedTurns(list):
+    def __init__(self):
+        super().__init__()
+        self.stored = threading.Event()
+
+
+@pytest.fixture(scope='module')
+def chat_app(tmp_path_factory):
+    # chatPsych keeps users.db in the working directory and reads the default agent from there
+    os.environ.setdefault('FLASK_SECRET_KEY', 'test')
+    cwd = os.getcwd()
+    app_dir = tmp_path_factory.mktemp('app')
+    os.symlink(os.path.join(REPO_DIR, 'agents'), app_dir / 'agents')
+    os.chdir(app_dir)
+    try:
+        import chatPsych
+        yield chatPsych
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def saved(chat_app, monkeypatch):
+    """The turns add_message was asked to save, as (message, response, audio)"""
+    turns = SavedTurns()
+
+    def add_message(user_id, password, message, response, *args, audio=None, **kwargs):
+        turns.append((message, response, audio))
+        turns.stored.set()
+        return len(turns)
+
+    monkeypatch.setattr(chat_app, 'add_message', add_message)
+    return turns
+
+
+def stream_client(chat_app, monkeypatch, reply, audio=False):
+    monkeypatch.setattr(chat_app.API, 'thinkAbout_stream', lambda message, conversation, model=None: reply)
+    monkeypatch.setattr(chat_app, 'get_agent_config', lambda agent: {'PrePrompt': ''})
+    monkeypatch.setattr(chat_app.API, 'set_agent_data', lambda agent_config: None)
+    monkeypatch.setattr(chat_app, 'get_messages', lambda user_id, password: [])
+    voice = {'voice_id': 'v', 'audio_format': AudioFormat.MP3_PROFESSIONAL_128,
+             'text_processing': TextProcessingMode.AUTO_DETECT} if audio else None
+    monkeypatch.setattr(chat_app, 'agent_voice', lambda agent_config: voice)
+    monkeypatch.setattr(chat_app, 'agent_synthesizer', lambda agent_config: FakeSynthesizer())
+    client = chat_app.app.test_client()
+    with client.session_transaction() as session:
+        session.update(username='participant', user_id='u1', password='pw', agent='default', survey_completed=True)
+    return client
+
+
+def events_of(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_text_events_then_done(chat_app, monkeypatch, saved):
+    client = stream_client(chat_app, monkeypatch, FakeReply(['Hello ', 'there.']))
+    events = events_of(client.post('/chat/stream', data={'message': 'hi'}))
+    assert [event['type'] for event in events] == ['start', 'text', 'text', 'done']
+    assert events[0]['audio_type'] is None
+    assert events[-1]['response'] == 'Hello there.'
+    assert saved == [('hi', 'Hello there.', None)]
+
+
+def test_audio_events_come_in_segment_order_before_done(chat_app, monkeypatch, saved):
+    sentences = ['The first sentence is long enough. ', 'The second sentence is long enough too. ',
+                 'And this is the third one, also long.']
+    client = stream_client(chat_app, monkeypatch, FakeReply(sentences), audio=True)
+    events = events_of(client.post('/chat/stream', data={'message': 'hi'}))
+    types = [event['type'] for event in events]
+    assert types[0] == 'start' and types[-1] == 'done'
+    assert events[0]['audio_type'] == 'audio/mpeg'
+    audio_events = [event for event in events if event['type'] in ('audio', 'audio_end')]
+    assert [(event['type'], event['segment']) for event in audio_events] == [
+        ('audio', 0), ('audio_end', 0), ('audio', 1), ('audio_end', 1), ('audio', 2), ('audio_end', 2)]
+    assert events[-1]['audio_url'].startswith('/chat/audio/1')
+    assert saved[0][1] == ''.join(sentences)
+    assert saved[0][2]['format'] == 'mp3_44100_128'
+
+
+@pytest.mark.parametrize('audio', [False, True])
+def test_reply_is_saved_when_the_participant_leaves(chat_app, monkeypatch, saved, audio):
+    deltas = [f'word{number} ' for number in range(50)]
+    client = stream_client(chat_app, monkeypatch, FakeReply(deltas, delay=0.01), audio=audio)
+    response = client.post('/chat/stream', data={'message': 'hi'}, buffered=False)
+    first_event = json.loads(next(iter(response.response)))
+    assert first_event['type'] == 'start'
+    response.close()
+    assert saved.stored.wait(10)
+    assert saved[0][1] == ''.join(deltas)
+
+
+def test_reply_that_breaks_off_is_reported_and_not_saved(chat_app, monkeypatch, saved):
+    client = stream_client(chat_app, monkeypatch, FakeReply(['Half ', 'a ', 'reply'], break_after=2))
+    events = events_of(client.post('/chat/stream', data={'message': 'hi'}))
+    assert [event['type'] for event in events] == ['start', 'text', 'text', 'error']
+    assert saved == []
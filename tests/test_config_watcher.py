@@ -0,0 +1,91 @@
+# The config watcher (config_watcher.py): versions move on when a watched file changes, and
+# fingerprints only follow the files themselves.
+# Run with: python -m pytest tests
+
+import time
+
+import pytest
+
+import config_watcher as config_watcher_module
+from config_watcher import ConfigWatcher
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture(params=['poll', 'auto'])
+def watcher(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(config_watcher_module, 'CONFIG_WATCH_MODE', request.param)
+    monkeypatch.setattr(config_watcher_module, 'CONFIG_POLL_SECONDS', 0.05)
+    (tmp_path / 'kind.json').write_text('{"PrePrompt": "Be kind."}')
+    watcher = ConfigWatcher()
+    watcher.watch(str(tmp_path), 'agents', lambda name: name.endswith('.json'))
+    watcher.version('agents')
+    yield watcher
+    watcher.stop()
+
+
+def test_editing_a_file_moves_the_version_on(watcher, tmp_path):
+    before = watcher.version('agents')
+    fingerprint = watcher.fingerprint('agents')
+    # A poll only notices a different mtime or size
+    time.sleep(0.05)
+    (tmp_path / 'kind.json').write_text('{"PrePrompt": "Be very kind."}')
+    assert wait_for(lambda: watcher.version('agents') != before)
+    assert watcher.fingerprint('agents') != fingerprint
+
+
+def test_other_files_are_ignored(watcher, tmp_path):
+    before = watcher.version('agents')
+    (tmp_path / 'notes.txt').write_text('not an agent')
+    time.sleep(0.3)
+    assert watcher.version('agents') == before
+
+
+def test_new_and_removed_files_count(watcher, tmp_path):
+    before = watcher.version('agents')
+    (tmp_path / 'new.json').write_text('{}')
+    assert wait_for(lambda: watcher.version('agents') != before)
+    before = watcher.version('agents')
+    (tmp_path / 'new.json').unlink()
+    assert wait_for(lambda: watcher.version('agents') != before)
+
+
+def test_bump_is_seen_straight_away(watcher):
+    before = watcher.version('agents')
+    watcher.bump('agents')
+    assert watcher.version('agents') != before
+    assert watcher.status()['generations']['agents'] >= 1
+
+
+def test_versions_differ_between_watchers_but_fingerprints_agree(watcher, tmp_path):
+    other = ConfigWatcher()
+    other.watch(str(tmp_path), 'agents', lambda name: name.endswith('.json'))
+    try:
+        assert other.version('agents') != watcher.version('agents')
+        assert other.fingerprint('agents') == watcher.fingerprint('agents')
+    finally:
+        other.stop()
+
+
+def test_fingerprint_is_only_recomputed_for_a_new_version(tmp_path, monkeypatch):
+    # No watcher thread gets to see the edit, so only bump() can tell
+    monkeypatch.setattr(config_watcher_module, 'CONFIG_WATCH_MODE', 'poll')
+    monkeypatch.setattr(config_watcher_module, 'CONFIG_POLL_SECONDS', 3600)
+    (tmp_path / 'kind.json').write_text('{}')
+    watcher = ConfigWatcher()
+    watcher.watch(str(tmp_path), 'agents', lambda name: name.endswith('.json'))
+    try:
+        fingerprint = watcher.fingerprint('agents')
+        (tmp_path / 'kind.json').write_text('{"changed": true}')
+        assert watcher.fingerprint('agents') == fingerprint
+        watcher.bump('agents')
+        assert watcher.fingerprint('agents') != fingerprint
+    finally:
+        watcher.stop()
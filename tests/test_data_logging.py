@@ -0,0 +1,132 @@
+# Crash recovery and quarantine of the data log queue (data_logging.py).
+# Run with: python -m pytest tests
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+import data_logging
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A worker whose writer thread hangs on its first batch, so every record it submits is still
+# queued (or mid-batch) and only on disk in its journal when it is killed
+CRASHING_WORKER = textwrap.dedent('''
+    import sys, threading
+    import data_logging
+    data_dir = sys.argv[1]
+    data_logging.DATA_DIR = data_dir
+    data_logging.JOURNAL_DIR = data_dir + '/.log_journal'
+    data_logging.WRITE_LOCK_PATH = data_dir + '/.data_log.lock'
+    data_logging.data_log.register('test', lambda records: threading.Event().wait())
+    for i in range(int(sys.argv[2])):
+        data_logging.data_log.submit('test', {'id': i})
+    print('submitted', flush=True)
+    threading.Event().wait()
+''')
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_logging, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(data_logging, 'JOURNAL_DIR', str(tmp_path / '.log_journal'))
+    monkeypatch.setattr(data_logging, 'WRITE_LOCK_PATH', str(tmp_path / '.data_log.lock'))
+    monkeypatch.setattr(data_logging, 'QUARANTINE_PATH', str(tmp_path / 'data_log_quarantine.jsonl'))
+    monkeypatch.setattr(data_logging, 'DATA_LOG_MODE', 'async')
+    monkeypatch.setattr(data_logging, 'LOG_AGGREGATOR_SOCKET', '')
+    return tmp_path
+
+
+def start_queue(written, fail_on=()):
+    def write_batch(records):
+        if any(record['id'] in fail_on for record in records):
+            raise ValueError('cannot write this record')
+        written.extend(record['id'] for record in records)
+    log = data_logging.DataLogQueue()
+    log.register('test', write_batch)
+    return log
+
+
+def test_records_queued_in_a_killed_worker_are_replayed_exactly_once(data_dir):
+    record_count = 250
+    worker = subprocess.Popen([sys.executable, '-c', CRASHING_WORKER, str(data_dir), str(record_count)],
+                              cwd=REPO_DIR, stdout=subprocess.PIPE, text=True)
+    try:
+        assert worker.stdout.readline().strip() == 'submitted'
+    finally:
+        worker.send_signal(signal.SIGKILL)
+        worker.wait()
+        worker.stdout.close()
+
+    written = []
+    log = start_queue(written)
+    log.submit('test', {'id': 'after restart'})
+    assert log.flush()
+    log.close()
+
+    assert sorted(id for id in written if id != 'after restart') == list(range(record_count))
+    assert written.count('after restart') == 1
+    assert log.recovered == record_count
+    # The replayed journal is gone, so a third worker has nothing left to replay
+    again = []
+    third = start_queue(again)
+    third.submit('test', {'id': 'third'})
+    assert third.flush()
+    third.close()
+    assert again == ['third']
+
+
+def test_a_record_that_keeps_failing_is_quarantined_and_the_queue_keeps_draining(data_dir, monkeypatch):
+    monkeypatch.setattr(data_logging, 'DATA_LOG_MAX_RETRIES', 2)
+    monkeypatch.setattr(data_logging, 'DATA_LOG_RETRY_DELAY', 0.01)
+    written = []
+    log = start_queue(written, fail_on={3})
+    for i in range(6):
+        log.submit('test', {'id': i})
+    assert log.flush()
+    log.submit('test', {'id': 6})
+    assert log.flush()
+    log.close()
+
+    assert sorted(written) == [0, 1, 2, 4, 5, 6]
+    with open(data_logging.QUARANTINE_PATH) as f:
+        quarantined = [json.loads(line) for line in f]
+    assert [(entry['kind'], entry['record']) for entry in quarantined] == [('test', {'id': 3})]
+    assert log.quarantined == 1
+    # Nothing is left in the journal to replay
+    assert not os.listdir(data_logging.JOURNAL_DIR)
+
+
+def test_a_full_queue_does_not_hold_up_the_request(data_dir, monkeypatch):
+    monkeypatch.setattr(data_logging, 'DATA_LOG_QUEUE_SIZE', 1)
+    monkeypatch.setattr(data_logging, 'DATA_LOG_ENQUEUE_TIMEOUT', 0.01)
+    monkeypatch.setattr(data_logging, 'DATA_LOG_RETRY_DELAY', 0.2)
+    written = []
+    healthy = threading.Event()
+
+    def write_batch(records):
+        # Writes fail until the disk "recovers", keeping the writer busy retrying
+        if not healthy.is_set():
+            raise OSError('disk full')
+        written.extend(record['id'] for record in records)
+
+    log = data_logging.DataLogQueue()
+    log.register('test', write_batch)
+    started = time.monotonic()
+    for i in range(10):
+        log.submit('test', {'id': i})
+    assert time.monotonic() - started < 1
+    assert log.overflow_writes > 0
+
+    healthy.set()
+    assert log.flush(timeout=20)
+    log.close()
+    assert sorted(written) == list(range(10))
+    assert log.quarantined == 0
@@ -0,0 +1,90 @@
+# A batch the log aggregator confirms too late must not be written twice (log_aggregator.py).
+# Run with: python -m pytest tests
+
+import threading
+import time
+
+import pytest
+
+import data_logging
+import log_aggregator
+
+
+@pytest.fixture
+def aggregator(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_logging, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(data_logging, 'JOURNAL_DIR', str(tmp_path / '.log_journal'))
+    monkeypatch.setattr(data_logging, 'WRITE_LOCK_PATH', str(tmp_path / '.data_log.lock'))
+    monkeypatch.setattr(data_logging, 'QUARANTINE_PATH', str(tmp_path / 'data_log_quarantine.jsonl'))
+    monkeypatch.setattr(data_logging, 'DATA_LOG_MODE', 'async')
+    monkeypatch.setattr(data_logging, 'LOG_AGGREGATOR_TIMEOUT', 0.3)
+    monkeypatch.setattr(data_logging, 'DATA_LOG_RETRY_DELAY', 0.05)
+    socket_path = str(tmp_path / 'aggregator.sock')
+    monkeypatch.setattr(data_logging, 'LOG_AGGREGATOR_SOCKET', socket_path)
+
+    written = []
+    calls = []
+
+    def slow_first_batch(records):
+        calls.append(len(records))
+        if len(calls) == 1:
+            time.sleep(1.0)  # longer than LOG_AGGREGATOR_TIMEOUT
+        written.extend(record['id'] for record in records)
+
+    monkeypatch.setitem(data_logging.data_log._writers, 'test', slow_first_batch)
+    aggregator = log_aggregator.LogAggregator()
+    aggregator.start()
+    server = log_aggregator._Server(socket_path, log_aggregator._WorkerConnection)
+    server.aggregator = aggregator
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield aggregator, written
+    server.shutdown()
+    server.server_close()
+    aggregator.stop()
+
+
+def test_a_batch_resent_after_a_timeout_is_written_once(aggregator):
+    aggregator, written = aggregator
+
+    def worker_must_not_write(records):
+        raise AssertionError('the worker wrote a batch the aggregator already had')
+
+    log = data_logging.DataLogQueue()
+    log.register('test', worker_must_not_write)
+    for i in range(5):
+        log.submit('test', {'id': i})
+    assert log.flush(timeout=10)
+    log.close()
+
+    assert sorted(written) == [0, 1, 2, 3, 4]
+    assert aggregator.duplicates >= 1
+    assert log.aggregator_fallbacks == 0
+
+
+def test_a_batch_that_keeps_timing_out_is_resent_later_not_split_or_quarantined(aggregator, monkeypatch):
+    aggregator, written = aggregator
+    monkeypatch.setattr(data_logging, 'DATA_LOG_MAX_RETRIES', 0)
+
+    def worker_must_not_write(records):
+        raise AssertionError('the worker wrote a batch the aggregator already had')
+
+    log = data_logging.DataLogQueue()
+    log.register('test', worker_must_not_write)
+    for i in range(5):
+        log.submit('test', {'id': i})
+    assert log.flush(timeout=10)
+    log.close()
+
+    assert sorted(written) == [0, 1, 2, 3, 4]
+    assert log.quarantined == 0
+
+
+def test_parts_of_a_written_batch_are_not_written_again(aggregator):
+    aggregator, written = aggregator
+    aggregator.write([('test', {'id': 'a'}), ('test', {'id': 'b'})], 'batch-1')
+    aggregator.write([('test', {'id': 'a'})], 'batch-1:0')
+    aggregator.write([('test', {'id': 'b'})], 'batch-1:1')
+    # A part of a batch it never saw is written
+    aggregator.write([('test', {'id': 'c'})], 'batch-2:0')
+    assert sorted(written) == ['a', 'b', 'c']
+    assert aggregator.duplicates == 2
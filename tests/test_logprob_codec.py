@@ -0,0 +1,71 @@
+# Packing logprobs into float32/float16 arrays and the JSON/CSV forms they are exported in
+# (logprob_codec.py).
+# Run with: python -m pytest tests
+
+import math
+
+import pytest
+
+from logprob_codec import (csv_logprobs, decode_logprobs, encode_logprobs, pack_logprobs, summarize_logprobs,
+                           to_numpy, unpack_logprobs)
+
+LOGPROBS = [-0.5, -1.25, -0.0078125, -12.0]
+
+
+@pytest.mark.parametrize('dtype', ['f32', 'f16'])
+def test_round_trip(dtype):
+    blob = pack_logprobs(LOGPROBS, dtype)
+    assert len(blob) == len(LOGPROBS) * (4 if dtype == 'f32' else 2)
+    assert unpack_logprobs(blob, dtype) == LOGPROBS
+    assert decode_logprobs(encode_logprobs(LOGPROBS, dtype)) == LOGPROBS
+
+
+def test_empty_lists():
+    assert pack_logprobs([]) is None
+    assert unpack_logprobs(None) == []
+    assert encode_logprobs([]) == {'encoding': 'f32le-b64', 'data': '', 'count': 0}
+    assert csv_logprobs(encode_logprobs([])) == ''
+    assert decode_logprobs('') == []
+
+
+def test_f16_keeps_values_beyond_its_range_at_its_largest():
+    assert unpack_logprobs(pack_logprobs([-70000.0, 1e6, -3.0], 'f16'), 'f16') == [-65504.0, 65504.0, -3.0]
+    assert unpack_logprobs(pack_logprobs([-1e39], 'f32'), 'f32') == [-3.4028234663852886e38]
+    infinite = unpack_logprobs(pack_logprobs([float('-inf'), float('nan')], 'f16'), 'f16')
+    assert infinite[0] == float('-inf') and math.isnan(infinite[1])
+
+
+def test_f16_is_approximate():
+    decoded = decode_logprobs(encode_logprobs([-0.1234567], 'f16'))
+    assert decoded[0] == pytest.approx(-0.1234567, abs=1e-3)
+
+
+def test_csv_cell_carries_its_dtype():
+    cell = csv_logprobs(encode_logprobs(LOGPROBS, 'f16'))
+    assert cell.startswith('f16:')
+    # Decoded as f16 whatever dtype the caller assumes
+    assert decode_logprobs(cell, 'f32') == LOGPROBS
+    # Cells of older exports have no prefix and use the dtype given
+    legacy = encode_logprobs(LOGPROBS, 'f32')['data']
+    assert decode_logprobs(legacy) == LOGPROBS
+    with pytest.raises(ValueError):
+        decode_logprobs('f64:AAAA')
+
+
+def test_older_exports_with_plain_lists():
+    assert decode_logprobs(LOGPROBS) == LOGPROBS
+
+
+def test_to_numpy_reads_every_form():
+    np = pytest.importorskip('numpy')
+    encoded = encode_logprobs(LOGPROBS, 'f16')
+    for value in (encoded, csv_logprobs(encoded)):
+        array = to_numpy(value)
+        assert array.dtype == np.float16
+        assert array.tolist() == LOGPROBS
+    assert to_numpy(pack_logprobs(LOGPROBS)).tolist() == LOGPROBS
+
+
+def test_summary():
+    assert summarize_logprobs(LOGPROBS) == {'count': 4, 'sum': sum(LOGPROBS), 'mean': sum(LOGPROBS) / 4, 'min': -12.0}
+    assert summarize_logprobs([]) == {'count': 0, 'sum': 0, 'mean': None, 'min': None}
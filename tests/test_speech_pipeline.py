@@ -0,0 +1,166 @@
+# Cutting text for synthesis (tts_text.split_text, SentenceSegmenter) and relaying the segments'
+# audio (speech_pipeline.py): buffering ahead of a slow reader and WAV clips stitched from parts.
+# Run with: python -m pytest tests
+
+import struct
+import threading
+
+import pytest
+
+import speech_pipeline
+from API_AUDIO import AudioFormat, TextProcessingMode
+from speech_pipeline import SentenceSegmenter, _SegmentBuffer, speak_text
+from tts_text import split_text
+
+
+def wav_header(data_size=1000):
+    fmt = struct.pack('<HHIIHH', 1, 1, 22050, 44100, 2, 16)
+    return (b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+            + b'LIST' + struct.pack('<I', 3) + b'abc\0' + b'data' + struct.pack('<I', data_size))
+
+
+class FakeStream:
+    request_id = None
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.finished = threading.Event()
+
+    def __iter__(self):
+        yield from self.chunks
+        self.finished.set()
+
+    def close(self):
+        pass
+
+
+class FakeSynthesizer:
+    """Each segment's audio is made by make_chunks(text)"""
+
+    cache = None
+
+    def __init__(self, make_chunks):
+        self.make_chunks = make_chunks
+        self.streams = []
+
+    def synthesize_speech_streaming(self, use_cache=False, **request):
+        stream = FakeStream(self.make_chunks(request['text_content']))
+        self.streams.append(stream)
+        return stream
+
+
+def voice(audio_format):
+    return {'voice_id': 'v', 'audio_format': AudioFormat(audio_format), 'text_processing': TextProcessingMode.AUTO_DETECT}
+
+
+def long_text(sentences=30):
+    return ' '.join(f'This is sentence number {number}, and it has a clause.' for number in range(sentences))
+
+
+def test_split_text_keeps_short_text_whole():
+    assert split_text('  Hello there.  ') == ['Hello there.']
+    assert split_text('   ') == []
+
+
+def test_split_text_cuts_at_sentences_then_clauses_then_words():
+    text = long_text()
+    chunks = split_text(text, 120)
+    assert all(len(chunk) <= 120 for chunk in chunks)
+    assert all(chunk.endswith('.') for chunk in chunks)
+    assert ' '.join(chunks) == text
+
+    clauses = split_text('one two three, four five six, seven eight nine, ten eleven twelve', 30)
+    assert all(len(chunk) <= 30 for chunk in clauses)
+    assert clauses[0].endswith(',')
+
+    assert split_text('x' * 25, 10) == ['x' * 10, 'x' * 10, 'x' * 5]
+
+
+def test_segmenter_joins_short_sentences_and_flushes_the_rest():
+    segmenter = SentenceSegmenter(min_chars=20, max_chars=500)
+    segments = []
+    for token in 'Hi. Okay. This one is a longer sentence. And the end'.split(' '):
+        segments += segmenter.feed(token + ' ')
+    assert segments == ['Hi. Okay. This one is a longer sentence.']
+    assert segmenter.flush() == ['And the end']
+    assert segmenter.flush() == []
+
+
+def test_segmenter_sends_a_runaway_sentence_in_parts():
+    segmenter = SentenceSegmenter(min_chars=5, max_chars=50)
+    segments = []
+    for number in range(40):
+        segments += segmenter.feed(f'word{number}, ')
+    assert segments and all(len(segment) <= 50 for segment in segments)
+    rest = segmenter.flush()
+    assert ' '.join(segments + rest) == ' '.join(f'word{number},' for number in range(40))
+
+
+def test_segment_buffer_spools_overflow_in_order():
+    buffer = _SegmentBuffer(max_chunks=3)
+    for number in range(10):
+        buffer.put(b'%d;' % number)
+    assert buffer.get() == b'0;'
+    buffer.put(b'10;')
+    buffer.put(None)
+    received = b'0;'
+    while (chunk := buffer.get(timeout=1)) is not None:
+        received += chunk
+    assert received == b''.join(b'%d;' % number for number in range(11))
+
+
+def test_slow_reader_does_not_hold_the_provider_stream(monkeypatch):
+    monkeypatch.setattr(speech_pipeline, 'TTS_SEGMENT_BUFFER_CHUNKS', 4)
+    synthesizer = FakeSynthesizer(lambda text: [text.encode()] * 200)
+    pipeline = speak_text(synthesizer, voice('mp3_44100_128'), long_text())
+    audio = pipeline.audio()
+    received = [next(audio)[1]]
+    # Streams are read to the end although nobody reads their audio yet
+    for stream in list(synthesizer.streams):
+        assert stream.finished.wait(5)
+    received += [chunk for _, chunk in audio if chunk is not None]
+    assert b''.join(received) == b''.join(segment.text.encode() * 200 for segment in pipeline.segments)
+    assert not pipeline.failed
+
+
+def test_wav_clip_has_one_header_and_every_segment_in_order():
+    def make_chunks(text):
+        samples = text.encode()
+        header = wav_header(len(samples))
+        # The header arrives split over chunks
+        return [header[:10], header[10:30], header[30:] + samples[:5], samples[5:]]
+
+    text = long_text()
+    pipeline = speak_text(FakeSynthesizer(make_chunks), voice('wav_22050'), text)
+    clip = b''.join(pipeline.clip_audio())
+    header = wav_header()
+    data_start = len(header)
+    assert clip.count(b'RIFF') == 1
+    assert clip[4:8] == b'\xff\xff\xff\xff'
+    assert clip[data_start - 8:data_start] == b'data\xff\xff\xff\xff'
+    assert clip[8:data_start - 4] == header[8:data_start - 4]
+    assert clip[data_start:] == b''.join(segment.text.encode() for segment in pipeline.segments)
+    assert len(pipeline.segments) > 1
+
+
+def test_failed_segment_is_reported():
+    def make_chunks(text):
+        if 'number 0,' in text:
+            raise RuntimeError('provider error')
+        return [b'audio']
+
+    pipeline = speak_text(FakeSynthesizer(make_chunks), voice('mp3_44100_128'), long_text())
+    chunks = [chunk for _, chunk in pipeline.audio() if chunk is not None]
+    assert pipeline.failed == [0]
+    assert len(chunks) == len(pipeline.segments) - 1
+    assert pipeline.clip is None
+
+
+@pytest.mark.parametrize('audio_format', ['mp3_44100_128', 'opus_48000_32'])
+def test_replays_are_chunked_in_every_format(audio_format):
+    synthesizer = FakeSynthesizer(lambda text: [text.encode()])
+    text = long_text()
+    pipeline = speak_text(synthesizer, voice(audio_format), text)
+    clip = b''.join(pipeline.clip_audio())
+    assert len(synthesizer.streams) == len(pipeline.segments) > 1
+    assert clip == b''.join(segment.text.encode() for segment in pipeline.segments)
@@ -0,0 +1,52 @@
+# The TTS clip cache (tts_cache.py): clips stored replies refer to outlive the age and size limits.
+# Run with: python -m pytest tests
+
+import os
+import time
+
+from tts_cache import KEPT_DIRECTORY, TTSCache
+
+
+def make_cache(tmp_path, **limits):
+    return TTSCache(str(tmp_path / 'tts_cache'), sweep_interval=0, **limits)
+
+
+def age(cache, clip, seconds):
+    path = os.path.join(cache.directory, clip)
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_kept_clip_survives_expiry_and_is_exported(tmp_path):
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    clip = cache.put('a' * 64, b'reply audio', 'mp3_44100_128', study='kind agent')
+    kept = cache.keep(clip)
+    assert kept == os.path.join(KEPT_DIRECTORY, clip)
+    age(cache, clip, 120)
+    cache.sweep()
+    assert not os.path.exists(os.path.join(cache.directory, clip))
+    with open(os.path.join(cache.directory, kept), 'rb') as f:
+        assert f.read() == b'reply audio'
+    assert cache.study_clips('kind agent') == [kept]
+    assert cache.study_clips() == [kept]
+    # Kept clips don't count against the cache
+    assert cache.stats()['bytes'] == 0
+
+
+def test_kept_clips_are_not_evicted_for_space(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=100, study_max_bytes=60)
+    kept = [cache.keep(cache.put(f'{number:064x}', b'x' * 40, 'mp3', study='study')) for number in range(5)]
+    assert cache.stats()['bytes'] <= 60
+    for clip in kept:
+        assert os.path.getsize(os.path.join(cache.directory, clip)) == 40
+    assert sorted(kept) == cache.study_clips('study')[:5]
+    # The same audio kept again for a later reply
+    assert cache.keep(kept[0][len(KEPT_DIRECTORY) + 1:]) == kept[0]
+
+
+def test_keeping_an_evicted_clip(tmp_path):
+    cache = make_cache(tmp_path)
+    clip = cache.put('b' * 64, b'audio', 'mp3', study='study')
+    cache.clear()
+    assert cache.keep(clip) is None
+    assert cache.keep(None) is None
@@ -0,0 +1,62 @@
+# The ElevenLabs metadata cache (tts_metadata.py) and warming voice details into it (API_AUDIO.py).
+# Run with: python -m pytest tests
+
+import asyncio
+
+from API_AUDIO import AsyncSpeechSynthesizer
+from tts_metadata import MetadataCache
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+
+def counting_saves(cache):
+    saves = []
+    original = cache._save
+
+    def save():
+        saves.append(len(cache._entries))
+        original()
+
+    cache._save = save
+    return saves
+
+
+def test_put_many_saves_once_and_other_workers_read_it(tmp_path):
+    path = str(tmp_path / 'metadata.json')
+    cache = MetadataCache(path)
+    saves = counting_saves(cache)
+    cache.put_many({f'voice:{number}': {'name': str(number)} for number in range(20)})
+    cache.put_many({})
+    assert saves == [20]
+    other = MetadataCache(path)
+    assert other.get('voice:7', lambda: None) == {'name': '7'}
+    assert other.fetches == 0
+
+
+def test_warm_voice_details_saves_the_file_once(tmp_path):
+    cache = MetadataCache(str(tmp_path / 'metadata.json'))
+    synthesizer = AsyncSpeechSynthesizer(api_key='test', metadata=cache)
+    cache.put(synthesizer._metadata_key('voice:cached'), {'voice_id': 'cached'})
+    saves = counting_saves(cache)
+
+    async def request_async(method, path, **kwargs):
+        voice_id = path.rsplit('/', 1)[1]
+        if voice_id == 'gone':
+            return FakeResponse(404, {'detail': 'voice not found'})
+        return FakeResponse(200, {'voice_id': voice_id})
+
+    synthesizer._request_async = request_async
+    voice_ids = ['cached', 'gone'] + [f'v{number}' for number in range(10)]
+    assert asyncio.run(synthesizer.warm_voice_details(voice_ids)) == 10
+    assert saves == [11]
+    assert cache.fresh(synthesizer._metadata_key('voice:v3'))
+    assert not cache.fresh(synthesizer._metadata_key('voice:gone'))
@@ -0,0 +1,77 @@
+# Which opening lines and formats tts_warmup.py synthesizes ahead of time.
+# Run with: python -m pytest tests
+
+import sqlite3
+
+import pytest
+
+import tts_warmup
+from API_AUDIO import AudioFormat
+from tts_warmup import active_agents, opening_lines, warm_formats
+
+
+class FakeSynthesizer:
+    def __init__(self, formats=None):
+        self.formats = formats
+
+    def supports_format(self, audio_format):
+        return self.formats is None or audio_format in self.formats
+
+
+def voice(audio_format):
+    return {'voice_id': 'v', 'audio_format': audio_format}
+
+
+@pytest.mark.parametrize('preprompt, lines', [
+    ('Always begin the conversation with "Hello, I am here to listen."', ['Hello, I am here to listen.']),
+    ('You are a counsellor. Your first message should be: "How are you feeling today?"', ['How are you feeling today?']),
+    ('Greet the user by saying “Welcome back.” Then wait.', ['Welcome back.']),
+    ('Never say "I am an AI".', []),
+    ('Do not start with "As a language model".', []),
+    ("Don't open with \"Hi\". Start by saying \"Good morning, thanks for coming.\"", ['Good morning, thanks for coming.']),
+    ('Reply with "Okay" when the participant agrees.', []),
+])
+def test_preprompt_openings(preprompt, lines):
+    assert opening_lines({'PrePrompt': preprompt}) == lines
+
+
+def test_phrases_come_first_without_repeats():
+    config = {'audio': {'phrases': ['Hello there.', '  ', 'Hello there.', 3]},
+              'PrePrompt': 'Start with "Hello there." and then "Nice to meet you."'}
+    assert opening_lines(config) == ['Hello there.']
+    config['PrePrompt'] = 'Open with "Nice to meet you."'
+    assert opening_lines(config) == ['Hello there.', 'Nice to meet you.']
+
+
+def test_warm_formats_are_the_ones_negotiation_picks(monkeypatch):
+    monkeypatch.setattr(tts_warmup, 'TTS_WARMUP_COMPACT', True)
+    assert warm_formats(voice(AudioFormat.MP3_PROFESSIONAL_128), FakeSynthesizer()) == [
+        AudioFormat.MP3_PROFESSIONAL_128, AudioFormat.OPUS_COMPACT_32, AudioFormat.MP3_COMPACT_32]
+    # Browsers that can't play the agent's Opus get MP3
+    assert warm_formats(voice(AudioFormat.OPUS_COMPACT_32), FakeSynthesizer()) == [
+        AudioFormat.OPUS_COMPACT_32, AudioFormat.MP3_PROFESSIONAL_128, AudioFormat.MP3_COMPACT_32]
+    # Nothing the synthesizer can't produce
+    local = FakeSynthesizer({AudioFormat.WAV_22050, AudioFormat.MP3_PROFESSIONAL_128})
+    assert warm_formats(voice(AudioFormat.WAV_22050), local) == [AudioFormat.WAV_22050]
+
+
+def test_warm_formats_without_compact(monkeypatch):
+    monkeypatch.setattr(tts_warmup, 'TTS_WARMUP_COMPACT', False)
+    assert warm_formats(voice(AudioFormat.MP3_PROFESSIONAL_128), FakeSynthesizer()) == [
+        AudioFormat.MP3_PROFESSIONAL_128]
+
+
+def test_active_agents_reads_active_passwords(tmp_path, monkeypatch):
+    agents_folder = tmp_path / 'agents'
+    agents_folder.mkdir()
+    (agents_folder / 'kind.json').write_text('{"PrePrompt": "Start with \\"Hi there.\\""}')
+    monkeypatch.setattr(tts_warmup, 'AGENTS_FOLDER', str(agents_folder))
+    db_path = tmp_path / 'users.db'
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE passwords (password TEXT PRIMARY KEY, agent TEXT, is_active INTEGER DEFAULT 1)')
+    conn.executemany('INSERT INTO passwords VALUES (?, ?, ?)',
+                     [('a', 'kind', 1), ('b', 'kind', 1), ('c', 'retired', 0), ('d', 'missing', 1)])
+    conn.commit()
+    conn.close()
+    assert active_agents(str(db_path)) == [('kind', {'PrePrompt': 'Start with "Hi there."'})]
+    assert active_agents(str(tmp_path / 'none.db')) == []
@@ -0,0 +1,537 @@
+# Content-addressed storage for synthesized speech (see API_AUDIO.py).
+#
+# Audio is stored under a hash of everything that changes what the provider returns: the text,
+# voice, model, voice settings, output format, seed and the other synthesis options. Agents repeat
+# themselves a lot (greetings, scripted first lines), so the same audio is only paid for once.
+#
+# Clips are kept per study, one file each, sharded by the first two characters of their hash so no
+# directory grows huge:
+#   TTS_CACHE_DIR/<study>/<ab>/<abcdef...>.mp3
+# The study is the agent whose reply the clip is. Clips that don't belong to a reply, such as
+# ElevenLabs calls made outside a chat, are kept under _shared.
+#
+# A reply that is saved refers to its clip in interactions.json, and researchers export the clips
+# with /download-audio-clips. keep() puts a hard link to such a clip under _kept/, which the limits
+# below never touch, so evicting the cached copy doesn't lose the study's audio:
+#   TTS_CACHE_DIR/_kept/<study>/<ab>/<abcdef...>.mp3
+#
+# Each worker keeps an in-memory index of the clips (size, when written, when last used) so
+# lookups don't touch the directory. The file's mtime is when it was written and its atime when it
+# was last played, so the index can be rebuilt from disk after a restart and workers see each
+# other's clips. Limits:
+#   - clips older than TTS_CACHE_TTL_SECONDS are removed
+#   - a study using more than TTS_STUDY_MAX_MB loses its least recently used clips
+#   - past TTS_CACHE_MAX_MB in total, the least recently used _shared clips go first, then the
+#     least recently used study clips
+# Adding a clip enforces the size limits from the in-memory index, so it stays quick when the cache
+# sits at its limit. A background sweep in every worker re-reads the directory (outside the lock, to
+# pick up the other workers' clips) and also removes expired clips.
+#
+# Streamed audio is written as it passes through (CacheWriter), so a clip is stored the first time
+# it is played without being held in memory.
+#
+# Settings (.env):
+#   TTS_CACHE_ENABLED=true
+#   TTS_CACHE_DIR=data/tts_cache
+#   TTS_CACHE_MAX_MB=500           disk space all clips together may use
+#   TTS_STUDY_MAX_MB=0             disk space one study's clips may use (0 = only the total limit)
+#   TTS_CACHE_TTL_SECONDS=2592000  how long a clip is kept (30 days); 0 keeps clips until evicted
+#   TTS_SWEEP_INTERVAL_SECONDS=600 how often each worker checks the limits in the background
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TTS_CACHE_ENABLED = os.environ.get('TTS_CACHE_ENABLED', 'true').lower() == 'true'
+TTS_CACHE_DIR = os.path.join(APP_DIR, os.environ.get('TTS_CACHE_DIR', os.path.join('data', 'tts_cache')))
+TTS_CACHE_MAX_MB = float(os.environ.get('TTS_CACHE_MAX_MB', 500))
+TTS_STUDY_MAX_MB = float(os.environ.get('TTS_STUDY_MAX_MB', 0))
+TTS_CACHE_TTL_SECONDS = float(os.environ.get('TTS_CACHE_TTL_SECONDS', 30 * 24 * 3600))
+TTS_SWEEP_INTERVAL_SECONDS = float(os.environ.get('TTS_SWEEP_INTERVAL_SECONDS', 600))
+
+SHARED_STUDY = '_shared'
+# Clips stored replies refer to, outside the cache's limits (see keep)
+KEPT_DIRECTORY = '_kept'
+
+# File extension per output format family, so cached clips can be opened and served as they are
+FORMAT_EXTENSIONS = {'mp3': '.mp3', 'pcm': '.pcm', 'ulaw': '.ulaw', 'opus': '.opus', 'wav': '.wav'}
+
+# Temporary files of clips that were never finished (a worker was killed mid-stream)
+STALE_TEMP_SECONDS = 3600
+
+_STUDY_UNSAFE = re.compile(r'[^A-Za-z0-9_-]')
+
+
+def audio_cache_key(**request):
+    """Hash of the synthesis request. Anything that changes the audio must be passed in."""
+    encoded = json.dumps(request, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def study_directory(study):
+    """Directory name of a study's clips"""
+    return _STUDY_UNSAFE.sub('_', study) if study else SHARED_STUDY
+
+
+class _Entry:
+    __slots__ = ('size', 'created', 'used', 'study')
+
+    def __init__(self, size, created, used, study):
+        self.size = size
+        self.created = created
+        self.used = used
+        self.study = study
+
+
+class TTSCache:
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=int(TTS_CACHE_MAX_MB * 1024 * 1024),
+                 ttl_seconds=TTS_CACHE_TTL_SECONDS, study_max_bytes=int(TTS_STUDY_MAX_MB * 1024 * 1024),
+                 sweep_interval=TTS_SWEEP_INTERVAL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.study_max_bytes = study_max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self._index = OrderedDict()  # clip path (relative to directory) -> _Entry, least recently used first
+        self._names = {}  # clip filename -> clip path
+        self._bytes = 0
+        self._study_bytes = {}  # study -> bytes of its clips
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    def clip_path(self, key, audio_format='mp3', study=None):
+        """Where a clip is stored, relative to the cache directory"""
+        filename = self._filename(key, audio_format)
+        return os.path.join(study_directory(study), filename[:2], filename)
+
+    def lookup(self, key, audio_format='mp3'):
+        """Path of the cached clip for key (from any study), or None. Counts as a use of the clip."""
+        self._ensure_sweeper()
+        filename = self._filename(key, audio_format)
+        with self._lock:
+            self._load()
+            clip = self._names.get(filename)
+            entry = self._index.get(clip) if clip else None
+        if entry is None:
+            # Another worker may have synthesized it since we read the directory
+            clip, entry = self._find(filename)
+        if entry is None or self._expired(entry):
+            if clip:
+                self._forget(clip, remove=entry is not None)
+            self.misses += 1
+            return None
+
+        path = os.path.join(self.directory, clip)
+        now = time.time()
+        try:
+            # atime records the last use for the other workers and the next restart
+            os.utime(path, (now, entry.created))
+        except FileNotFoundError:
+            # Evicted by another worker
+            self._forget(clip)
+            self.misses += 1
+            return None
+        except OSError:
+            pass
+        with self._lock:
+            entry.used = now
+            self._track(clip, entry)
+            self._index.move_to_end(clip)
+            self.hits += 1
+            self.bytes_served += entry.size
+        return path
+
+    def get(self, key, audio_format='mp3'):
+        """Cached audio for key, or None"""
+        path = self.lookup(key, audio_format)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as audio_file:
+                return audio_file.read()
+        except FileNotFoundError:
+            self._forget(os.path.relpath(path, self.directory))
+            return None
+
+    def writer(self, audio_format='mp3', key=None, study=None):
+        """A CacheWriter for a clip that arrives in chunks"""
+        return CacheWriter(self, audio_format, key, study)
+
+    def put(self, key, audio_data, audio_format='mp3', study=None):
+        """Store audio for key, then evict clips until the cache is within its size limits"""
+        writer = self.writer(audio_format, key, study)
+        writer.write(audio_data)
+        return writer.commit()
+
+    def _add(self, temp_path, key, audio_format, size, study=None):
+        """Move a finished clip into the cache (called by CacheWriter.commit). Returns its clip path."""
+        self._ensure_sweeper()
+        clip = self.clip_path(key, audio_format, study)
+        try:
+            os.makedirs(os.path.dirname(os.path.join(self.directory, clip)), exist_ok=True)
+            os.replace(temp_path, os.path.join(self.directory, clip))
+        except OSError as e:
+            print(f"TTS cache: could not store {clip}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+
+        now = time.time()
+        with self._lock:
+            self._load()
+            self._track(clip, _Entry(size, now, now, study_directory(study)))
+            over_limit = self._bytes > self.max_bytes or self._over_study_limit(study_directory(study))
+        if over_limit:
+            # From the index only, the sweeper catches up with the other workers' clips
+            self._evict(rescan=False)
+        return clip
+
+    def keep(self, clip):
+        """Keep a clip a stored reply refers to for good, out of reach of the age and size limits.
+
+        Returns the kept clip's path relative to the cache directory, or None if the clip is gone.
+        """
+        if not clip:
+            return None
+        kept = os.path.join(KEPT_DIRECTORY, clip)
+        source = os.path.join(self.directory, clip)
+        target = os.path.join(self.directory, kept)
+        if os.path.exists(target):
+            # The same audio was kept for an earlier reply
+            return kept
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.link(source, target)
+        except FileExistsError:
+            # ... by another worker just now
+            pass
+        except FileNotFoundError:
+            print(f"TTS cache: {clip} was evicted before it could be kept")
+            return None
+        except OSError:
+            # No hard links on this filesystem, keep a copy
+            temp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+            try:
+                shutil.copyfile(source, temp_path)
+                os.replace(temp_path, target)
+            except OSError as e:
+                print(f"TTS cache: could not keep {clip}: {e}")
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                return None
+        return kept
+
+    def clear(self):
+        """Remove every cached clip (kept clips stay)"""
+        with self._lock:
+            self._load()
+            clips = list(self._index)
+        for clip in clips:
+            self._forget(clip, remove=True)
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            studies = {}
+            for entry in self._index.values():
+                study = studies.setdefault(entry.study, {'clips': 0, 'bytes': 0})
+                study['clips'] += 1
+                study['bytes'] += entry.size
+            return {'enabled': TTS_CACHE_ENABLED, 'clips': len(self._index), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'study_max_bytes': self.study_max_bytes, 'studies': studies,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'bytes_served': self.bytes_served}
+
+    def study_clips(self, study=None):
+        """Paths of the clips of one study (all studies if None), relative to the cache directory:
+        the kept ones, then the ones still in the cache"""
+        self._rescan()
+        with self._lock:
+            cached = [clip for clip, entry in self._index.items()
+                      if entry.study != SHARED_STUDY and (study is None or entry.study == study_directory(study))]
+        kept_directory = os.path.join(self.directory, KEPT_DIRECTORY)
+        if study is not None:
+            kept_directory = os.path.join(kept_directory, study_directory(study))
+        kept = []
+        for root, directories, filenames in os.walk(kept_directory):
+            kept += [os.path.relpath(os.path.join(root, filename), self.directory)
+                     for filename in filenames if not filename.endswith('.tmp')]
+        return sorted(kept) + cached
+
+    def sweep(self):
+        """Enforce the age and size limits now (the background sweeper calls this)"""
+        self._evict(rescan=True)
+        self._remove_stale_temp_files()
+
+    @staticmethod
+    def _filename(key, audio_format):
+        family = str(audio_format).split('_')[0]
+        return key + FORMAT_EXTENSIONS.get(family, '.audio')
+
+    def _expired(self, entry):
+        return self.ttl_seconds > 0 and time.time() - entry.created > self.ttl_seconds
+
+    def _over_study_limit(self, study):
+        """True if a study uses more than study_max_bytes (call with the lock held)"""
+        if study == SHARED_STUDY or not self.study_max_bytes:
+            return False
+        return self._study_bytes.get(study, 0) > self.study_max_bytes
+
+    def _stat(self, clip):
+        try:
+            stat = os.stat(os.path.join(self.directory, clip))
+        except OSError:
+            return None
+        return _Entry(stat.st_size, stat.st_mtime, stat.st_atime, clip.split(os.sep, 1)[0])
+
+    def _find(self, filename):
+        """Look for a clip on disk in every study"""
+        try:
+            studies = os.listdir(self.directory)
+        except OSError:
+            return None, None
+        for study in studies:
+            clip = os.path.join(study, filename[:2], filename)
+            entry = self._stat(clip)
+            if entry:
+                return clip, entry
+        return None, None
+
+    def _track(self, clip, entry):
+        """Add a clip to the index (call with the lock held)"""
+        self._untrack(self._index.pop(clip, None))
+        self._index[clip] = entry
+        self._names[os.path.basename(clip)] = clip
+        self._bytes += entry.size
+        self._study_bytes[entry.study] = self._study_bytes.get(entry.study, 0) + entry.size
+
+    def _untrack(self, entry):
+        """Take a clip removed from the index off the totals (call with the lock held)"""
+        if entry:
+            self._bytes -= entry.size
+            self._study_bytes[entry.study] -= entry.size
+
+    def _scan(self):
+        """(clip, entry) for every clip on disk, least recently used first. Doesn't need the lock."""
+        self._move_flat_clips()
+        entries = []
+        for root, directories, filenames in os.walk(self.directory):
+            if root == self.directory and KEPT_DIRECTORY in directories:
+                # Kept clips aren't part of the cache
+                directories.remove(KEPT_DIRECTORY)
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                clip = os.path.relpath(os.path.join(root, filename), self.directory)
+                entry = self._stat(clip)
+                if entry:
+                    entries.append((clip, entry))
+        return sorted(entries, key=lambda item: item[1].used)
+
+    def _replace_index(self, entries):
+        """Make the index hold exactly these clips (call with the lock held)"""
+        self._index.clear()
+        self._names.clear()
+        self._bytes = 0
+        self._study_bytes = {}
+        for clip, entry in entries:
+            self._track(clip, entry)
+        self._loaded = True
+
+    def _load(self):
+        """Build the index from the files on disk the first time it is needed (call with the lock held)"""
+        if not self._loaded:
+            self._replace_index(self._scan())
+
+    def _rescan(self):
+        """Read the index from disk again, for the other workers' clips. Lookups go on meanwhile."""
+        entries = self._scan()
+        with self._lock:
+            self._replace_index(entries)
+
+    def _move_flat_clips(self):
+        """Clips from before the study/shard layout sat directly in the cache directory"""
+        try:
+            filenames = [entry.name for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError:
+            return
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                continue
+            target = os.path.join(self.directory, SHARED_STUDY, filename[:2], filename)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(os.path.join(self.directory, filename), target)
+            except OSError:
+                pass
+
+    def _forget(self, clip, remove=False):
+        with self._lock:
+            self._untrack(self._index.pop(clip, None))
+            if self._names.get(os.path.basename(clip)) == clip:
+                del self._names[os.path.basename(clip)]
+        if remove:
+            try:
+                os.remove(os.path.join(self.directory, clip))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, rescan=True):
+        """Remove least recently used clips until every size limit is met.
+
+        With rescan, the index is first read from disk again (other workers add and evict clips
+        too) and expired clips are removed as well. Both go through every clip, so only the
+        sweeper does that.
+        """
+        if rescan:
+            self._rescan()
+        with self._lock:
+            self._load()
+            victims = [clip for clip, entry in self._index.items() if self._expired(entry)] if rescan else []
+            chosen = set(victims)
+
+            study_bytes = dict(self._study_bytes)
+            for clip in victims:
+                study_bytes[self._index[clip].study] -= self._index[clip].size
+            over_quota = {study for study, size in study_bytes.items()
+                          if study != SHARED_STUDY and self.study_max_bytes and size > self.study_max_bytes}
+            for clip, entry in self._index.items():
+                if not over_quota:
+                    break
+                if clip not in chosen and entry.study in over_quota:
+                    victims.append(clip)
+                    chosen.add(clip)
+                    study_bytes[entry.study] -= entry.size
+                    if study_bytes[entry.study] <= self.study_max_bytes:
+                        over_quota.discard(entry.study)
+
+            # Shared clips can always be synthesized again, clips of replies only if they are evicted
+            remaining = sum(study_bytes.values())
+            for shared_first in (True, False):
+                for clip, entry in self._index.items():
+                    if remaining <= self.max_bytes:
+                        break
+                    if clip in chosen or (entry.study == SHARED_STUDY) != shared_first:
+                        continue
+                    victims.append(clip)
+                    chosen.add(clip)
+                    remaining -= entry.size
+        for clip in victims:
+            self._forget(clip, remove=True)
+        self.evictions += len(victims)
+
+    def _remove_stale_temp_files(self):
+        cutoff = time.time() - STALE_TEMP_SECONDS
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name.endswith('.tmp') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _ensure_sweeper(self):
+        # Threads don't survive a fork, so each gunicorn worker starts its own sweeper
+        if self._sweeper_pid == os.getpid() or not self.sweep_interval:
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='tts-cache-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"TTS cache: sweep failed: {e}")
+
+
+class CacheWriter:
+    """Writes a clip to a temporary file as its chunks pass through, so streamed audio can be cached
+    without holding it in memory. The clip only appears in the cache on commit(); a stream that
+    breaks off is discarded. The key can be given at commit time if it isn't known up front.
+    """
+
+    def __init__(self, cache, audio_format='mp3', key=None, study=None):
+        self.cache = cache
+        self.audio_format = audio_format
+        self.key = key
+        self.study = study
+        self.size = 0
+        self._temp_path = None
+        self._file = None
+        # A clip bigger than its study may hold isn't worth keeping either
+        self._max_bytes = cache.max_bytes
+        if study and cache.study_max_bytes:
+            self._max_bytes = min(self._max_bytes, cache.study_max_bytes)
+        try:
+            os.makedirs(cache.directory, exist_ok=True)
+            self._temp_path = os.path.join(cache.directory, f"{uuid.uuid4().hex}.tmp")
+            self._file = open(self._temp_path, 'wb')
+        except OSError as e:
+            print(f"TTS cache: could not start a clip: {e}")
+
+    def write(self, chunk):
+        if self._file is None:
+            return
+        self.size += len(chunk)
+        if self.size > self._max_bytes:
+            # Bigger than the whole cache, no point keeping it
+            self.abort()
+            return
+        try:
+            self._file.write(chunk)
+        except OSError as e:
+            print(f"TTS cache: could not write a clip: {e}")
+            self.abort()
+
+    def commit(self, key=None):
+        """Store the clip, returns its path relative to the cache directory (None if it wasn't stored)"""
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        if self.size:
+            return self.cache._add(self._temp_path, key or self.key, self.audio_format, self.size, self.study)
+        self._remove_temp()
+        return None
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._remove_temp()
+
+    def _remove_temp(self):
+        try:
+            os.remove(self._temp_path)
+        except OSError:
+            pass
+
+
+# Shared by every synthesizer in this worker
+tts_cache = TTSCache()
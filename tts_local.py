@@ -0,0 +1,346 @@
+# Local text-to-speech on the server's CPU, for offline studies and for agents that don't need
+# ElevenLabs' voices (see API_AUDIO.py for the ElevenLabs backend).
+#
+# Two engines are supported, picked with "model_id" in the agent's "audio" block:
+#   espeak-ng  robotic but tiny and instant. voice_id is an espeak voice ("en-us", "de", "en-gb+f3").
+#              Each clip is one espeak-ng process reading the text on stdin and writing WAV to
+#              stdout, so the audio streams out as it is produced.
+#   piper      natural neural voices that still run faster than real time on a CPU. voice_id is the
+#              path to a .onnx voice model (relative paths are looked up in PIPER_VOICES_DIR).
+#              Loading a voice takes a moment, so piper processes are kept running in a pool per
+#              voice and handed one clip at a time (--json-input).
+#
+# Agents use it with:
+#   "audio": {"enabled": true, "backend": "local", "model_id": "piper",
+#             "voice_id": "en_US-lessac-medium.onnx", "speed": 1.0, "format": "wav_22050"}
+#
+# Both engines produce WAV. Other formats (mp3, pcm, ulaw) are converted with ffmpeg, which must be
+# installed for them. Clips go through the same TTS cache as ElevenLabs' audio.
+#
+# Settings (.env):
+#   TTS_LOCAL_WORKERS=2            clips synthesized at once per worker (about one per CPU core)
+#   ESPEAK_NG_PATH=espeak-ng       engine binaries, if they aren't on the PATH
+#   PIPER_PATH=piper
+#   PIPER_VOICES_DIR=voices        where piper voice models are kept (relative to the app directory)
+#   FFMPEG_PATH=ffmpeg
+
+import json
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+
+from API_AUDIO import (TTS_STREAM_CHUNK_BYTES, AudioFormat, AudioStream, CachedAudioStream, SpeechBackend)
+from tts_cache import TTS_CACHE_ENABLED, audio_cache_key, tts_cache
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TTS_LOCAL_WORKERS = int(os.environ.get('TTS_LOCAL_WORKERS', 2))
+ESPEAK_NG_PATH = os.environ.get('ESPEAK_NG_PATH', 'espeak-ng')
+PIPER_PATH = os.environ.get('PIPER_PATH', 'piper')
+PIPER_VOICES_DIR = os.path.join(APP_DIR, os.environ.get('PIPER_VOICES_DIR', 'voices'))
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+
+ENGINES = ('espeak-ng', 'piper')
+
+# espeak-ng's default speaking rate in words per minute, speed 1.0
+ESPEAK_WORDS_PER_MINUTE = 175
+
+# ffmpeg output options per format family
+_FFMPEG_FORMATS = {
+    'mp3': ['-f', 'mp3', '-codec:a', 'libmp3lame'],
+    'pcm': ['-f', 's16le', '-ac', '1'],
+    'ulaw': ['-f', 'mulaw', '-ac', '1'],
+    'opus': ['-f', 'ogg', '-codec:a', 'libopus'],
+    'wav': ['-f', 'wav', '-ac', '1'],
+}
+
+# One slot per clip being synthesized in this worker, both engines together
+local_slots = threading.BoundedSemaphore(TTS_LOCAL_WORKERS)
+
+
+def _ffmpeg_args(audio_format):
+    """ffmpeg arguments to convert WAV on stdin to audio_format on stdout"""
+    family, *details = audio_format.value.split('_')
+    args = [FFMPEG_PATH, '-loglevel', 'error', '-i', 'pipe:0'] + _FFMPEG_FORMATS[family]
+    if details:
+        args += ['-ar', details[0]]
+    if len(details) > 1:
+        args += ['-b:a', f'{details[1]}k']
+    return args + ['pipe:1']
+
+
+class ProcessOutput:
+    """Audio read from a process's stdout (or a file), looking like a streamed HTTP response to
+    AudioStream.
+
+    A process that exits with an error raises once its output is read, so the clip isn't cached.
+    close() stops the processes and gives the synthesis slot back.
+    """
+
+    headers = {}
+
+    def __init__(self, processes, output=None, on_close=None, cleanup=None):
+        self.processes = processes
+        self.output = output or processes[-1].stdout
+        self._on_close = on_close
+        self._cleanup = cleanup
+        self._closed = False
+
+    def iter_content(self, chunk_size=TTS_STREAM_CHUNK_BYTES):
+        while True:
+            # read1 returns what the process has written so far instead of waiting for a full chunk
+            audio_chunk = self.output.read1(chunk_size)
+            if not audio_chunk:
+                break
+            yield audio_chunk
+        for process in self.processes:
+            process.wait()
+            if process.returncode:
+                error = process.stderr.read().decode(errors='replace').strip() if process.stderr else ''
+                raise RuntimeError(f"{os.path.basename(process.args[0])} failed ({process.returncode}): {error}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.output.close()
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                if pipe:
+                    pipe.close()
+        if self._cleanup:
+            self._cleanup()
+        if self._on_close:
+            self._on_close()
+
+
+class _PiperProcess:
+    """A running piper with its voice loaded, synthesizing one clip at a time into a file"""
+
+    def __init__(self, model_path, length_scale):
+        self.process = subprocess.Popen(
+            [PIPER_PATH, '--model', model_path, '--length_scale', str(length_scale), '--json-input'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1
+        )
+
+    def synthesize(self, text_content, output_file):
+        # piper prints the path of each file it has written
+        self.process.stdin.write(json.dumps({'text': text_content, 'output_file': output_file}) + '\n')
+        self.process.stdin.flush()
+        written = self.process.stdout.readline().strip()
+        if not written:
+            raise RuntimeError(f"piper stopped (exit code {self.process.poll()})")
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class LocalSpeechSynthesizer(SpeechBackend):
+    """
+    SpeechBackend running espeak-ng or piper on this machine.
+
+    Takes the same arguments as SpeechSynthesizer where they make sense (text_content, voice_id,
+    model_id, audio_format, chunk_size, use_cache) plus speed (1.0 is the voice's normal pace).
+    ElevenLabs-only options such as voice_settings, previous_text or next_text are accepted and
+    ignored, so callers don't need to care which backend an agent uses.
+    """
+
+    name = "local"
+
+    def __init__(self, cache=None, use_cache=True):
+        self.cache = None
+        if use_cache:
+            self.cache = cache or (tts_cache if TTS_CACHE_ENABLED else None)
+        self._piper_pools = {}  # (model path, length scale) -> idle _PiperProcess queue
+        self._pool_lock = threading.Lock()
+
+    @staticmethod
+    def check_engine(model_id):
+        """Raise ValueError if the engine isn't known or isn't installed"""
+        if model_id not in ENGINES:
+            raise ValueError(f"Unknown local TTS engine {model_id!r}, use one of {', '.join(ENGINES)}")
+        binary = ESPEAK_NG_PATH if model_id == 'espeak-ng' else PIPER_PATH
+        if shutil.which(binary) is None:
+            raise ValueError(f"{model_id} is not installed (looked for {binary!r})")
+
+    def supports_format(self, audio_format):
+        family = audio_format.value.split('_')[0]
+        if family not in _FFMPEG_FORMATS:
+            return False
+        return audio_format == AudioFormat.WAV_22050 or shutil.which(FFMPEG_PATH) is not None
+
+    def _check_request(self, text_content, model_id, audio_format, speed):
+        if not text_content or not text_content.strip():
+            raise ValueError("Text cannot be empty")
+        if not 0.25 <= speed <= 4.0:
+            raise ValueError("Speed must be between 0.25 and 4.0")
+        if not isinstance(audio_format, AudioFormat):
+            audio_format = AudioFormat(audio_format)
+        if audio_format.value.split('_')[0] not in _FFMPEG_FORMATS:
+            raise ValueError(f"Local TTS can't produce {audio_format.value}")
+        self.check_engine(model_id)
+        if audio_format != AudioFormat.WAV_22050 and shutil.which(FFMPEG_PATH) is None:
+            raise ValueError(f"ffmpeg is needed for {audio_format.value} audio from local TTS (looked for {FFMPEG_PATH!r})")
+        return audio_format
+
+    def cache_key(self, text_content, voice_id, model_id='espeak-ng', speed=1.0,
+                  audio_format=AudioFormat.WAV_22050, **ignored_options):
+        """TTS cache key of the audio synthesize_speech would return for these arguments"""
+        return audio_cache_key(backend=self.name, engine=model_id, voice_id=voice_id, text=text_content,
+                               speed=speed, output_format=AudioFormat(audio_format).value)
+
+    def synthesize_speech(self, text_content, voice_id, model_id='espeak-ng', speed=1.0,
+                          audio_format=AudioFormat.WAV_22050, use_cache=True, **ignored_options):
+        """
+        Synthesize a whole clip
+
+        Returns:
+            bytes: Audio in audio_format
+        """
+        stream = self.synthesize_speech_streaming(text_content, voice_id, model_id=model_id, speed=speed,
+                                                  audio_format=audio_format, use_cache=use_cache)
+        return b''.join(stream)
+
+    def synthesize_speech_streaming(self, text_content, voice_id, model_id='espeak-ng', speed=1.0,
+                                    audio_format=AudioFormat.WAV_22050, chunk_size=TTS_STREAM_CHUNK_BYTES,
+                                    use_cache=True, **ignored_options):
+        """
+        Synthesize a clip and read it in chunks as the engine produces it
+
+        Returns:
+            AudioStream (or CachedAudioStream) yielding audio chunks
+        """
+        audio_format = self._check_request(text_content, model_id, audio_format, speed)
+
+        cache_writer = None
+        if self.cache and use_cache:
+            cache_key = self.cache_key(text_content, voice_id, model_id, speed, audio_format)
+            cached_path = self.cache.lookup(cache_key, audio_format.value)
+            if cached_path:
+                return CachedAudioStream(cached_path, chunk_size)
+            cache_writer = self.cache.writer(audio_format.value, cache_key)
+
+        local_slots.acquire()
+        try:
+            if model_id == 'piper':
+                output = self._run_piper(text_content, voice_id, speed, audio_format)
+            else:
+                output = self._run_espeak(text_content, voice_id, speed, audio_format)
+        except Exception:
+            local_slots.release()
+            if cache_writer:
+                cache_writer.abort()
+            raise
+        return AudioStream(output, chunk_size, cache_writer)
+
+    def _run_espeak(self, text_content, voice_id, speed, audio_format):
+        words_per_minute = str(round(ESPEAK_WORDS_PER_MINUTE * speed))
+        espeak = subprocess.Popen(
+            [ESPEAK_NG_PATH, '-v', voice_id, '-s', words_per_minute, '--stdin', '--stdout'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        # Written from a thread, espeak-ng starts speaking (and filling stdout) before it has read everything
+        threading.Thread(target=self._write_text, args=(espeak.stdin, text_content), daemon=True).start()
+        processes = [espeak]
+        if audio_format != AudioFormat.WAV_22050:
+            processes.append(subprocess.Popen(_ffmpeg_args(audio_format), stdin=espeak.stdout,
+                                              stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+            # ffmpeg owns the pipe now
+            espeak.stdout.close()
+            espeak.stdout = None
+        return ProcessOutput(processes, on_close=local_slots.release)
+
+    def _run_piper(self, text_content, voice_id, speed, audio_format):
+        model_path = voice_id if os.path.isabs(voice_id) else os.path.join(PIPER_VOICES_DIR, voice_id)
+        if not os.path.exists(model_path):
+            raise ValueError(f"Piper voice model not found: {model_path}")
+        # piper's length_scale is the time per phoneme, so it is the inverse of the speed
+        pool_key = (model_path, round(1 / speed, 3))
+        piper = self._take_piper(pool_key)
+        output_file = os.path.join(tempfile.gettempdir(), f"piper-{uuid.uuid4().hex}.wav")
+        try:
+            piper.synthesize(text_content, output_file)
+        except Exception:
+            piper.stop()
+            self._remove(output_file)
+            raise
+        self._return_piper(pool_key, piper)
+
+        # piper writes the whole clip before it reports back, so it is read from the file from here
+        cleanup = lambda: self._remove(output_file)
+        wav_file = open(output_file, 'rb')
+        if audio_format == AudioFormat.WAV_22050:
+            return ProcessOutput([], output=wav_file, on_close=local_slots.release, cleanup=cleanup)
+        ffmpeg = subprocess.Popen(_ffmpeg_args(audio_format), stdin=wav_file,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wav_file.close()
+        return ProcessOutput([ffmpeg], on_close=local_slots.release, cleanup=cleanup)
+
+    def _take_piper(self, pool_key):
+        with self._pool_lock:
+            idle = self._piper_pools.setdefault(pool_key, queue.LifoQueue())
+        while True:
+            try:
+                piper = idle.get_nowait()
+            except queue.Empty:
+                return _PiperProcess(*pool_key)
+            if piper.alive():
+                return piper
+
+    def _return_piper(self, pool_key, piper):
+        idle = self._piper_pools[pool_key]
+        # No more idle processes per voice than clips can run at once
+        if idle.qsize() < TTS_LOCAL_WORKERS:
+            idle.put(piper)
+        else:
+            piper.stop()
+
+    @staticmethod
+    def _write_text(pipe, text_content):
+        try:
+            pipe.write(text_content.encode())
+            pipe.close()
+        except (OSError, ValueError):
+            # The stream was closed before espeak-ng had read the text
+            pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def close(self):
+        """Stop the pooled piper processes"""
+        with self._pool_lock:
+            pools, self._piper_pools = self._piper_pools, {}
+        for idle in pools.values():
+            while not idle.empty():
+                idle.get_nowait().stop()
+
+
+_shared_local = {}
+_shared_lock = threading.Lock()
+
+
+def shared_local_synthesizer():
+    """This worker's LocalSpeechSynthesizer, so piper processes are reused between requests"""
+    with _shared_lock:
+        synthesizer = _shared_local.get(os.getpid())
+        if synthesizer is None:
+            synthesizer = LocalSpeechSynthesizer()
+            _shared_local[os.getpid()] = synthesizer
+        return synthesizer
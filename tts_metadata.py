@@ -0,0 +1,162 @@
+# Cache for ElevenLabs voice and model metadata (see API_AUDIO.py).
+#
+# The voice and model lists rarely change, but a voice picker on the dashboard asks for them every
+# time it opens, and every request counts against the ElevenLabs rate limit. Answers are kept for
+# TTS_METADATA_TTL_SECONDS. After that the old answer is still returned straight away while a
+# background thread fetches a fresh one (stale-while-revalidate), so only the very first load ever
+# waits for ElevenLabs. Answers older than TTS_METADATA_MAX_STALE_SECONDS are fetched again before
+# returning, and if ElevenLabs can't be reached the last answer is used whatever its age.
+#
+# The cache is saved to TTS_METADATA_FILE so a restart (or another worker) doesn't fetch it again.
+# The whole file is rewritten on every save, so many answers at once (warming voice details) go in
+# with one put_many.
+#
+# Settings (.env):
+#   TTS_METADATA_TTL_SECONDS=3600            how long metadata counts as fresh
+#   TTS_METADATA_MAX_STALE_SECONDS=604800    how long stale metadata may be served while refreshing (7 days)
+#   TTS_METADATA_FILE=data/tts_metadata.json
+
+import json
+import os
+import threading
+import time
+import uuid
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TTS_METADATA_TTL_SECONDS = float(os.environ.get('TTS_METADATA_TTL_SECONDS', 3600))
+TTS_METADATA_MAX_STALE_SECONDS = float(os.environ.get('TTS_METADATA_MAX_STALE_SECONDS', 7 * 24 * 3600))
+TTS_METADATA_FILE = os.path.join(APP_DIR, os.environ.get('TTS_METADATA_FILE', os.path.join('data', 'tts_metadata.json')))
+
+
+class MetadataCache:
+    def __init__(self, path=TTS_METADATA_FILE, ttl_seconds=TTS_METADATA_TTL_SECONDS,
+                 max_stale_seconds=TTS_METADATA_MAX_STALE_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self._entries = {}  # key -> {'fetched': timestamp, 'value': ...}
+        self._file_mtime = None
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.fetches = 0
+
+    def get(self, key, fetch, refresh=False):
+        """The value for key, calling fetch() to get it when it is missing or too old"""
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(key)
+        age = time.time() - entry['fetched'] if entry else None
+
+        if entry and not refresh and age < self.ttl_seconds:
+            self.hits += 1
+            return entry['value']
+        if entry and not refresh and age < self.ttl_seconds + self.max_stale_seconds:
+            self.stale_hits += 1
+            self._refresh_in_background(key, fetch)
+            return entry['value']
+
+        try:
+            return self._fetch(key, fetch)
+        except Exception as e:
+            if entry is None:
+                raise
+            print(f"TTS metadata: could not refresh {key}, using the copy from {int(age)}s ago: {e}")
+            return entry['value']
+
+    def fresh(self, key):
+        """True if key has a value that doesn't need refreshing yet"""
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(key)
+        return entry is not None and time.time() - entry['fetched'] < self.ttl_seconds
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, values):
+        """Store several keys with a single save"""
+        if not values:
+            return
+        with self._lock:
+            self._reload()
+            fetched = time.time()
+            for key, value in values.items():
+                self._entries[key] = {'fetched': fetched, 'value': value}
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+    def stats(self):
+        with self._lock:
+            self._reload()
+            return {'entries': len(self._entries), 'hits': self.hits, 'stale_hits': self.stale_hits,
+                    'fetches': self.fetches}
+
+    def _fetch(self, key, fetch):
+        self.fetches += 1
+        value = fetch()
+        self.put(key, value)
+        return value
+
+    def _refresh_in_background(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key, fetch)
+            except Exception as e:
+                print(f"TTS metadata: background refresh of {key} failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name='tts-metadata', daemon=True).start()
+
+    def _reload(self):
+        """Read the file again if another worker has saved it (call with the lock held)"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._file_mtime:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"TTS metadata: could not read {self.path}: {e}")
+            return
+        # Keep whichever copy of each entry is newer
+        for key, entry in saved.items():
+            if key not in self._entries or entry['fetched'] > self._entries[key]['fetched']:
+                self._entries[key] = entry
+        self._file_mtime = mtime
+
+    def _save(self):
+        """Write the cache to disk (call with the lock held)"""
+        temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+            self._file_mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            print(f"TTS metadata: could not save {self.path}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+# Shared by every synthesizer in this worker
+tts_metadata = MetadataCache()
@@ -0,0 +1,125 @@
+# Text clean-up and chunking before speech synthesis (see speech_pipeline.py).
+#
+# LLM replies are written to be read: markdown emphasis, headings, bullet points, links and code.
+# normalize_text turns them into something a voice can say, following the agent's
+# TextProcessingMode the way ElevenLabs' own normalization does:
+#   off   text is only trimmed and its whitespace collapsed
+#   auto  markdown, links and code formatting are removed as well (the default)
+#   on    common symbols and abbreviations are also written out ("&" -> "and", "e.g." -> "for example")
+#
+# split_text cuts text into chunks of at most max_chars, at sentence ends where possible, then at
+# clause boundaries (, ; : and dashes), then between words. Providers limit how much text one
+# request may have, and shorter chunks start playing sooner.
+#
+# Settings (.env):
+#   TTS_MAX_CHUNK_CHARS=500        longest text sent in one synthesis request
+
+import os
+import re
+
+from API_AUDIO import TextProcessingMode
+
+TTS_MAX_CHUNK_CHARS = int(os.environ.get('TTS_MAX_CHUNK_CHARS', 500))
+
+_CODE_BLOCK = re.compile(r'```.*?(```|$)', re.DOTALL)
+_INLINE_CODE = re.compile(r'`([^`]*)`')
+_IMAGE = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+_LINK = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+_URL = re.compile(r'https?://\S+')
+_HEADING = re.compile(r'^\s{0,3}#{1,6}\s*', re.MULTILINE)
+_BULLET = re.compile(r'^\s*(?:[-*+•]|\d+[.)])\s+', re.MULTILINE)
+_QUOTE = re.compile(r'^\s*>\s?', re.MULTILINE)
+_EMPHASIS = re.compile(r'(?<!\w)(\*\*|__|\*|_|~~)(?=\S)(.+?)(?<=\S)\1(?!\w)')
+_RULE = re.compile(r'^\s*([-*_])(\s*\1){2,}\s*$', re.MULTILINE)
+_TABLE_BAR = re.compile(r'\s*\|\s*')
+_BLANK_LINES = re.compile(r'\n\s*\n+')
+_SPACES = re.compile(r'[ \t\r\f\v]+')
+# A line without its own punctuation (heading, list item) would run into the next one when spoken
+_UNPUNCTUATED_LINE_END = re.compile(r'(?<=[^\s.!?…:;,])[ \t]*\n')
+
+_SYMBOLS = [
+    (re.compile(r'\s*&\s*'), ' and '),
+    (re.compile(r'(?<=\d)\s*%'), ' percent'),
+    (re.compile(r'(?<=\d)\s*°C\b'), ' degrees Celsius'),
+    (re.compile(r'(?<=\d)\s*°F\b'), ' degrees Fahrenheit'),
+    (re.compile(r'\s+\+\s+'), ' plus '),
+    (re.compile(r'\s+=\s+'), ' equals '),
+    (re.compile(r'\s*(?:->|→)\s*'), ' to '),
+    (re.compile(r'(?<=\s)@(?=\w)'), 'at '),
+]
+_ABBREVIATIONS = [
+    (re.compile(r'\be\.g\.', re.IGNORECASE), 'for example'),
+    (re.compile(r'\bi\.e\.', re.IGNORECASE), 'that is'),
+    (re.compile(r'\betc\.', re.IGNORECASE), 'et cetera'),
+    (re.compile(r'\bvs\.?(?=\s)', re.IGNORECASE), 'versus'),
+    (re.compile(r'\bapprox\.', re.IGNORECASE), 'approximately'),
+]
+
+_SENTENCE_BREAK = re.compile(r'[.!?…]+["\')\]]*\s+')
+_CLAUSE_BREAK = re.compile(r'[,;:]\s+|\s+[—–-]\s+')
+_WORD_BREAK = re.compile(r'\s+')
+
+
+def normalize_text(text, mode=TextProcessingMode.AUTO_DETECT):
+    """text as it should be spoken (see the header for what each mode does)"""
+    if mode != TextProcessingMode.RAW_TEXT:
+        text = _CODE_BLOCK.sub(' ', text)
+        text = _INLINE_CODE.sub(r'\1', text)
+        text = _IMAGE.sub(r'\1', text)
+        text = _LINK.sub(r'\1', text)
+        text = _URL.sub('', text)
+        text = _RULE.sub('', text)
+        text = _HEADING.sub('', text)
+        text = _BULLET.sub('', text)
+        text = _QUOTE.sub('', text)
+        text = _EMPHASIS.sub(r'\2', text)
+        text = _TABLE_BAR.sub(', ', text)
+        text = _BLANK_LINES.sub('\n', text)
+        text = _UNPUNCTUATED_LINE_END.sub('. ', text)
+    if mode == TextProcessingMode.NORMALIZE_ALL:
+        for pattern, replacement in _ABBREVIATIONS + _SYMBOLS:
+            text = pattern.sub(replacement, text)
+    return _SPACES.sub(' ', text.replace('\n', ' ')).strip()
+
+
+def _split_at(text, pattern, max_chars):
+    """Cut text after each pattern match and greedily join the pieces into chunks of at most max_chars"""
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        pieces.append(text[start:match.end()].strip())
+        start = match.end()
+    pieces.append(text[start:].strip())
+    chunks = []
+    current = ''
+    for piece in filter(None, pieces):
+        candidate = f'{current} {piece}' if current else piece
+        if len(candidate) <= max_chars:
+            current = candidate
+        else:
+            if current:
+                chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_text(text, max_chars=TTS_MAX_CHUNK_CHARS):
+    """text in chunks of at most max_chars, cut at sentence, then clause, then word boundaries"""
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text] if text else []
+    chunks = []
+    for sentence_chunk in _split_at(text, _SENTENCE_BREAK, max_chars):
+        if len(sentence_chunk) <= max_chars:
+            chunks.append(sentence_chunk)
+            continue
+        for clause_chunk in _split_at(sentence_chunk, _CLAUSE_BREAK, max_chars):
+            if len(clause_chunk) <= max_chars:
+                chunks.append(clause_chunk)
+                continue
+            for word_chunk in _split_at(clause_chunk, _WORD_BREAK, max_chars):
+                # A single "word" longer than the budget (a long URL or number) is cut where it must be
+                chunks.extend(word_chunk[start:start + max_chars] for start in range(0, len(word_chunk), max_chars))
+    return chunks
@@ -0,0 +1,206 @@
+# Audio for agents' opening lines, synthesized before any participant asks for it.
+#
+# Many agents open with the same greeting or scripted first line every time. The first sentence of
+# a reply is on the critical path: nothing plays until it is synthesized. warm_up_agents goes
+# through the active agents (those with an active password) and caches, for every format
+# negotiate_audio_format picks for the browsers chat.js reports (the agent's format, MP3 where that
+# doesn't play, and the compact ones for slow connections):
+#   - the first sentence of each opening line, which SpeechPipeline then plays from the cache
+#   - the whole line, so replaying it (/chat/audio/<message id>) is served from disk too
+# Clips go into the agent's study in the TTS cache (see tts_cache.py), and anything already cached
+# is skipped, so running it again only synthesizes what has changed.
+#
+# Opening lines come from the agent JSON:
+#   "audio": {"enabled": true, ..., "phrases": ["Hi, I'm Sam. What would you like to talk about?"]}
+# and from lines the PrePrompt quotes as the ones to open with, e.g.
+#   Always begin the conversation with "Hello! How are you feeling today?"
+#   Your first message should be: "Hi, I'm Sam."
+# Only instructions to begin/start/open/greet/introduce with a line, or a quoted first message,
+# count. Other quotes ("Never say ...", "Do not start with ...") are not warmed, each line is
+# paid synthesis in every format.
+#
+# Gunicorn runs it once when it starts (on_starting in gunicorn.conf.py runs this file), the
+# development server when it starts, and a worker in a background thread when an agent is saved from
+# the dashboard. Runs take turns through a lock file, so a second one finds everything cached.
+# To run it yourself:
+#   python tts_warmup.py
+#
+# Settings (.env):
+#   TTS_WARMUP=true                synthesize opening lines ahead of time
+#   TTS_WARMUP_COMPACT=true        also warm the compact formats for slow connections
+
+import argparse
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from speech_pipeline import SentenceSegmenter, agent_synthesizer, agent_voice, negotiate_audio_format, speak_text
+from tts_text import normalize_text
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TTS_WARMUP = os.environ.get('TTS_WARMUP', 'true').lower() == 'true'
+TTS_WARMUP_COMPACT = os.environ.get('TTS_WARMUP_COMPACT', 'true').lower() == 'true'
+WARMUP_LOCK_FILE = os.path.join(APP_DIR, 'data', 'tts_warmup.lock')
+AGENTS_FOLDER = os.path.join(APP_DIR, 'agents')
+
+# What chat.js reports for the browsers negotiate_audio_format tells apart: (audio_accept, kbps).
+# One that plays Ogg Opus and one that doesn't, each on a fast and on a slow connection.
+_BROWSER_ACCEPT = ('audio/ogg, audio/mpeg, audio/wav', 'audio/mpeg, audio/wav')
+_CLIENTS = [(accept, kbps) for kbps in (None, 0) for accept in _BROWSER_ACCEPT]
+
+# A quoted line after an instruction to open with it ("start by saying", "greet the user with",
+# "your first message is" ...)
+_PREPROMPT_OPENING = re.compile(
+    r'(?:\b(?:begin|start|open|greet|introduce)\w*\b[^"“\n.!?;]{0,60}?\b(?:with|saying)'
+    r'|\bfirst (?:message|line|sentence|reply|response)\b[^"“\n.!?;]{0,40}?)'
+    r'\s*:?\s*["“]([^"”\n]{2,300})["”]',
+    re.IGNORECASE)
+# ... unless the sentence says not to
+_NEGATION = re.compile(r"\b(?:never|not|don'?t|doesn'?t|avoid|instead of)\b", re.IGNORECASE)
+
+
+def opening_lines(agent_config):
+    """The fixed lines an agent is known to say: its "phrases" and the ones quoted in its PrePrompt"""
+    audio = (agent_config or {}).get('audio') or {}
+    lines = [phrase for phrase in audio.get('phrases', []) if isinstance(phrase, str)]
+    lines += _preprompt_openings((agent_config or {}).get('PrePrompt') or '')
+    # Same order, without repeats or blanks
+    return list(dict.fromkeys(line.strip() for line in lines if line.strip()))
+
+
+def _preprompt_openings(preprompt):
+    """The lines a PrePrompt tells the agent to open with"""
+    lines = []
+    for match in _PREPROMPT_OPENING.finditer(preprompt):
+        sentence_start = max(preprompt.rfind(mark, 0, match.start()) for mark in '.!?\n') + 1
+        instruction = preprompt[sentence_start:match.start(1)]
+        if not _NEGATION.search(instruction):
+            lines.append(match.group(1))
+    return lines
+
+
+def warm_formats(voice, synthesizer):
+    """Every format negotiate_audio_format picks for this voice for some browser, that the synthesizer can produce"""
+    clients = _CLIENTS if TTS_WARMUP_COMPACT else [(accept, kbps) for accept, kbps in _CLIENTS if kbps is None]
+    formats = [negotiate_audio_format(voice, synthesizer, accept=accept, connection_kbps=kbps)[0]
+               for accept, kbps in clients]
+    return [fmt for fmt in dict.fromkeys(formats) if synthesizer.supports_format(fmt)]
+
+
+def first_segment(text):
+    """The first sentence SpeechPipeline sends when text is streamed in"""
+    segmenter = SentenceSegmenter()
+    segments = segmenter.feed(text) + segmenter.flush()
+    return segments[0] if segments else ''
+
+
+def _warm_first_segment(synthesizer, voice, text, study):
+    """Cache the first sentence of text, the way SpeechPipeline asks for it. True if it was synthesized."""
+    request = dict(voice)
+    request['text_content'] = normalize_text(first_segment(text), voice['text_processing'])
+    if not request['text_content']:
+        return False
+    audio_format = voice['audio_format'].value
+    key = synthesizer.cache_key(**request)
+    if synthesizer.cache.lookup(key, audio_format):
+        return False
+    writer = synthesizer.cache.writer(audio_format, key, study)
+    try:
+        for chunk in synthesizer.synthesize_speech_streaming(use_cache=False, **request):
+            writer.write(chunk)
+        writer.commit()
+    finally:
+        writer.abort()
+    return True
+
+
+def _warm_whole_line(synthesizer, voice, text, study):
+    """Cache the clip a replay of text is served from. True if it was synthesized."""
+    if synthesizer.cache.lookup(synthesizer.cache_key(text, **voice), voice['audio_format'].value):
+        return False
+    pipeline = speak_text(synthesizer, voice, text, study=study)
+    for _ in pipeline.audio():
+        pass
+    if pipeline.errors:
+        raise RuntimeError(f"{pipeline.errors} part(s) failed")
+    return True
+
+
+def warm_up_agent(agent_name, agent_config):
+    """Synthesize and cache an agent's opening lines in every format. Returns the number of clips made."""
+    voice = agent_voice(agent_config)
+    lines = opening_lines(agent_config)
+    if voice is None or not lines:
+        return 0
+    synthesizer = agent_synthesizer(agent_config)
+    if synthesizer is None or synthesizer.cache is None:
+        return 0
+    made = 0
+    for audio_format in warm_formats(voice, synthesizer):
+        format_voice = dict(voice, audio_format=audio_format)
+        for line in lines:
+            try:
+                # The first sentence first: a single-sentence line then reuses it for the whole clip
+                made += _warm_first_segment(synthesizer, format_voice, line, agent_name)
+                made += _warm_whole_line(synthesizer, format_voice, line, agent_name)
+            except Exception as e:
+                print(f"TTS warm-up failed for agent {agent_name} ({audio_format.value}): {e}")
+    return made
+
+
+def warm_up_agents(agents):
+    """Warm up (agent name, agent config) pairs, one worker at a time"""
+    if not TTS_WARMUP:
+        return
+    os.makedirs(os.path.dirname(WARMUP_LOCK_FILE), exist_ok=True)
+    with open(WARMUP_LOCK_FILE, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            for agent_name, agent_config in agents:
+                made = warm_up_agent(agent_name, agent_config)
+                if made:
+                    print(f"TTS warm-up: cached {made} clip(s) for agent {agent_name}")
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def active_agents(db_path='users.db'):
+    """(agent name, agent config) of every agent with an active password"""
+    if not os.path.exists(db_path):
+        # First start: the app creates the database
+        return []
+    conn = sqlite3.connect(db_path)
+    try:
+        names = sorted({agent for agent, in conn.execute('SELECT agent FROM passwords WHERE is_active = 1')})
+    finally:
+        conn.close()
+    agents = []
+    for agent_name in names:
+        try:
+            with open(os.path.join(AGENTS_FOLDER, f'{agent_name}.json')) as f:
+                agents.append((agent_name, json.load(f)))
+        except (OSError, ValueError) as e:
+            print(f"TTS warm-up: could not read agent {agent_name}: {e}")
+    return agents
+
+
+def warm_up_in_background(agents):
+    """Run warm_up_agents on a daemon thread (the list is built by the caller, e.g. from the database)"""
+    if not TTS_WARMUP:
+        return
+    threading.Thread(target=warm_up_agents, args=(list(agents),), name='tts-warmup', daemon=True).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cache the audio of the active agents' opening lines")
+    parser.add_argument('--db', default='users.db', help='the app database (default: users.db)')
+    args = parser.parse_args()
+    try:
+        agents = active_agents(args.db)
+    except sqlite3.Error as e:
+        parser.exit(1, f"TTS warm-up: could not read the agents from {args.db}: {e}\n")
+    warm_up_agents(agents)